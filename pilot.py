@@ -10,12 +10,22 @@
 
 import argparse
 import logging
+import logging.handlers
+import signal
 import sys
 import threading
 
-from pilot.util.constants import SUCCESS, FAILURE, ERRNO_NOJOBS
-from pilot.util.https import https_setup
-from pilot.util.information import set_location
+# the import profiler has to be in place before the pilot modules are imported
+if '--profile-startup' in sys.argv:
+    from pilot.util.timing import ImportProfiler
+    import_profiler = ImportProfiler().install()
+else:
+    import_profiler = None
+
+# modules of options not given are imported where the options are handled, if at all
+from pilot.util.constants import SUCCESS, FAILURE, ERRNO_NOJOBS  # noqa: E402
+from pilot.util.https import https_setup, dump_metrics  # noqa: E402
+from pilot.util.timing import PhaseTimer, dump_profile  # noqa: E402
 
 VERSION = '2017-04-04.001'
 
@@ -25,15 +35,87 @@ def main():
     logger.info('pilot startup - version %s' % VERSION)
 
     args.graceful_stop = threading.Event()
+    from pilot.util.clock import Clock
+    args.clock = Clock(args.simulate_speed if args.simulate else 1)
+
+    args.simulation = None
+    if args.simulate:
+        # only needed for simulations, kept out of the pilot startup
+        from pilot.benchmark import simulation
+        args.simulation = simulation.setup(args)
+
+    if args.offload_workers:
+        logger.info('offloading CPU-heavy data tasks to %s worker processes' % args.offload_workers)
+
+    # kill -USR2 <pilot pid> switches sampling on and off
+    args.sampler = None
+    if args.profile:
+        toggle_profiler()
+    signal.signal(signal.SIGUSR2, toggle_profiler)
+
+    # the first getJob request records the end of the startup, see pilot.control.job.retrieve
+    timer = args.timer = PhaseTimer(args.startup_budget)
 
-    https_setup(args, VERSION)
+    with timer.phase('https_setup'):
+        https_setup(args, VERSION)
 
-    if not set_location(args):
+    # job retrieval starts while the storages are still being resolved
+    if not locate(timer):
+        if args.sampler is not None:
+            args.sampler.stop()
+        if args.simulation is not None:
+            args.simulation.stop()
         return False
 
     logger.info('workflow: %s' % args.workflow)
-    workflow = __import__('pilot.workflow.%s' % args.workflow, globals(), locals(), [args.workflow], -1)
-    return workflow.run(args)
+    with timer.phase('workflow'):
+        workflow = __import__('pilot.workflow.%s' % args.workflow, globals(), locals(), [args.workflow], -1)
+
+    # the workflow imports its controllers when it runs, the profiler stays installed for them
+    trace = workflow.run(args)
+
+    if import_profiler is not None:
+        import_profiler.uninstall()
+
+    if args.sampler is not None:
+        args.sampler.stop()
+    dump_metrics('pilot_metrics.json')
+    if args.simulation is not None:
+        args.simulation.stop('pilot_simulation.json')
+    if args.profile_startup:
+        dump_profile('pilot_startup.json', timer, import_profiler)
+
+    return trace
+
+
+def locate(timer):
+    """
+    Resolves the queue, site and storages of the pilot, the storages in the background.
+
+    :returns: `bool` -- whether the queue could be resolved
+    """
+    # compute nodes of HPC allocations have no outbound network, the jobs file has all the pilot needs
+    if args.workflow.endswith('_hpc'):
+        logging.getLogger(__name__).info('HPC workflow -- skipping the site information lookup')
+        return True
+
+    from pilot.util import information
+    if args.cache_dir is None:
+        args.cache_dir = information.CACHE_DIR
+    if args.cache_ttl is None:
+        args.cache_ttl = information.CACHE_TTL
+    return information.set_location(args, background=True, timer=timer)
+
+
+def toggle_profiler(*signal_args):
+    """
+    Switches the sampling of the thread stacks on and off, the profiler is started the first time.
+    """
+    if args.sampler is None:
+        from pilot.util import profiler
+        args.sampler = profiler.start(args.profile_interval, args.profile_output, enabled=True)
+    else:
+        args.sampler.toggle()
 
 
 if __name__ == '__main__':
@@ -74,6 +156,108 @@ if __name__ == '__main__':
                             default='mtest',
                             help='job prod/source label (default: mtest)')
 
+    # server endpoints
+    arg_parser.add_argument('--url',
+                            dest='url',
+                            default='https://pandaserver.cern.ch',
+                            help='PanDA server URL (default: https://pandaserver.cern.ch)')
+    arg_parser.add_argument('-p', '--port',
+                            dest='port',
+                            default=25443,
+                            type=int,
+                            help='PanDA server port (default: 25443)')
+    arg_parser.add_argument('--info-url',
+                            dest='info_url',
+                            default='http://atlas-agis-api.cern.ch',
+                            help='AGIS information system URL (default: http://atlas-agis-api.cern.ch)')
+
+    # information system cache
+    arg_parser.add_argument('--cache-dir',
+                            dest='cache_dir',
+                            default=None,
+                            help='node-wide AGIS cache directory (default: pilot-cache-<uid> in the temporary directory)')
+    arg_parser.add_argument('--cache-ttl',
+                            dest='cache_ttl',
+                            default=None,
+                            type=int,
+                            help='seconds before cached AGIS documents are refreshed (default: 3600)')
+
+    arg_parser.add_argument('--shutdown-grace',
+                            dest='shutdown_grace',
+                            default=60,
+                            type=float,
+                            help='seconds at the end of the lifetime, or after SIGTERM, for an orderly shutdown, '
+                                 'at most half the lifetime (default: 60)')
+
+    arg_parser.add_argument('--startup-budget',
+                            dest='startup_budget',
+                            default=30,
+                            type=float,
+                            help='seconds the startup may take before every further phase is logged as over budget (default: 30)')
+
+    # logging
+    arg_parser.add_argument('--log-max-bytes',
+                            dest='log_max_bytes',
+                            default=100 * 1024 * 1024,
+                            type=int,
+                            help='size in bytes at which the pilot log is rotated, 0 never rotates (default: 100MB)')
+    arg_parser.add_argument('--log-backups',
+                            dest='log_backups',
+                            default=5,
+                            type=int,
+                            help='number of rotated pilot logs to keep (default: 5)')
+    arg_parser.add_argument('--log-json',
+                            dest='log_json',
+                            action='store_true',
+                            default=False,
+                            help='also write the log as JSON lines keyed by PandaID to pilotlog.json')
+    arg_parser.add_argument('--log-rate',
+                            dest='log_rate',
+                            default=60,
+                            type=int,
+                            help='messages per minute from the same line of code before they are suppressed, 0 disables (default: 60)')
+
+    # state export for node monitoring
+    arg_parser.add_argument('--metrics-file',
+                            dest='metrics_file',
+                            default='pilot_status.prom',
+                            help='file periodically replaced with the pilot state (default: pilot_status.prom)')
+    arg_parser.add_argument('--metrics-format',
+                            dest='metrics_format',
+                            default='prometheus',
+                            choices=['prometheus', 'json'],
+                            help='format of the pilot state file (default: prometheus)')
+    arg_parser.add_argument('--metrics-interval',
+                            dest='metrics_interval',
+                            default=10,
+                            type=float,
+                            help='seconds between updates of the pilot state file (default: 10)')
+    arg_parser.add_argument('--metrics-socket',
+                            dest='metrics_socket',
+                            default=None,
+                            help='also serve the pilot state on this local Unix socket')
+
+    # profiling
+    arg_parser.add_argument('--profile',
+                            dest='profile',
+                            action='store_true',
+                            default=False,
+                            help='sample the thread stacks from the start, otherwise toggled with SIGUSR2')
+    arg_parser.add_argument('--profile-interval',
+                            dest='profile_interval',
+                            default=0.1,
+                            type=float,
+                            help='seconds between stack samples (default: 0.1)')
+    arg_parser.add_argument('--profile-output',
+                            dest='profile_output',
+                            default='pilot_profile.txt',
+                            help='collapsed stacks output file for flame graph tools (default: pilot_profile.txt)')
+    arg_parser.add_argument('--profile-startup',
+                            dest='profile_startup',
+                            action='store_true',
+                            default=False,
+                            help='report the import time of every module and the time to the first job request in pilot_startup.json')
+
     # SSL certificates
     arg_parser.add_argument('--cacert',
                             dest='cacert',
@@ -86,22 +270,194 @@ if __name__ == '__main__':
                             help='CA certificates path',
                             metavar='path/to/certificates/')
 
+    arg_parser.add_argument('--http-connections',
+                            dest='http_connections',
+                            default=4,
+                            type=int,
+                            help='maximum number of persistent HTTPS connections per server (default: 4)')
+    arg_parser.add_argument('--http-compress',
+                            dest='http_compress',
+                            action='store_true',
+                            default=False,
+                            help='send large request bodies gzip-compressed')
+
+    # event service
+    arg_parser.add_argument('--es-batch',
+                            dest='es_batch',
+                            default=10,
+                            type=int,
+                            help='maximum number of event ranges fetched per request (default: 10)')
+    arg_parser.add_argument('--es-lookahead',
+                            dest='es_lookahead',
+                            default=60,
+                            type=float,
+                            help='seconds of payload work to keep prefetched, at the measured consumption rate (default: 60)')
+    arg_parser.add_argument('--es-inflight',
+                            dest='es_inflight',
+                            default=2,
+                            type=int,
+                            help='event ranges handed to the payload ahead of its results (default: 2)')
+    arg_parser.add_argument('--es-update-batch',
+                            dest='es_update_batch',
+                            default=50,
+                            type=int,
+                            help='event range states sent to the server per update (default: 50)')
+    arg_parser.add_argument('--es-update-interval',
+                            dest='es_update_interval',
+                            default=30,
+                            type=float,
+                            help='seconds between event range updates with fewer states (default: 30)')
+
+    # HPC workflows
+    arg_parser.add_argument('--hpc-jobs',
+                            dest='hpc_jobs',
+                            default='hpc_jobs.json',
+                            help='file with the list of job descriptions for the HPC workflows (default: hpc_jobs.json)')
+    arg_parser.add_argument('--hpc-shared',
+                            dest='hpc_shared',
+                            default=None,
+                            help='directory on the shared filesystem with the input files, output files are moved there '
+                                 '(default: the directory of the jobs file)')
+    arg_parser.add_argument('--hpc-results',
+                            dest='hpc_results',
+                            default='hpc_results',
+                            help='directory for the job state files (default: hpc_results)')
+    arg_parser.add_argument('--hpc-cores',
+                            dest='hpc_cores',
+                            default=0,
+                            type=int,
+                            help='cores to pack the jobs onto, 0 for all cores of the node (default: 0)')
+
+    # CPU-heavy data tasks
+    arg_parser.add_argument('--offload-workers',
+                            dest='offload_workers',
+                            default=0,
+                            type=int,
+                            help='worker processes for compressing log tarballs and parsing job reports, '
+                                 '0 runs them in the pilot process (default: 0)')
+
+    # job working directories
+    arg_parser.add_argument('--scratch',
+                            dest='scratch',
+                            action='append',
+                            default=[],
+                            help='local scratch directory for the job working directories, tmpfs or SSD, may be repeated; '
+                                 'the fastest one a job fits on is used, else the pilot directory')
+    arg_parser.add_argument('--scratch-headroom',
+                            dest='scratch_headroom',
+                            default=2 * 1024 * 1024 * 1024,
+                            type=int,
+                            help='bytes a job needs on scratch besides its inputs and outputs (default: 2GB)')
+    arg_parser.add_argument('--failed-jobs-dir',
+                            dest='failed_jobs_dir',
+                            default='failed_jobs',
+                            help='directory the working directories of failed jobs are kept in for debugging (default: failed_jobs)')
+    arg_parser.add_argument('--failed-jobs-size',
+                            dest='failed_jobs_size',
+                            default=100 * 1024 * 1024,
+                            type=int,
+                            help='size in bytes the kept working directories of failed jobs may take, 0 keeps none (default: 100MB)')
+
+    # transfer stall detection
+    arg_parser.add_argument('--stall-rate',
+                            dest='stall_rate',
+                            default=10240,
+                            type=int,
+                            help='minimum transfer throughput in bytes/s before a transfer is considered stalled (default: 10240)')
+    arg_parser.add_argument('--stall-window',
+                            dest='stall_window',
+                            default=300,
+                            type=int,
+                            help='seconds the throughput must stay below the minimum to kill a transfer, 0 disables (default: 300)')
+    arg_parser.add_argument('--stall-retries',
+                            dest='stall_retries',
+                            default=2,
+                            type=int,
+                            help='number of times a stalled transfer is rescheduled (default: 2)')
+
+    # simulation
+    arg_parser.add_argument('--simulate',
+                            dest='simulate',
+                            action='store_true',
+                            default=False,
+                            help='run the jobs of a local mock server with a fake copytool and fake payloads, '
+                                 'and report the pipeline latency in pilot_simulation.json, see pilot/benchmark/simulation.py')
+    arg_parser.add_argument('--simulate-trace',
+                            dest='simulate_trace',
+                            default=None,
+                            help='replay the jobs of this file, one job description per line (default: synthetic jobs)')
+    arg_parser.add_argument('--simulate-jobs',
+                            dest='simulate_jobs',
+                            default=None,
+                            type=int,
+                            help='number of jobs to hand out (default: 10 synthetic jobs, or all jobs of the trace)')
+    arg_parser.add_argument('--simulate-speed',
+                            dest='simulate_speed',
+                            default=1,
+                            type=float,
+                            help='simulated seconds per real second, for the pilot and the fake executables (default: 1)')
+    arg_parser.add_argument('--simulate-bandwidth',
+                            dest='simulate_bandwidth',
+                            default=100 * 1024 * 1024,
+                            type=float,
+                            help='bytes/s of the fake copytool (default: 100MB/s)')
+    arg_parser.add_argument('--simulate-input-size',
+                            dest='simulate_input_size',
+                            default=1024 * 1024 * 1024,
+                            type=int,
+                            help='bytes per input file of the synthetic jobs (default: 1GB)')
+    arg_parser.add_argument('--simulate-output-size',
+                            dest='simulate_output_size',
+                            default=200 * 1024 * 1024,
+                            type=int,
+                            help='bytes per output file of the fake payloads (default: 200MB)')
+    arg_parser.add_argument('--simulate-runtime',
+                            dest='simulate_runtime',
+                            default=600,
+                            type=float,
+                            help='seconds the fake payloads run (default: 600)')
+    arg_parser.add_argument('--simulate-cpu',
+                            dest='simulate_cpu',
+                            default=0.9,
+                            type=float,
+                            help='fraction of a core the fake payloads keep busy (default: 0.9)')
+    arg_parser.add_argument('--simulate-memory',
+                            dest='simulate_memory',
+                            default=500,
+                            type=int,
+                            help='MB of memory the fake payloads use (default: 500)')
+
     args = arg_parser.parse_args()
 
-    console = logging.StreamHandler(sys.stdout)
+    # the workers are forked, which is only safe before any threads are started
+    if args.offload_workers:
+        from pilot.util import offload
+        offload.setup(args.offload_workers)
+
     if args.debug:
-        logging.basicConfig(filename='pilotlog.txt', level=logging.DEBUG,
-                            format='%(asctime)s | %(levelname)-8s | %(threadName)-10s | %(name)-32s | %(funcName)-32s | %(message)s')
-        console.setLevel(logging.DEBUG)
-        console.setFormatter(logging.Formatter('%(asctime)s | %(levelname)-8s | %(threadName)-10s | %(name)-32s | %(funcName)-32s | %(message)s'))
+        level = logging.DEBUG
+        formatter = logging.Formatter('%(asctime)s | %(levelname)-8s | %(threadName)-10s | %(name)-32s | %(funcName)-32s | %(message)s')
     else:
-        logging.basicConfig(filename='pilotlog.txt', level=logging.INFO,
-                            format='%(asctime)s | %(levelname)-8s | %(message)s')
-        console.setLevel(logging.INFO)
-        console.setFormatter(logging.Formatter('%(asctime)s | %(levelname)-8s | %(message)s'))
-    logging.getLogger('').addHandler(console)
+        level = logging.INFO
+        formatter = logging.Formatter('%(asctime)s | %(levelname)-8s | %(message)s')
+
+    # all threads log through a queue, only the log writer thread touches the files and the terminal
+    from pilot.util import logqueue
+    logfile = logging.handlers.RotatingFileHandler('pilotlog.txt', maxBytes=args.log_max_bytes, backupCount=args.log_backups)
+    logfile.setFormatter(formatter)
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(formatter)
+    handlers = [logfile, console]
+    if args.log_json:
+        jsonfile = logging.handlers.RotatingFileHandler('pilotlog.json', maxBytes=args.log_max_bytes, backupCount=args.log_backups)
+        jsonfile.setFormatter(logqueue.JSONFormatter())
+        handlers.append(jsonfile)
+    log_writer = logqueue.start(handlers, level=level, rate=args.log_rate)
 
     trace = main()
+    if args.offload_workers:
+        offload.stop()
+    log_writer.stop()
     logging.shutdown()
 
     if not trace:
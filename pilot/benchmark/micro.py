@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+# Microbenchmarks of the hot paths of the pilot, runnable offline on
+# synthetic data and against the local mock server:
+#
+#   prepare_log         log tarball of a job directory with many files
+#   set_location.cold   queue resolution from large AGIS documents, empty cache
+#   set_location.warm   the same, from the cache
+#   request             round trip of https.request to the mock server
+#   handoff             a job handed from one controller to the next through
+#                       the job registry, as in the generic workflow
+#   pfc                 PoolFileCatalog of a job with thousands of outputs
+#
+# Every benchmark is repeated, and reported with the statistics of its
+# seconds per call, in JSON together with the commit it ran on. Reports of
+# two commits are compared by their medians:
+#
+#   python -m pilot.benchmark.micro --output base.json
+#   git checkout feature
+#   python -m pilot.benchmark.micro --compare base.json
+
+import argparse
+import collections
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from pilot.benchmark.mockserver import MockServer
+from pilot.control import data
+from pilot.control.job import server_url
+from pilot.util import https, information
+from pilot.util.metrics import summarize
+from pilot.util.registry import JobRegistry, STATES, TRANSITIONS, UNQUEUED
+
+import logging
+logger = logging.getLogger(__name__)
+
+VERSION = 'benchmark'
+
+
+def _timed(func, repeat):
+    samples = []
+    for i in xrange(repeat):
+        start = time.time()
+        func()
+        samples.append(time.time() - start)
+    return samples
+
+
+def _log_line(i):
+    return '2017-04-04 12:00:00 | INFO     | event %08d processed in 0.%06ds\n' % (i, i * 7919 % 1000000)
+
+
+def bench_prepare_log(args, directory):
+    job = {'PandaID': 1,
+           'working_dir': os.path.join(directory, 'job-1'),
+           'inFiles': '',
+           'outFiles': 'log.tgz',
+           'logFile': 'log.tgz',
+           'logGUID': '00000000-0000-0000-0000-000000000001',
+           'scopeLog': 'mock'}
+    os.mkdir(job['working_dir'])
+    line = len(_log_line(0))
+    for i in xrange(args.log_files):
+        with open(os.path.join(job['working_dir'], 'file%05d.log' % i), 'w') as f:
+            f.write(''.join(_log_line(n) for n in xrange(i, i + args.log_file_size // line)))
+    return {'prepare_log': _timed(lambda: data.prepare_log(job, 'tarball_PandaJob_1_MOCK'), args.repeat)}
+
+
+def bench_set_location(args, directory):
+    server = MockServer(filler=args.filler).start()
+    location = argparse.Namespace(queue=server.queue, info_url=server.info_url, cache_dir=None, cache_ttl=3600)
+
+    def cold():
+        location.cache_dir = tempfile.mkdtemp(dir=directory)
+        information.set_location(location)
+        shutil.rmtree(location.cache_dir)
+
+    try:
+        results = {'set_location.cold': _timed(cold, args.repeat)}
+        location.cache_dir = tempfile.mkdtemp(dir=directory)
+        information.set_location(location)
+        results['set_location.warm'] = _timed(lambda: information.set_location(location), args.repeat)
+    finally:
+        server.stop()
+    return results
+
+
+def bench_request(args, directory):
+    server = MockServer().start()
+    url = server_url(argparse.Namespace(url=server.url, port=server.port), 'updateJob')
+    try:
+        samples = _timed(lambda: https.request(url, data={'jobId': 1, 'state': 'running'}), args.requests)
+    finally:
+        server.stop()
+    return {'request': samples}
+
+
+def bench_handoff(args, directory):
+    registry = JobRegistry()
+    since = {}
+    samples = []
+    finished = threading.Event()
+
+    def observe(job, previous, state, now):
+        if previous is not None:
+            samples.append(now - since[job['PandaID']])
+        since[job['PandaID']] = now
+        if state == 'finished':
+            finished.set()
+
+    def controller(state):
+        for job in iter(lambda: registry.next(state), None):
+            registry.transition(job, TRANSITIONS[state])
+            # as in the pilot, the controller starting a job hands it on once it ran
+            if TRANSITIONS[state] == 'running':
+                registry.transition(job, 'executed')
+
+    registry.observe(observe)
+    threads = [threading.Thread(target=controller, name=state, args=(state,)) for state in STATES[:-2] if state not in UNQUEUED]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # one job at a time, for the latency rather than the throughput
+    for panda_id in xrange(args.handoffs):
+        finished.clear()
+        registry.add({'PandaID': panda_id})
+        finished.wait()
+
+    registry.close()
+    [t.join() for t in threads]
+    return {'handoff': samples}
+
+
+def bench_pfc(args, directory):
+    files = [{'guid': '00000000-0000-0000-0000-%012d' % i,
+              'name': 'HITS.%08d._%06d.pool.root.1' % (1, i),
+              'pfn': 'root://mock.cern.ch//eos/mock/HITS.%08d._%06d.pool.root.1' % (1, i),
+              'bytes': 2000000000 + i,
+              'adler32': '%08x' % i} for i in xrange(args.outputs)]
+    return {'pfc': _timed(lambda: data.build_pfc(files), args.repeat)}
+
+
+BENCHMARKS = collections.OrderedDict([('prepare_log', bench_prepare_log),
+                                      ('set_location', bench_set_location),
+                                      ('request', bench_request),
+                                      ('handoff', bench_handoff),
+                                      ('pfc', bench_pfc)])
+
+
+def _commit():
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root, stderr=subprocess.STDOUT).strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def run(args):
+    """
+    Runs the benchmarks given by ``args.only``, all if empty.
+
+    :returns: `dict` -- the report
+    """
+    https.https_setup(args, VERSION)
+
+    commit, dirty = _commit()
+    report = {'commit': commit,
+              'dirty': dirty,
+              'python': sys.version.split()[0],
+              'platform': platform.platform(),
+              'time': time.time(),
+              'parameters': dict((name, getattr(args, name)) for name in ('repeat', 'log_files', 'log_file_size', 'filler',
+                                                                          'requests', 'handoffs', 'outputs')),
+              'benchmarks': {}}
+
+    directory = tempfile.mkdtemp()
+    try:
+        for name, benchmark in BENCHMARKS.items():
+            if args.only and name not in args.only:
+                continue
+            for result, samples in benchmark(args, directory).items():
+                report['benchmarks'][result] = summarize(samples)
+    finally:
+        shutil.rmtree(directory)
+    return report
+
+
+def compare(report, baseline, threshold=0.1):
+    """
+    Compares the medians of the benchmarks in both reports.
+
+    :param float threshold: relative change of the median counted as regression or improvement
+    :returns: `list` of (benchmark, baseline median, median, ratio, verdict)
+    """
+    rows = []
+    for name in sorted(set(report['benchmarks']) & set(baseline['benchmarks'])):
+        before, after = baseline['benchmarks'][name]['p50'], report['benchmarks'][name]['p50']
+        ratio = after / before if before else None
+        if ratio is None:
+            verdict = 'unknown'
+        elif ratio > 1 + threshold:
+            verdict = 'regression'
+        elif ratio < 1 - threshold:
+            verdict = 'improvement'
+        else:
+            verdict = 'unchanged'
+        rows.append((name, before, after, ratio, verdict))
+    return rows
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='microbenchmarks of the pilot hot paths')
+    arg_parser.add_argument('--only', nargs='*', default=[], choices=BENCHMARKS.keys(), help='benchmarks to run (default: all)')
+    arg_parser.add_argument('--repeat', default=20, type=int, help='calls per benchmark')
+    arg_parser.add_argument('--log-files', dest='log_files', default=1000, type=int, help='files in the job directory of prepare_log')
+    arg_parser.add_argument('--log-file-size', dest='log_file_size', default=10240, type=int, help='bytes per file of prepare_log')
+    arg_parser.add_argument('--filler', default=5000, type=int, help='unrelated entries per AGIS document of set_location')
+    arg_parser.add_argument('--requests', default=200, type=int, help='calls of the request benchmark')
+    arg_parser.add_argument('--handoffs', default=200, type=int, help='jobs handed through all states of the handoff benchmark')
+    arg_parser.add_argument('--outputs', default=5000, type=int, help='output files of the pfc benchmark')
+    arg_parser.add_argument('--http-connections', dest='http_connections', default=4, type=int)
+    arg_parser.add_argument('--http-compress', dest='http_compress', action='store_true', default=False)
+    arg_parser.add_argument('--cacert', default=None)
+    arg_parser.add_argument('--capath', default=None)
+    arg_parser.add_argument('--output', default=None, help='write the JSON report to this file')
+    arg_parser.add_argument('--compare', default=None, help='JSON report of another commit to compare with')
+    arg_parser.add_argument('--threshold', default=0.1, type=float, help='relative change of the median that counts (default: 0.1)')
+    args = arg_parser.parse_args()
+    args.graceful_stop = threading.Event()
+
+    logging.basicConfig(level=logging.ERROR, format='%(asctime)s | %(levelname)-8s | %(message)s')
+
+    report = run(args)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+    if args.compare is None:
+        sys.stdout.write(output + '\n')
+        return 0
+
+    with open(args.compare) as f:
+        baseline = json.load(f)
+    sys.stdout.write('%-20s %12s %12s %8s  %s\n' % ('benchmark', 'baseline', 'median', 'ratio', '%s -> %s' % (baseline['commit'], report['commit'])))
+    rows = compare(report, baseline, args.threshold)
+    for name, before, after, ratio, verdict in rows:
+        sys.stdout.write('%-20s %12.6f %12.6f %8s  %s\n' % (name, before, after, '%.2f' % ratio if ratio is not None else '-', verdict))
+    return 1 if [row for row in rows if row[4] == 'regression'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+# Local stand-in for the PanDA server and AGIS, for load tests and benchmarks.
+# Serves synthetic jobs, or those of a given source, through getJob, accepts
+# updateJob calls, hands out the event ranges of event service jobs and
+# records their states, and serves the AGIS queue, site and ddmendpoint lists
+# for a single mock queue, optionally padded with any number of filler
+# entries. Latency and failures can be injected into every request.
+#
+#   python -m pilot.benchmark.mockserver --port 8080 --latency 0.05 --failure-rate 0.01
+#   ./pilot.py -q MOCK_QUEUE --url http://localhost --port 8080 --info-url http://localhost:8080
+
+import argparse
+import BaseHTTPServer
+import collections
+import hashlib
+import json
+import random
+import SocketServer
+import ssl
+import threading
+import time
+import urlparse
+import zlib
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def synthetic_job(panda_id, nr_inputs=1, nr_outputs=1, walltime=3600):
+    """
+    Creates a job description with all the fields the pilot reads.
+    """
+    return {'StatusCode': 0,
+            'PandaID': panda_id,
+            'jobsetID': 1,
+            'taskID': 1,
+            'prodSourceLabel': 'mtest',
+            'transformation': 'Sim_tf.py',
+            'homepackage': 'AtlasProduction/20.7.5.1',
+            'jobPars': '--maxEvents=10 --inputEVNTFile=EVNT.pool.root --outputHITSFile=HITS.pool.root',
+            'inFiles': ','.join('EVNT.%s._%06d.pool.root.1' % (panda_id, i) for i in xrange(nr_inputs)),
+            'scopeIn': 'mc15_13TeV',
+            'ddmEndPointIn': 'MOCK_DATADISK',
+            'fsize': ','.join(['1048576'] * nr_inputs),
+            'outFiles': ','.join('HITS.%s._%06d.pool.root.1' % (panda_id, i) for i in xrange(nr_outputs)),
+            'scopeOut': 'mc15_13TeV',
+            'ddmEndPointOut': 'MOCK_DATADISK',
+            'destinationDblock': 'mc15_13TeV.mock.HITS_sub%s' % panda_id,
+            'logFile': 'log.%s.job.log.tgz.1' % panda_id,
+            'logGUID': '00000000-0000-0000-0000-%012d' % panda_id,
+            'scopeLog': 'mc15_13TeV',
+            'maxCpuCount': walltime,
+            'maxWalltime': walltime,
+            'coreCount': 1,
+            'minRamCount': 2000}
+
+
+def agis_documents(queue, site, filler=0):
+    """
+    Creates the AGIS pandaqueue, site and ddmendpoint lists for a single queue,
+    padded with ``filler`` unrelated entries of each kind.
+    """
+    queues = [{'name': queue, 'site': site, 'state': 'ACTIVE', 'type': 'production',
+               'maxtime': 172800, 'maxrss': 2000, 'corecount': 1}]
+    sites = [{'name': site, 'state': 'ACTIVE', 'tier_level': 2, 'cloud': 'MOCK'}]
+    storages = [{'name': 'MOCK_DATADISK', 'site': site, 'state': 'ACTIVE', 'type': 'DATADISK', 'rse': 'MOCK_DATADISK'},
+                {'name': 'MOCK_SCRATCHDISK', 'site': site, 'state': 'ACTIVE', 'type': 'SCRATCHDISK', 'rse': 'MOCK_SCRATCHDISK'}]
+    for i in xrange(filler):
+        queues.append({'name': 'FILLER_QUEUE_%s' % i, 'site': 'FILLER_SITE_%s' % (i // 4), 'state': 'ACTIVE', 'type': 'production',
+                       'maxtime': 172800, 'maxrss': 2000, 'corecount': 8, 'description': 'x' * 200})
+        sites.append({'name': 'FILLER_SITE_%s' % i, 'state': 'ACTIVE', 'tier_level': 2, 'cloud': 'MOCK', 'description': 'x' * 200})
+        storages.append({'name': 'FILLER_SITE_%s_DATADISK' % i, 'site': 'FILLER_SITE_%s' % i, 'state': 'ACTIVE',
+                         'type': 'DATADISK', 'rse': 'FILLER_SITE_%s_DATADISK' % i, 'description': 'x' * 200})
+    return {'pandaqueue': queues, 'site': sites, 'ddmendpoint': storages}
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the response goes out in one piece, not with a delayed ACK after every unbuffered header line
+    wbufsize = -1
+
+    def log_message(self, fmt, *args):
+        logger.debug(fmt % args)
+
+    def do_GET(self):
+        self._handle(None)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        self._handle(body)
+
+    def _handle(self, body):
+        server = self.server.mock
+        url = urlparse.urlsplit(self.path)
+        data = dict(urlparse.parse_qsl(body if body is not None else url.query))
+
+        if server.latency:
+            time.sleep(random.uniform(0, 2 * server.latency))
+
+        if server.failure_rate and random.random() < server.failure_rate:
+            server.count('failures')
+            return self._reply(503, 'injected failure', headers={'Retry-After': str(server.retry_after)})
+
+        handler = server.routes.get(url.path.rstrip('/').split('/')[-1])
+        if handler is None:
+            return self._reply(404, 'not found: %s' % url.path)
+        output = json.dumps(handler(url.path, data))
+
+        if body is None:
+            # documents fetched with GET support conditional requests
+            etag = '"%s"' % hashlib.md5(output).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                server.count('not_modified')
+                return self._reply(304, '', headers={'ETag': etag})
+            return self._reply(200, output, headers={'ETag': etag}, content_type='application/json')
+        return self._reply(200, output, content_type='application/json')
+
+    def _reply(self, status, body, headers=None, content_type='text/plain'):
+        headers = dict(headers or {})
+        if 'gzip' in self.headers.get('Accept-Encoding', '') and len(body) > 1024:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(header, headers[header])
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MockServer(object):
+    """
+    Local PanDA server and AGIS stand-in.
+
+    :param str queue: name of the only real queue in the AGIS documents
+    :param int jobs: number of jobs to hand out, `None` for unlimited
+    :param int event_ranges: number of event ranges to hand out per job
+    :param int walltime: walltime and CPU time limit of the jobs in seconds
+    :param source: function(PandaID) returning the job to hand out, `None` once there are no more, synthetic jobs if `None`
+    :param float latency: mean injected latency per request in seconds
+    :param float failure_rate: probability of answering a request with 503
+    :param int filler: number of unrelated entries in each AGIS document
+    :param certfile: PEM file with certificate and key to serve HTTPS, plain HTTP if `None`
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, queue='MOCK_QUEUE', site='MOCK_SITE', jobs=None, event_ranges=100, walltime=3600,
+                 source=None, latency=0, failure_rate=0, retry_after=1, filler=0, certfile=None):
+        self.queue = queue
+        self.jobs = jobs
+        self.event_ranges = event_ranges
+        self.walltime = walltime
+        self.source = source
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.retry_after = retry_after
+        self.agis = agis_documents(queue, site, filler)
+        self.states = {}
+        self.timings = {}
+        self.event_states = {}
+        self._served = collections.defaultdict(int)
+        self.counters = collections.defaultdict(int)
+        self._next_id = 1000000
+        self._lock = threading.Lock()
+        self.routes = {'getJob': self.get_job,
+                       'updateJob': self.update_job,
+                       'getEventRanges': self.get_event_ranges,
+                       'updateEventRanges': self.update_event_ranges,
+                       'list': self.agis_list}
+
+        self.httpd = _HTTPServer((host, port), _Handler)
+        self.httpd.mock = self
+        self.scheme = 'http'
+        if certfile is not None:
+            self.httpd.socket = ssl.wrap_socket(self.httpd.socket, certfile=certfile, server_side=True)
+            self.scheme = 'https'
+        self.host, self.port = self.httpd.server_address[:2]
+        self._thread = None
+
+    @property
+    def url(self):
+        """
+        Base URL without port, as given to :option:`--url`.
+        """
+        return '%s://%s' % (self.scheme, self.host)
+
+    @property
+    def info_url(self):
+        """
+        Base URL with port, as given to :option:`--info-url`.
+        """
+        return '%s://%s:%s' % (self.scheme, self.host, self.port)
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def get_job(self, path, data):
+        with self._lock:
+            self.counters['getJob'] += 1
+            if self.jobs is not None and self.counters['jobs'] >= self.jobs:
+                return {'StatusCode': 20}
+            self._next_id += 1
+            job = synthetic_job(self._next_id, walltime=self.walltime) if self.source is None else self.source(self._next_id)
+            if job is None:
+                return {'StatusCode': 20}
+            self.counters['jobs'] += 1
+        return job
+
+    def update_job(self, path, data):
+        with self._lock:
+            self.counters['updateJob'] += 1
+            self.states.setdefault(data.get('jobId'), []).append(data.get('state'))
+            if 'pilotTiming' in data:
+                self.timings[data.get('jobId')] = data['pilotTiming']
+        return {'StatusCode': 0, 'command': 'NULL'}
+
+    def get_event_ranges(self, path, data):
+        panda_id = int(data['pandaID'])
+        with self._lock:
+            self.counters['getEventRanges'] += 1
+            first = self._served[panda_id]
+            count = max(0, min(int(data.get('nRanges', 1)), self.event_ranges - first))
+            self._served[panda_id] = first + count
+        ranges = [{'eventRangeID': '%s-%s' % (panda_id, i),
+                   'startEvent': i,
+                   'lastEvent': i,
+                   'LFN': 'EVNT.%s._000000.pool.root.1' % panda_id,
+                   'GUID': '00000000-0000-0000-0000-%012d' % panda_id,
+                   'scope': 'mc15_13TeV'} for i in xrange(first, first + count)]
+        return {'StatusCode': 0, 'eventRanges': json.dumps(ranges)}
+
+    def update_event_ranges(self, path, data):
+        statuses = json.loads(data.get('eventRanges', '[]'))
+        with self._lock:
+            self.counters['updateEventRanges'] += 1
+            for status in statuses:
+                self.event_states[status['eventRangeID']] = status['eventStatus']
+        return {'StatusCode': 0, 'Returns': [True] * len(statuses)}
+
+    def agis_list(self, path, data):
+        # /request/<document>/query/list/?json
+        self.count('agis')
+        return self.agis[path.strip('/').split('/')[1]]
+
+    def start(self):
+        """
+        Serves requests in a background thread.
+        """
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='mockserver')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='local PanDA server and AGIS stand-in')
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', default=8080, type=int)
+    arg_parser.add_argument('--queue', default='MOCK_QUEUE')
+    arg_parser.add_argument('--jobs', default=None, type=int, help='number of jobs to serve (default: unlimited)')
+    arg_parser.add_argument('--walltime', default=3600, type=int, help='walltime limit of the jobs in seconds (default: 3600)')
+    arg_parser.add_argument('--event-ranges', dest='event_ranges', default=100, type=int, help='event ranges per job (default: 100)')
+    arg_parser.add_argument('--latency', default=0, type=float, help='mean injected latency in seconds')
+    arg_parser.add_argument('--failure-rate', dest='failure_rate', default=0, type=float, help='fraction of requests failing with 503')
+    arg_parser.add_argument('--filler', default=0, type=int, help='unrelated entries per AGIS document')
+    arg_parser.add_argument('--certfile', default=None, help='PEM certificate and key to serve HTTPS')
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s | %(levelname)-8s | %(message)s')
+    server = MockServer(host=args.host, port=args.port, queue=args.queue, jobs=args.jobs, event_ranges=args.event_ranges, walltime=args.walltime,
+                        latency=args.latency, failure_rate=args.failure_rate, filler=args.filler, certfile=args.certfile)
+    logger.info('serving PanDA and AGIS at %s' % server.info_url)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+# Simulation mode of the pilot, to measure the overhead of its pipeline and
+# compare scheduling changes without PanDA, rucio or Athena. With --simulate,
+# the pilot gets its jobs from the local mock server, and finds fake
+# executables in place of the copytool and the payload:
+#
+#   jobs      synthetic ones with the sizes and profile given, or replayed
+#             from a trace of recorded job descriptions
+#   rucio     downloads and uploads at the given bandwidth, to and from a
+#             storage directory; the files are sparse, of their nominal size
+#   payload   runs for the given time at the given CPU and memory usage, and
+#             writes the job report with its output files
+#
+# Everything else is the real pilot. The pilot and the fake executables run
+# on a clock --simulate-speed times faster than the real time, see
+# pilot.util.clock, and nothing is random, so that runs can be repeated. At
+# the end, pilot_simulation.json reports the time the jobs spent in every
+# state, the overhead of the pilot around the payloads, and the utilization
+# of the payload slot, all in simulated seconds. What is not simulated, like
+# the work of the pilot itself and starting the fake executables, takes real
+# time, which counts --simulate-speed times in simulated seconds: schedules
+# compare at any speed, the overhead of the pilot is measured at speed 1.
+#
+#   ./pilot.py -q MOCK_QUEUE --simulate --simulate-speed 100 -l 7200
+#
+# A trace has one job description per line, as sent by getJob. A job may
+# set its own profile in a 'simulation' field, e.g.
+#
+#   {"PandaID": 1, "inFiles": "EVNT.pool.root", "fsize": "2000000000", ...,
+#    "simulation": {"runtime": 3600, "cpu": 0.95, "memory": 1800}}
+#
+# The checkpoints of real jobs can be replayed as well:
+#
+#   cat job-*/checkpoint.json > trace.json
+
+import argparse
+import collections
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from pilot.benchmark.mockserver import MockServer, synthetic_job
+from pilot.util.clock import Clock
+from pilot.util.metrics import summarize
+
+import logging
+logger = logging.getLogger(__name__)
+
+# profile of the synthetic jobs, and of replayed jobs for what they do not set
+PROFILE = {'runtime': 600,
+           'cpu': 0.9,
+           'memory': 500,
+           'input_size': 1024 * 1024 * 1024,
+           'output_size': 200 * 1024 * 1024,
+           'exit_code': 0}
+
+# fields the pilot adds to the jobs, dropped from replayed checkpoints
+PILOT_FIELDS = ('working_dir', 'job_report', 'uploaded', 'reported', 'errmsg', 'timing')
+
+# largest block read at once by the fake copytool
+BLOCKSIZE = 16 * 1024 * 1024
+
+PAYLOAD = 'simulated_payload'
+
+
+def _sparse(path, size):
+    with open(path, 'ab') as f:
+        f.truncate(size)
+
+
+def simulated(job, profile, storage):
+    """
+    Turns a job description into one for the fake executables, and puts its inputs into the storage.
+
+    :param profile: `dict` -- the profile of the job, overridden by its 'simulation' field
+    :param storage: directory of the fake storage
+    """
+    profile = dict(profile, **job.get('simulation', {}))
+
+    in_files = [name for name in job['inFiles'].split(',') if name]
+    sizes = [size for size in str(job.get('fsize') or '').split(',') if size]
+    if len(sizes) != len(in_files):
+        sizes = [str(profile['input_size'])] * len(in_files)
+        job['fsize'] = ','.join(sizes)
+
+    directory = os.path.join(storage, job['scopeIn'])
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for name, size in zip(in_files, sizes):
+        _sparse(os.path.join(directory, name), int(size))
+
+    outputs = [name for name in job['outFiles'].split(',') if name and name != job['logFile']]
+    job['transformation'] = PAYLOAD
+    job['jobPars'] = '--runtime %s --cpu %s --memory %s --exit-code %s --outputs %s' \
+                     % (profile['runtime'], profile['cpu'], profile['memory'], profile['exit_code'],
+                        ','.join('%s=%s' % (name, profile['output_size']) for name in outputs))
+    return job
+
+
+class Synthetic(object):
+    """
+    Job source for the mock server, handing out jobs of the same profile.
+    """
+
+    def __init__(self, profile, storage):
+        self.profile = profile
+        self.storage = storage
+
+    def __call__(self, panda_id):
+        # the walltime requested by production jobs is about twice what they need
+        job = synthetic_job(panda_id, walltime=int(self.profile['runtime'] * 2))
+        return simulated(job, self.profile, self.storage)
+
+
+class Replay(object):
+    """
+    Job source for the mock server, handing out the jobs of a trace in order.
+
+    :param path: trace file with one job description, or job checkpoint, per line
+    """
+
+    def __init__(self, path, profile, storage):
+        self.profile = profile
+        self.storage = storage
+        self.jobs = collections.deque()
+        with open(path) as trace:
+            for line in trace:
+                if line.strip():
+                    record = json.loads(line)
+                    self.jobs.append(record.get('job', record))
+
+    def __call__(self, panda_id):
+        if not self.jobs:
+            return None
+        job = dict(synthetic_job(panda_id), **self.jobs.popleft())
+        for field in PILOT_FIELDS:
+            job.pop(field, None)
+        # the recorded PandaIDs could collide with jobs of earlier runs in the same directory
+        job['PandaID'] = panda_id
+        return simulated(job, self.profile, self.storage)
+
+
+class Simulation(object):
+    """
+    Mock server, fake executables and measurements of a simulated pilot run.
+
+    :param clock: `Clock` of the pilot
+    :param float bandwidth: bytes/s of the fake copytool
+    :param trace: trace file to replay, synthetic jobs if `None`
+    :param int jobs: number of jobs to hand out, `None` for all of the trace
+    """
+
+    def __init__(self, clock, bandwidth, profile=PROFILE, trace=None, jobs=None):
+        self.clock = clock
+        self.bandwidth = bandwidth
+        self.directory = tempfile.mkdtemp(prefix='pilot_simulation_')
+        self.storage = os.path.join(self.directory, 'storage')
+        os.mkdir(self.storage)
+        if trace is None:
+            source = Synthetic(profile, self.storage)
+        else:
+            source = Replay(trace, profile, self.storage)
+        self.server = MockServer(jobs=jobs, source=source)
+        self.start = None
+        self._history = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def setup(self, args):
+        """
+        Starts the mock server, points the pilot at it and puts the fake executables in its path.
+        """
+        self.server.start()
+        args.url, args.port, args.info_url = self.server.url, self.server.port, self.server.info_url
+        args.cache_dir = os.path.join(self.directory, 'cache')
+
+        bin_dir = os.path.join(self.directory, 'bin')
+        alrb = os.path.join(self.directory, 'alrb')
+        for directory in (bin_dir, os.path.join(alrb, 'user'), os.path.join(alrb, 'scripts')):
+            os.makedirs(directory)
+        for name, command in (('rucio', 'rucio'), (PAYLOAD, 'payload')):
+            with open(os.path.join(bin_dir, name), 'w') as script:
+                script.write('#!/bin/sh\nexec "%s" -m pilot.benchmark.simulation %s "$@"\n' % (sys.executable, command))
+            os.chmod(os.path.join(bin_dir, name), 0755)
+        with open(os.path.join(alrb, 'user', 'atlasLocalSetup.sh'), 'w') as script:
+            script.write('export AtlasSetup=%s\n' % alrb)
+        with open(os.path.join(alrb, 'scripts', 'asetup.sh'), 'w') as script:
+            script.write('true\n')
+
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        os.environ.update({'PATH': bin_dir + os.pathsep + os.environ.get('PATH', ''),
+                           'PYTHONPATH': os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])),
+                           'ATLAS_LOCAL_ROOT_BASE': alrb,
+                           'PILOT_SIMULATION_SPEED': str(self.clock.speed),
+                           'PILOT_SIMULATION_BANDWIDTH': str(self.bandwidth),
+                           'PILOT_SIMULATION_STORAGE': self.storage})
+
+        self.start = self.clock.time()
+        logger.info('simulation at %.0fx speed -- serving jobs at %s' % (self.clock.speed, self.server.info_url))
+
+    def observe(self, job, previous, state, now):
+        """
+        Registry observer recording the transitions of the jobs.
+        """
+        with self._lock:
+            self._history[job['PandaID']].append((state, now))
+
+    def report(self):
+        """
+        :returns: `dict` -- seconds the jobs spent in each state, overhead of the pilot around the
+                  payloads and utilization of the payload slot, in simulated seconds
+        """
+        now = self.clock.time()
+        with self._lock:
+            histories = [list(transitions) for transitions in self._history.values()]
+
+        stages = collections.defaultdict(list)
+        overhead = []
+        busy = 0
+        for transitions in histories:
+            running = 0
+            for (state, since), (following, until) in zip(transitions, transitions[1:]):
+                stages[state].append(until - since)
+                if state == 'running':
+                    running += until - since
+            # a payload still running at the end occupies the slot until then
+            if transitions[-1][0] == 'running':
+                running += now - transitions[-1][1]
+            busy += running
+            if transitions[-1][0] == 'finished':
+                overhead.append(transitions[-1][1] - transitions[0][1] - running)
+
+        elapsed = now - self.start
+        finished = len([transitions for transitions in histories if transitions[-1][0] == 'finished'])
+        return {'speed': self.clock.speed,
+                'elapsed': elapsed,
+                'jobs': {'finished': finished,
+                         'failed': len([transitions for transitions in histories if transitions[-1][0] == 'failed'])},
+                'jobs_per_hour': finished * 3600.0 / elapsed if elapsed else None,
+                'stages': dict((state, summarize(seconds)) for state, seconds in stages.items()),
+                'overhead': summarize(overhead),
+                'slot': {'busy': busy,
+                         'utilization': busy / elapsed if elapsed else None}}
+
+    def stop(self, path='pilot_simulation.json'):
+        """
+        Writes the report, stops the mock server and removes the storage and the fake executables.
+        """
+        report = self.report()
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+        logger.info('simulation: %s jobs finished, %s failed in %.0fs -- slot utilization %.1f%%'
+                    % (report['jobs']['finished'], report['jobs']['failed'], report['elapsed'], 100 * (report['slot']['utilization'] or 0)))
+        self.server.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        return report
+
+
+def setup(args):
+    """
+    Sets up the simulation given by the pilot arguments, see :option:`--simulate`.
+
+    :returns: `Simulation`
+    """
+    profile = dict(PROFILE,
+                   runtime=args.simulate_runtime,
+                   cpu=args.simulate_cpu,
+                   memory=args.simulate_memory,
+                   input_size=args.simulate_input_size,
+                   output_size=args.simulate_output_size)
+    jobs = args.simulate_jobs
+    if jobs is None and args.simulate_trace is None:
+        jobs = 10
+    simulation = Simulation(args.clock, args.simulate_bandwidth, profile=profile, trace=args.simulate_trace, jobs=jobs)
+    simulation.setup(args)
+    return simulation
+
+
+def _environment():
+    return (Clock(float(os.environ.get('PILOT_SIMULATION_SPEED', 1))),
+            float(os.environ.get('PILOT_SIMULATION_BANDWIDTH', 100 * 1024 * 1024)),
+            os.environ.get('PILOT_SIMULATION_STORAGE', '.'))
+
+
+def _transfer(clock, size, bandwidth):
+    """
+    Yields the bytes transferred so far at the given bandwidth, about ten times per real second.
+    """
+    step = max(1, int(bandwidth * clock.speed / 10))
+    done = 0
+    while done < size:
+        chunk = min(step, size - done)
+        clock.sleep(chunk / bandwidth)
+        done += chunk
+        yield done
+
+
+def rucio(argv):
+    """
+    Fake rucio client, for the download and upload commands as called by pilot.control.data.
+    """
+    clock, bandwidth, storage = _environment()
+
+    if 'download' in argv:
+        scope, names = argv[-1].split(':', 1)
+        for name in names.split(','):
+            source = os.path.join(storage, scope, name)
+            if not os.path.exists(source):
+                sys.stderr.write('Details: file %s:%s not found.\n' % (scope, name))
+                return 1
+            with open(name, 'wb') as destination:
+                for done in _transfer(clock, os.stat(source).st_size, bandwidth):
+                    destination.truncate(done)
+        return 0
+
+    # the upload reads and checksums the file like the real one, which the stall detection follows
+    scope, name = argv[argv.index('--scope') + 1], argv[-1]
+    checksum = 1
+    with open(name, 'rb') as source:
+        offset = 0
+        for done in _transfer(clock, os.fstat(source.fileno()).st_size, bandwidth):
+            while offset < done:
+                block = source.read(min(BLOCKSIZE, done - offset))
+                checksum = zlib.adler32(block, checksum)
+                offset += len(block)
+    directory = os.path.join(storage, scope)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    _sparse(os.path.join(directory, name), offset)
+
+    summary = {'%s:%s' % (scope, name): {'scope': scope,
+                                         'name': name,
+                                         'pfn': 'file://%s' % os.path.join(directory, name),
+                                         'bytes': offset,
+                                         'adler32': '%08x' % (checksum & 0xffffffff)}}
+    with open('rucio_upload.json', 'w') as summary_file:
+        json.dump(summary, summary_file)
+    return 0
+
+
+def payload(argv):
+    """
+    Fake payload, running for the given time at the given CPU and memory usage.
+    """
+    arg_parser = argparse.ArgumentParser(prog=PAYLOAD)
+    arg_parser.add_argument('--runtime', type=float, default=PROFILE['runtime'], help='seconds')
+    arg_parser.add_argument('--cpu', type=float, default=PROFILE['cpu'], help='fraction of a core in use')
+    arg_parser.add_argument('--memory', type=int, default=PROFILE['memory'], help='MB in use')
+    arg_parser.add_argument('--exit-code', dest='exit_code', type=int, default=PROFILE['exit_code'])
+    arg_parser.add_argument('--outputs', default='', help='output files as name=bytes,...')
+    args = arg_parser.parse_args(argv)
+    clock = _environment()[0]
+
+    # every page is written, for the memory to be resident
+    ballast = bytearray(args.memory * 1024 * 1024)
+    for i in xrange(0, len(ballast), 4096):
+        ballast[i] = 1
+
+    # busy for the CPU share of every tenth of a real second
+    cpu = min(1.0, max(0.0, args.cpu))
+    end = clock.monotonic() + args.runtime
+    while True:
+        tick = min(0.1, (end - clock.monotonic()) / clock.speed)
+        if tick <= 0:
+            break
+        busy = time.time() + tick * cpu
+        while time.time() < busy:
+            pass
+        time.sleep(tick * (1 - cpu))
+
+    outputs = []
+    for output in filter(None, args.outputs.split(',')):
+        name, size = output.rsplit('=', 1)
+        _sparse(name, int(size))
+        outputs.append({'subFiles': [{'name': name,
+                                      'file_guid': '00000000-0000-0000-0000-%012x' % (zlib.crc32(name) & 0xffffffff),
+                                      'file_size': int(size)}]})
+    with open('jobReport.json', 'w') as report:
+        json.dump({'exitCode': args.exit_code,
+                   'exitMsg': 'OK' if args.exit_code == 0 else 'simulated failure',
+                   'files': {'output': outputs}}, report)
+    return args.exit_code
+
+
+if __name__ == '__main__':
+    sys.exit({'rucio': rucio, 'payload': payload}[sys.argv[1]](sys.argv[2:]))
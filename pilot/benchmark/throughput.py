@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+# Server communication throughput benchmark. Runs a number of concurrent
+# simulated pilots against the local mock server (or any PanDA server given
+# by --url/--port), each fetching jobs and walking them through the state
+# updates of the generic workflow, and reports jobs per hour and the latency
+# of every pipeline stage.
+#
+#   python -m pilot.benchmark.throughput --pilots 50 --jobs 20 --latency 0.05 --failure-rate 0.01
+
+import argparse
+import collections
+import json
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from pilot.benchmark.mockserver import MockServer
+from pilot.control.job import send_state, server_url
+from pilot.util import https
+from pilot.util.information import set_location
+from pilot.util.metrics import summarize
+
+import logging
+logger = logging.getLogger(__name__)
+
+VERSION = 'benchmark'
+
+
+class Recorder(object):
+    """
+    Thread-safe collection of stage latencies.
+    """
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.failures = collections.defaultdict(int)
+        self._lock = threading.Lock()
+
+    def timed(self, stage, func, *args, **kwargs):
+        """
+        Calls the function and records its latency; a `None` or `False` result counts as failure.
+        """
+        start = time.time()
+        result = func(*args, **kwargs)
+        with self._lock:
+            self.latencies[stage].append(time.time() - start)
+            if result is None or result is False:
+                self.failures[stage] += 1
+        return result
+
+
+def _pfc(job, nr_outputs):
+    files = ''.join(' <File ID="%s-%s"><logical><lfn name="%s.%s"/></logical></File>\n' % (job['logGUID'], i, job['outFiles'], i)
+                    for i in xrange(nr_outputs))
+    return '<?xml version="1.0" encoding="UTF-8" standalone="no" ?>\n<POOLFILECATALOG>\n%s</POOLFILECATALOG>' % files
+
+
+def simulated_pilot(args, recorder, done):
+    """
+    Fetches jobs and sends their state updates as the generic workflow does, without running anything.
+    """
+    for i in xrange(args.jobs):
+        job = recorder.timed('getJob', https.request, server_url(args, 'getJob'),
+                             data={'siteName': args.queue, 'prodSourceLabel': args.job_label})
+        if job is None or job.get('StatusCode') != 0:
+            break
+        for state in ['transferring', 'starting', 'running'] + ['running'] * args.heartbeats + ['transferring']:
+            recorder.timed('updateJob.%s' % state, send_state, job, args, state)
+        recorder.timed('updateJob.finished', send_state, job, args, 'finished', xml=_pfc(job, args.outputs))
+        with recorder._lock:
+            done.append(job['PandaID'])
+
+
+def run(args):
+    recorder = Recorder()
+
+    # start from a cold information cache
+    args.cache_dir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        https.https_setup(args, VERSION)
+        recorder.timed('startup.set_location', set_location, args)
+        startup = time.time() - start
+    finally:
+        shutil.rmtree(args.cache_dir)
+
+    done = []
+    threads = [threading.Thread(target=simulated_pilot, name='pilot-%s' % i, args=(args, recorder, done))
+               for i in xrange(args.pilots)]
+    start = time.time()
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    elapsed = time.time() - start
+
+    return {'pilots': args.pilots,
+            'jobs': len(done),
+            'elapsed': elapsed,
+            'startup': startup,
+            'jobs_per_hour': len(done) * 3600.0 / elapsed if elapsed else None,
+            'failures': dict(recorder.failures),
+            'stages': dict((stage, summarize(values)) for stage, values in recorder.latencies.items())}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='PanDA server communication throughput benchmark')
+    arg_parser.add_argument('--url', default=None, help='PanDA server URL (default: start a local mock server)')
+    arg_parser.add_argument('-p', '--port', default=25443, type=int)
+    arg_parser.add_argument('--info-url', dest='info_url', default=None, help='AGIS URL (default: the mock server)')
+    arg_parser.add_argument('-q', dest='queue', default='MOCK_QUEUE')
+    arg_parser.add_argument('-j', dest='job_label', default='mtest')
+    arg_parser.add_argument('--pilots', default=10, type=int, help='concurrent simulated pilots')
+    arg_parser.add_argument('--jobs', default=10, type=int, help='jobs per simulated pilot')
+    arg_parser.add_argument('--heartbeats', default=3, type=int, help='running heartbeats per job')
+    arg_parser.add_argument('--outputs', default=10, type=int, help='output files per job in the final update')
+    arg_parser.add_argument('--latency', default=0, type=float, help='mock server mean latency in seconds')
+    arg_parser.add_argument('--failure-rate', dest='failure_rate', default=0, type=float, help='mock server failure rate')
+    arg_parser.add_argument('--filler', default=1000, type=int, help='unrelated entries per mock AGIS document')
+    arg_parser.add_argument('--http-connections', dest='http_connections', default=4, type=int)
+    arg_parser.add_argument('--http-compress', dest='http_compress', action='store_true', default=False)
+    arg_parser.add_argument('--cache-ttl', dest='cache_ttl', default=3600, type=int)
+    arg_parser.add_argument('--cacert', default=None)
+    arg_parser.add_argument('--capath', default=None)
+    arg_parser.add_argument('--output', default=None, help='write the JSON report to this file')
+    args = arg_parser.parse_args()
+    args.graceful_stop = threading.Event()
+
+    logging.basicConfig(level=logging.ERROR, format='%(asctime)s | %(levelname)-8s | %(message)s')
+
+    server = None
+    if args.url is None or args.info_url is None:
+        server = MockServer(queue=args.queue, latency=args.latency, failure_rate=args.failure_rate, filler=args.filler).start()
+        if args.url is None:
+            args.url, args.port = server.url, server.port
+        if args.info_url is None:
+            args.info_url = server.info_url
+
+    try:
+        report = run(args)
+    finally:
+        if server is not None:
+            server.stop()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -8,69 +8,194 @@
 # - Mario Lassnig, mario.lassnig@cern.ch, 2016-2017
 # - Daniel Drizhuk, d.drizhuk@gmail.com, 2017
 
+import collections
 import copy
-import Queue
 import json
 import os
 import subprocess
-import tarfile
 import threading
 import time
 
 from pilot.control.job import send_state
+from pilot.util import checkpoint, information, offload
+from pilot.util.filehandling import adler32
+from pilot.util.timing import timed
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-def control(queues, traces, args):
+def control(registry, traces, args):
 
     threads = [threading.Thread(target=copytool_in,
-                                kwargs={'queues': queues,
+                                name='copytool_in',
+                                kwargs={'registry': registry,
                                         'traces': traces,
                                         'args': args}),
                threading.Thread(target=copytool_out,
-                                kwargs={'queues': queues,
+                                name='copytool_out',
+                                kwargs={'registry': registry,
                                         'traces': traces,
                                         'args': args})]
 
-    [t.start() for t in threads]
+    # daemon threads, so that threads abandoned at shutdown do not keep the pilot from exiting
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
 
+    # the controller lives as long as its threads, for the shutdown to wait for it
+    [t.join() for t in threads]
 
-def _call(args, executable, cwd=os.getcwd(), logger=logger):
+
+class TransferMonitor(object):
+    """
+    Watches the byte progress of a running transfer and flags it as stalled when the
+    throughput stays below ``rate`` bytes/s for at least ``window`` seconds.
+
+    :param rate: minimum acceptable throughput in bytes/s
+    :param window: observation window in seconds
+    :param probe: function()->int returning the bytes transferred so far, or `None` if unknown
+    """
+
+    def __init__(self, rate, window, probe):
+        self.rate = rate
+        self.window = window
+        self.probe = probe
+        self.samples = collections.deque()
+        self.bytes = 0
+        self.throughput = None
+        self.stalled = False
+
+    def update(self, now=None):
+        """
+        Take a progress sample and re-evaluate the throughput over the last window.
+
+        :param now: sample timestamp (default: current time)
+        :returns: `True` if the transfer is stalled
+        """
+        if self.window <= 0:
+            return False
+
+        now = time.time() if now is None else now
+        current = self.probe() if self.probe is not None else None
+        if current is None:
+            return False
+
+        self.bytes = max(self.bytes, current)
+        self.samples.append((now, self.bytes))
+
+        # keep exactly one sample older than the window as the reference point
+        while len(self.samples) > 1 and now - self.samples[1][0] >= self.window:
+            self.samples.popleft()
+
+        start, start_bytes = self.samples[0]
+        if now - start >= self.window:
+            self.throughput = (self.bytes - start_bytes) / float(now - start)
+            self.stalled = self.throughput < self.rate
+
+        return self.stalled
+
+
+def _file_progress(directory, names):
+    """
+    Current size of the destination files of a download, including partially written ones.
+    """
+    total = 0
+    for name in names:
+        for path in (os.path.join(directory, name), os.path.join(directory, name + '.part')):
+            try:
+                total += os.stat(path).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _process_progress(pid, field='rchar'):
+    """
+    Bytes read or written so far by a process, as reported by the kernel in /proc/<pid>/io.
+    Returns `None` if the information is not available on this system.
+    """
     try:
-        process = subprocess.Popen(executable,
-                                   bufsize=-1,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE,
-                                   cwd=cwd)
-    except Exception as e:
-        logger.error('could not execute: %s' % str(e))
-        return False
+        with open('/proc/%s/io' % pid) as io:
+            for line in io:
+                key, value = line.split(':', 1)
+                if key == field:
+                    return int(value)
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def _count_bytes(traces, direction, nbytes):
+    traces.pilot['bytes_%s' % direction] += nbytes
 
-    logger.info('started -- pid=%s executable=%s' % (process.pid, executable))
+
+def _trace_stall(traces, job, direction, name, attempt, monitor):
+    traces.rucio.setdefault('stalls', []).append({'PandaID': job['PandaID'],
+                                                  'direction': direction,
+                                                  'name': name,
+                                                  'attempt': attempt,
+                                                  'bytes': monitor.bytes,
+                                                  'throughput': monitor.throughput,
+                                                  'timestamp': time.time()})
+
+
+def _wait(args, process, logger=logger, monitor=None, phase='exit'):
+    """
+    Wait for a copytool process to finish, terminating it when the given shutdown phase begins or
+    if the transfer monitor considers it stalled.
+
+    :returns: exit code, or `None` if the process had to be killed
+    """
+    stop = args.shutdown.stopping(phase)
 
     breaker = False
+    grace = 3
     exit_code = None
+    # short transfers, like the per-range uploads of the event service, are not held up by the polling
+    interval = 0.05
     while True:
-        for i in xrange(10):
-            if args.graceful_stop.is_set():
-                breaker = True
-                logger.debug('breaking: sending SIGTERM pid=%s' % process.pid)
-                process.terminate()
-                break
-            time.sleep(0.1)
+        if stop.wait(interval):
+            breaker = True
+            grace = min(grace, args.shutdown.remaining(phase))
+            logger.debug('breaking -- sending SIGTERM pid=%s' % process.pid)
+            process.terminate()
+
+        if not breaker and monitor is not None and monitor.update():
+            breaker = True
+            logger.warning('transfer stalled -- %s bytes at %.1f bytes/s over %ss -- sending SIGTERM pid=%s'
+                           % (monitor.bytes, monitor.throughput, monitor.window, process.pid))
+            process.terminate()
+
         if breaker:
-            logger.debug('breaking: sleep 3s before sending SIGKILL pid=%s' % process.pid)
-            time.sleep(3)
+            logger.debug('breaking -- sleep %.1fs before sending SIGKILL pid=%s' % (grace, process.pid))
+            time.sleep(grace)
             process.kill()
             break
 
         exit_code = process.poll()
+        logger.debug('running -- pid=%s exit_code=%s' % (process.pid, exit_code))
         if exit_code is not None:
             break
-        else:
-            continue
+        interval = min(1, interval * 2)
+
+    return exit_code
+
+
+def _call(args, executable, cwd=os.getcwd(), logger=logger, monitor=None, phase='exit'):
+    try:
+        process = subprocess.Popen(executable,
+                                   bufsize=-1,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   cwd=cwd)
+    except Exception as e:
+        logger.error('could not execute: %s' % str(e))
+        return False
+
+    logger.info('started -- pid=%s executable=%s' % (process.pid, executable))
+
+    exit_code = _wait(args, process, logger=logger, monitor=monitor, phase=phase)
 
     logger.info('finished -- pid=%s exit_code=%s' % (process.pid, exit_code))
     stdout, stderr = process.communicate()
@@ -83,20 +208,36 @@ def _call(args, executable, cwd=os.getcwd(), logger=logger):
         return False
 
 
-def _stage_in(args, job):
+def _stage_in(args, job, traces):
     log = logger.getChild(str(job['PandaID']))
 
     os.environ['RUCIO_LOGGING_FORMAT'] = '{0}%(asctime)s %(levelname)s [%(message)s]'
-    if not _call(args,
+    in_files = job['inFiles'].split(',')
+
+    for attempt in xrange(args.stall_retries + 1):
+        monitor = TransferMonitor(args.stall_rate, args.stall_window,
+                                  lambda: _file_progress(job['working_dir'], in_files))
+        if _call(args,
                  ['/usr/bin/env',
                   'rucio', '-v', 'download',
                   '--no-subdir',
                   '--rse', job['ddmEndPointIn'],
                   '%s:%s' % (job['scopeIn'], job['inFiles'])],
                  cwd=job['working_dir'],
-                 logger=log):
-        return False
-    return True
+                 logger=log,
+                 monitor=monitor,
+                 phase='fetch'):
+            _count_bytes(traces, 'in', sum(int(size) for size in job.get('fsize', '').split(',') if size))
+            return True
+
+        # stage-in is useless once no more jobs are started
+        if not monitor.stalled or args.shutdown.stopping('fetch').is_set():
+            return False
+
+        _trace_stall(traces, job, 'in', job['inFiles'], attempt, monitor)
+        log.warning('stage-in stalled -- rescheduling (attempt %s/%s)' % (attempt + 1, args.stall_retries + 1))
+
+    return False
 
 
 def stage_in_auto(site, files):
@@ -165,40 +306,35 @@ def stage_in_auto(site, files):
     return files
 
 
-def copytool_in(queues, traces, args):
+def copytool_in(registry, traces, args):
 
-    while not args.graceful_stop.is_set():
-        try:
-            job = queues.data_in.get(block=True, timeout=1)
-
-            send_state(job, 'transferring')
-
-            if _stage_in(args, job):
-                queues.finished_data_in.put(job)
-            else:
-                queues.failed_data_in.put(job)
-
-        except Queue.Empty:
-            continue
+    for job in iter(lambda: registry.next('validated'), None):
+        with timed(job, 'stagein', args.clock.time):
+            send_state(job, args, 'transferring')
+            staged_in = _stage_in(args, job, traces)
 
+        if staged_in:
+            registry.transition(job, 'staged_in')
+        else:
+            registry.fail(job, 'stage-in failed')
 
-def copytool_out(queues, traces, args):
 
-    while not args.graceful_stop.is_set():
-        try:
-            job = queues.data_out.get(block=True, timeout=1)
+def copytool_out(registry, traces, args):
 
-            logger.info('dataset=%s rse=%s' % (job['destinationDblock'], job['ddmEndPointOut'].split(',')[0]))
+    for job in iter(lambda: registry.next('staging_out'), None):
+        logger.info('dataset=%s rse=%s' % (job['destinationDblock'], job['ddmEndPointOut'].split(',')[0]))
 
-            send_state(job, 'transferring')
+        # the storages are resolved in the background during startup
+        if not information.wait_storages(args):
+            registry.fail(job, 'storages unknown')
+            continue
 
-            if _stage_out_all(job, args):
-                queues.finished_data_out.put(job)
-            else:
-                queues.failed_data_out.put(job)
+        send_state(job, args, 'transferring')
 
-        except Queue.Empty:
-            continue
+        if _stage_out_all(job, args, traces):
+            registry.transition(job, 'finished')
+        else:
+            registry.fail(job, 'stage-out failed')
 
 
 def prepare_log(job, tarball_name):
@@ -209,21 +345,40 @@ def prepare_log(job, tarball_name):
     output_files = job['outFiles'].split(',')
     force_exclude = ['geomDB', 'sqlite200']
 
-    with tarfile.open(name=os.path.join(job['working_dir'], job['logFile']),
-                      mode='w:gz',
-                      dereference=True) as log_tar:
-        for _file in list(set(os.listdir(job['working_dir'])) - set(input_files) - set(output_files) - set(force_exclude)):
-            logging.debug('adding to log: %s' % _file)
-            log_tar.add(os.path.join(job['working_dir'], _file),
-                        arcname=os.path.join(tarball_name, _file))
+    files = sorted(set(os.listdir(job['working_dir'])) - set(input_files) - set(output_files) - set(force_exclude))
+    for _file in files:
+        log.debug('adding to log: %s' % _file)
+
+    # compressing a large log directory is CPU-bound, so it goes to a worker process if there are any
+    path = os.path.join(job['working_dir'], job['logFile'])
+    summary = offload.call(_make_log_tarball, path, job['working_dir'], files, tarball_name)
+    log.info('log file ready -- %s bytes, adler32 %s' % (summary['bytes'], summary['adler32']))
 
     return {'scope': job['scopeLog'],
             'name': job['logFile'],
             'guid': job['logGUID'],
-            'bytes': os.stat(os.path.join(job['working_dir'], job['logFile'])).st_size}
+            'bytes': summary['bytes'],
+            'adler32': summary['adler32']}
 
 
-def _stage_out(args, outfile, job):
+def _make_log_tarball(path, directory, files, tarball_name):
+    """
+    Writes the log tarball, possibly in an offload worker process.
+
+    :returns: `dict` -- size and adler32 checksum of the tarball
+    """
+    import tarfile  # only needed at the end of a job, kept out of the pilot startup
+
+    with tarfile.open(name=path, mode='w:gz', dereference=True) as log_tar:
+        for _file in files:
+            log_tar.add(os.path.join(directory, _file),
+                        arcname=os.path.join(tarball_name, _file))
+
+    return {'bytes': os.stat(path).st_size,
+            'adler32': adler32(path)}
+
+
+def _stage_out(args, outfile, job, monitor=None):
     log = logger.getChild(str(job['PandaID']))
 
     os.environ['RUCIO_LOGGING_FORMAT'] = '%(asctime)s %(levelname)s [%(message)s]'
@@ -247,28 +402,11 @@ def _stage_out(args, outfile, job):
 
     log.info('started -- pid=%s executable=%s' % (process.pid, executable))
 
-    breaker = False
-    exit_code = None
-    while True:
-        for i in xrange(10):
-            if args.graceful_stop.is_set():
-                breaker = True
-                log.debug('breaking -- sending SIGTERM pid=%s' % process.pid)
-                process.terminate()
-                break
-            time.sleep(0.1)
-        if breaker:
-            log.debug('breaking -- sleep 3s before sending SIGKILL pid=%s' % process.pid)
-            time.sleep(3)
-            process.kill()
-            break
+    if monitor is not None:
+        # the upload destination is remote, so follow what the copytool has read from disk
+        monitor.probe = lambda: _process_progress(process.pid, 'rchar')
 
-        exit_code = process.poll()
-        log.info('running -- pid=%s exit_code=%s' % (process.pid, exit_code))
-        if exit_code is not None:
-            break
-        else:
-            continue
+    exit_code = _wait(args, process, logger=log, monitor=monitor)
 
     log.info('finished -- pid=%s exit_code=%s' % (process.pid, exit_code))
     out, err = process.communicate()
@@ -285,23 +423,26 @@ def _stage_out(args, outfile, job):
     return summary
 
 
-def _stage_out_all(job, args):
+def _stage_out_monitored(args, outfile, job, traces):
+    log = logger.getChild(str(job['PandaID']))
 
-    outputs = {}
+    for attempt in xrange(args.stall_retries + 1):
+        monitor = TransferMonitor(args.stall_rate, args.stall_window, None)
+        summary = _stage_out(args, outfile, job, monitor=monitor)
+        if summary is not None or not monitor.stalled or args.graceful_stop.is_set():
+            return summary
 
-    for f in job['job_report']['files']['output']:
-        outputs[f['subFiles'][0]['name']] = {'scope': job['scopeOut'],
-                                             'name': f['subFiles'][0]['name'],
-                                             'guid': f['subFiles'][0]['file_guid'],
-                                             'bytes': f['subFiles'][0]['file_size']}
+        _trace_stall(traces, job, 'out', outfile['name'], attempt, monitor)
+        log.warning('stage-out of %s stalled -- rescheduling (attempt %s/%s)' % (outfile['name'], attempt + 1, args.stall_retries + 1))
+
+    return None
 
-    outputs['%s:%s' % (job['scopeLog'], job['logFile'])] = prepare_log(job, 'tarball_PandaJob_%s_%s' % (job['PandaID'], args.queue))
 
-    pfc = '''<?xml version="1.0" encoding="UTF-8" standalone="no" ?>
+PFC_HEADER = '''<?xml version="1.0" encoding="UTF-8" standalone="no" ?>
 <!DOCTYPE POOLFILECATALOG SYSTEM "InMemory">
 <POOLFILECATALOG>'''
 
-    pfc_file = '''
+PFC_FILE = '''
  <File ID="{guid}">
   <logical>
    <lfn name="{name}"/>
@@ -312,25 +453,69 @@ def _stage_out_all(job, args):
  </File>
 '''
 
+
+def build_pfc(files):
+    """
+    :param files: uploaded files, `dict` with guid, name, pfn, bytes and adler32
+    :returns: `str` -- the PoolFileCatalog of the files, sent with the final job state
+    """
+    return ''.join([PFC_HEADER] + [PFC_FILE.format(**f) for f in files] + ['</POOLFILECATALOG>'])
+
+
+def _stage_out_all(job, args, traces):
+    log = logger.getChild(str(job['PandaID']))
+
+    outputs = {}
+
+    for f in job['job_report']['files']['output']:
+        outputs[f['subFiles'][0]['name']] = {'scope': job['scopeOut'],
+                                             'name': f['subFiles'][0]['name'],
+                                             'guid': f['subFiles'][0]['file_guid'],
+                                             'bytes': f['subFiles'][0]['file_size']}
+
+    # files uploaded before a restart of the pilot, see pilot.util.checkpoint
+    uploaded = job.setdefault('uploaded', {})
+
+    log_key = '%s:%s' % (job['scopeLog'], job['logFile'])
+    if log_key not in uploaded:
+        with timed(job, 'log', args.clock.time):
+            outputs[log_key] = prepare_log(job, 'tarball_PandaJob_%s_%s' % (job['PandaID'], args.queue))
+
     failed = False
 
     for outfile in outputs:
-        summary = _stage_out(args, outputs[outfile], job)
+        if outfile in uploaded:
+            log.info('%s was uploaded before -- skipping' % outputs[outfile]['name'])
+            continue
+
+        with timed(job, 'stageout', args.clock.time):
+            summary = _stage_out_monitored(args, outputs[outfile], job, traces)
 
         if summary is not None:
-            outputs[outfile]['pfn'] = summary['%s:%s' % (outputs[outfile]['scope'], outputs[outfile]['name'])]['pfn']
-            outputs[outfile]['adler32'] = summary['%s:%s' % (outputs[outfile]['scope'], outputs[outfile]['name'])]['adler32']
+            destination = summary['%s:%s' % (outputs[outfile]['scope'], outputs[outfile]['name'])]
+            if outputs[outfile].get('adler32', destination['adler32']) != destination['adler32']:
+                # the copy at the destination is not the file written here, it must not be registered
+                log.error('adler32 of %s changed in upload: %s locally, %s uploaded -- failing the transfer'
+                          % (outputs[outfile]['name'], outputs[outfile]['adler32'], destination['adler32']))
+                failed = True
+                continue
+            outputs[outfile]['pfn'] = destination['pfn']
+            outputs[outfile]['adler32'] = destination['adler32']
+
+            _count_bytes(traces, 'out', int(outputs[outfile]['bytes']))
 
-            pfc += pfc_file.format(**outputs[outfile])
+            uploaded[outfile] = outputs[outfile]
+            checkpoint.save(job, 'staging_out')
 
         else:
             failed = True
 
-    pfc += '</POOLFILECATALOG>'
+    pfc = build_pfc(uploaded.values())
 
+    # failed jobs are reported by pilot.control.job.report_failed
     if failed:
-        send_state(job, 'failed')
         return False
     else:
-        send_state(job, 'finished', xml=pfc)
+        with timed(job, 'final_update', args.clock.time):
+            job['reported'] = send_state(job, args, 'finished', xml=pfc)
         return True
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+# Payload controller of the event service. Instead of one payload run per
+# job, a long-lived payload processes event ranges fetched from the server
+# while it runs:
+#
+#   fetch    getEventRanges in batches into a prefetch buffer, which holds
+#            enough ranges for the payload to keep busy for the lookahead time
+#   feed     ranges are written to the payload stdin, one JSON object per
+#            line, keeping a few in flight so that the payload never waits;
+#            stdin is closed when the server has no more ranges
+#   collect  the payload writes one JSON object per processed range to the
+#            pipe whose file descriptor is in its environment variable
+#            PILOT_EVENT_RESULTS: {"eventRangeID": ..., "status": "finished"
+#            or "failed", "output": <file in the job directory, optional>}
+#   upload   outputs are uploaded as soon as their range is done
+#   update   the range states are sent to the server in batches
+#
+# The stdout and stderr of the payload are its logs, like those of any other
+# payload. When it has exited, the job goes on to the stage-out of its log
+# like any other job.
+
+import collections
+import fcntl
+import functools
+import json
+import os
+import Queue
+import subprocess
+import threading
+import time
+import uuid
+
+from pilot.control.data import _stage_out_monitored
+from pilot.control.job import send_state, server_url
+from pilot.control.payload import run_payload, setup_payload, validate_pre, wait_graceful
+from pilot.util import https
+from pilot.util.timing import record, timed
+
+import logging
+logger = logging.getLogger(__name__)
+
+# environment variable of the payload with the file descriptor it writes its results to
+RESULTS_FD = 'PILOT_EVENT_RESULTS'
+
+
+def control(registry, traces, args):
+
+    threads = [threading.Thread(target=validate_pre,
+                                name='validate_pre',
+                                kwargs={'registry': registry,
+                                        'traces': traces,
+                                        'args': args}),
+               threading.Thread(target=execute,
+                                name='execute',
+                                kwargs={'registry': registry,
+                                        'traces': traces,
+                                        'args': args}),
+               threading.Thread(target=validate_post,
+                                name='validate_post',
+                                kwargs={'registry': registry,
+                                        'traces': traces,
+                                        'args': args})]
+
+    # daemon threads, so that threads abandoned at shutdown do not keep the pilot from exiting
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # the controller lives as long as its threads, for the shutdown to wait for it
+    [t.join() for t in threads]
+
+
+class RangeBuffer(object):
+    """
+    Event ranges fetched ahead of the payload. The buffer wants as many ranges as the payload
+    consumes in the lookahead time, at the rate measured so far, and at least ``minimum``.
+
+    :param int minimum: ranges to hold before a rate is known, and at least afterwards
+    :param float lookahead: seconds of payload work to hold
+    """
+
+    def __init__(self, minimum, lookahead, clock=time.time):
+        self.minimum = minimum
+        self.lookahead = lookahead
+        self.clock = clock
+        self.rate = None
+        self.exhausted = False
+        self.starved = 0
+        self._ranges = collections.deque()
+        self._last = None
+        self._cond = threading.Condition()
+
+    def target(self):
+        if self.rate is None:
+            return self.minimum
+        return max(self.minimum, int(self.rate * self.lookahead + 0.5))
+
+    def wanted(self, timeout=None):
+        """
+        Waits until the buffer is below its target.
+
+        :returns: `int` -- number of ranges missing, 0 once the server has no more ranges
+        """
+        with self._cond:
+            if not self.exhausted and len(self._ranges) >= self.target():
+                self._cond.wait(timeout)
+            if self.exhausted:
+                return 0
+            return max(0, self.target() - len(self._ranges))
+
+    def put(self, ranges):
+        with self._cond:
+            self._ranges.extend(ranges)
+            self._cond.notify_all()
+
+    def finish(self):
+        """
+        Marks that the server has no more ranges.
+        """
+        with self._cond:
+            self.exhausted = True
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Takes the next range, waiting for one if the buffer is empty.
+
+        :returns: the range, or `None` if the server has no more ranges or the timeout expired
+        """
+        with self._cond:
+            if not self._ranges and not self.exhausted:
+                # the time waiting for the server says nothing about the payload
+                self.starved += 1
+                self._last = None
+                self._cond.wait(timeout)
+            if not self._ranges:
+                return None
+            event_range = self._ranges.popleft()
+
+            # exponentially weighted rate of the ranges taken
+            now = self.clock()
+            if self._last is not None and now > self._last:
+                rate = 1.0 / (now - self._last)
+                self.rate = rate if self.rate is None else 0.8 * self.rate + 0.2 * rate
+            self._last = now
+            self._cond.notify_all()
+            return event_range
+
+    def drain(self):
+        """
+        :returns: `list` of the ranges left unused
+        """
+        with self._cond:
+            ranges = list(self._ranges)
+            self._ranges.clear()
+            return ranges
+
+
+class StatusUpdater(threading.Thread):
+    """
+    Sends event range states to the server in batches, when ``batch`` states are waiting or
+    every ``interval`` seconds. States the server did not take are sent again with the next batch.
+    """
+
+    def __init__(self, url, batch, interval):
+        threading.Thread.__init__(self, name='es_update')
+        self.daemon = True
+        self.url = url
+        self.batch = batch
+        self.interval = interval
+        self.sent = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+
+    def add(self, status):
+        with self._lock:
+            self._pending.append(status)
+            if len(self._pending) >= self.batch:
+                self._wake.set()
+
+    def run(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            statuses, self._pending = self._pending, []
+        if not statuses:
+            return True
+        res = https.request(self.url, data={'eventRanges': json.dumps(statuses)})
+        if res is None or res.get('StatusCode') != 0:
+            logger.warning('could not update %s event ranges -- trying again with the next batch' % len(statuses))
+            with self._lock:
+                self._pending[:0] = statuses
+            return False
+        self.sent += len(statuses)
+        return True
+
+    def close(self):
+        """
+        Sends the states still waiting and stops the thread.
+        """
+        self._closed = True
+        self._wake.set()
+        self.join()
+        return not self._pending
+
+
+def _fetch(job, args, ranges):
+    log = logger.getChild(str(job['PandaID']))
+    url = server_url(args, 'getEventRanges')
+
+    while not args.graceful_stop.is_set():
+        wanted = ranges.wanted(timeout=1)
+        if ranges.exhausted:
+            break
+        if not wanted:
+            continue
+
+        res = https.request(url, data={'pandaID': job['PandaID'],
+                                       'jobsetID': job.get('jobsetID'),
+                                       'taskID': job.get('taskID'),
+                                       'nRanges': min(wanted, args.es_batch)})
+        if res is None or res.get('StatusCode') != 0:
+            delay = https.next_attempt(url)
+            log.warning('could not get event ranges -- retry in %.0fs' % delay)
+            args.graceful_stop.wait(delay)
+            continue
+
+        new = json.loads(res['eventRanges']) if res.get('eventRanges') else []
+        log.debug('got %s event ranges -- %s wanted, %s/s consumed' % (len(new), wanted, ranges.rate))
+        if not new:
+            log.info('no more event ranges')
+            ranges.finish()
+            break
+        ranges.put(new)
+
+
+def _feed(job, proc, exited, ranges, inflight, slots):
+    log = logger.getChild(str(job['PandaID']))
+
+    try:
+        while True:
+            slots.acquire()
+            event_range = None
+            while event_range is None and not exited.is_set():
+                event_range = ranges.get(timeout=1)
+                if event_range is None and ranges.exhausted:
+                    break
+            if event_range is None:
+                break
+            inflight[event_range['eventRangeID']] = event_range
+            proc.stdin.write(json.dumps(event_range) + '\n')
+            proc.stdin.flush()
+    except IOError as e:
+        log.warning('cannot feed the payload: %s' % str(e))
+    finally:
+        # end of input for the payload
+        try:
+            proc.stdin.close()
+        except IOError:
+            pass
+
+
+def _upload(job, args, traces, uploads, updater):
+    for status, output in iter(uploads.get, None):
+        if output is not None:
+            outfile = {'scope': job['scopeOut'],
+                       'name': output,
+                       'guid': str(uuid.uuid4())}
+            summary = _stage_out_monitored(args, outfile, job, traces)
+            if summary is None:
+                status['eventStatus'] = 'failed'
+            else:
+                status.update(summary['%s:%s' % (outfile['scope'], outfile['name'])])
+        updater.add(status)
+
+
+def _inherit(fd):
+    # runs in the forked payload before its exec, the other processes started meanwhile do not keep the pipe open
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) & ~fcntl.FD_CLOEXEC)
+
+
+def results_pipe():
+    """
+    Opens the pipe the payload writes its range results to.
+
+    :returns: the read end as a file, the write end as a file descriptor, and the keyword
+              arguments of `run_payload` that pass the write end on to the payload only
+    """
+    read_fd, write_fd = os.pipe()
+    for fd in (read_fd, write_fd):
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    env = dict(os.environ)
+    env[RESULTS_FD] = str(write_fd)
+    return os.fdopen(read_fd, 'rb'), write_fd, {'env': env, 'preexec_fn': functools.partial(_inherit, write_fd)}
+
+
+def run_ranges(job, args, traces, proc, exited, results):
+    """
+    Feeds event ranges to a running payload and handles its results until it exits.
+
+    :param exited: `threading.Event` set once the payload exited, the process is reaped by its supervisor
+    :param results: read end of the pipe the payload writes its results to, see `results_pipe`
+
+    :returns: `dict` -- number of ranges by state
+    """
+    log = logger.getChild(str(job['PandaID']))
+
+    ranges = RangeBuffer(args.es_inflight, args.es_lookahead)
+    inflight = {}
+    slots = threading.Semaphore(args.es_inflight)
+    uploads = Queue.Queue()
+    updater = StatusUpdater(server_url(args, 'updateEventRanges'), args.es_update_batch, args.es_update_interval)
+
+    threads = [threading.Thread(target=_fetch, name='es_fetch', args=(job, args, ranges)),
+               threading.Thread(target=_feed, name='es_feed', args=(job, proc, exited, ranges, inflight, slots)),
+               threading.Thread(target=_upload, name='es_upload', args=(job, args, traces, uploads, updater)),
+               updater]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    counts = collections.defaultdict(int)
+    for line in iter(results.readline, ''):
+        try:
+            result = json.loads(line)
+            event_range = inflight.pop(result['eventRangeID'])
+        except (ValueError, KeyError, TypeError):
+            log.warning('unexpected payload result: %s' % line.strip())
+            continue
+        slots.release()
+        counts[result.get('status', 'failed')] += 1
+        uploads.put(({'eventRangeID': event_range['eventRangeID'],
+                      'eventStatus': 'finished' if result.get('status') == 'finished' else 'failed'},
+                     result.get('output')))
+
+    # no more ranges are needed, the feeder and the fetcher stop at their next look at the buffer
+    ranges.finish()
+    slots.release()
+    threads[1].join()
+
+    # ranges the payload took but never reported are given back as failed
+    for event_range_id in inflight.keys():
+        counts['lost'] += 1
+        uploads.put(({'eventRangeID': event_range_id, 'eventStatus': 'failed'}, None))
+
+    unused = ranges.drain()
+    if unused:
+        log.info('%s prefetched event ranges unused' % len(unused))
+
+    uploads.put(None)
+    [t.join() for t in threads[:3]]
+    if not updater.close():
+        log.warning('event range states could not all be sent')
+
+    log.info('event ranges: %s -- payload waited for ranges %s times' % (dict(counts), ranges.starved))
+    return dict(counts)
+
+
+def execute(registry, traces, args):
+
+    for job in iter(lambda: registry.next('prepared'), None):
+        log = logger.getChild(str(job['PandaID']))
+        start = args.clock.time()
+
+        out = open(os.path.join(job['working_dir'], 'payload.stdout'), 'wb')
+        err = open(os.path.join(job['working_dir'], 'payload.stderr'), 'wb')
+
+        send_state(job, args, 'starting')
+        registry.transition(job, 'running')
+
+        exit_code = 1
+        if setup_payload(job, None, err):
+            log.debug('running event service payload')
+            send_state(job, args, 'running')
+            record(job, 'setup', args.clock.time() - start)
+            # the stage-out of the event ranges overlaps with the payload, and is counted with it
+            with timed(job, 'payload', args.clock.time):
+                results, results_fd, kwargs = results_pipe()
+                proc = run_payload(job, out, err, stdin=subprocess.PIPE, **kwargs)
+                # the payload holds the write end, the results end when it exits
+                os.close(results_fd)
+                if proc is not None:
+                    # heartbeats, the termination at shutdown, and the only wait for the process
+                    exited = threading.Event()
+                    supervisor = threading.Thread(target=wait_graceful, name='es_payload', args=(args, proc, job, exited))
+                    supervisor.daemon = True
+                    supervisor.start()
+                    run_ranges(job, args, traces, proc, exited, results)
+                    supervisor.join()
+                    exit_code = proc.returncode
+                    log.info('finished pid=%s exit_code=%s' % (proc.pid, exit_code))
+                results.close()
+        else:
+            record(job, 'setup', args.clock.time() - start)
+
+        out.close()
+        err.close()
+
+        if exit_code == 0:
+            registry.transition(job, 'executed')
+        else:
+            registry.fail(job, 'payload failed with exit code %s' % exit_code)
+
+
+def validate_post(registry, traces, args):
+
+    for job in iter(lambda: registry.next('executed'), None):
+        # the outputs went out range by range, only the log is left for the stage-out
+        job['job_report'] = {'files': {'output': []}}
+        registry.transition(job, 'staging_out')
@@ -8,34 +8,48 @@
 # - Mario Lassnig, mario.lassnig@cern.ch, 2016-2017
 # - Daniel Drizhuk, d.drizhuk@gmail.com, 2017
 
-import Queue
+import json
 import os
 import threading
-import time
 import urllib
 
-from pilot.util import https
+from pilot.util import checkpoint, https
+from pilot.util.timing import pilot_timing, record, timed
 
 import logging
 logger = logging.getLogger(__name__)
 
+# state of a job given back to the server without being started, e.g. for lack of time. It is
+# final: the server ends the job as it ends the jobs it reassigns, and gives the work of the job
+# to a new one, without counting a failed attempt
+RELEASED = 'closed'
 
-def control(queues, traces, args):
+
+def control(registry, traces, args):
 
     threads = [threading.Thread(target=validate,
-                                kwargs={'queues': queues,
+                                name='validate',
+                                kwargs={'registry': registry,
                                         'traces': traces,
                                         'args': args}),
                threading.Thread(target=retrieve,
-                                kwargs={'queues': queues,
+                                name='retrieve',
+                                kwargs={'registry': registry,
                                         'traces': traces,
                                         'args': args}),
-               threading.Thread(target=create_data_payload,
-                                kwargs={'queues': queues,
+               threading.Thread(target=report_failed,
+                                name='report_failed',
+                                kwargs={'registry': registry,
                                         'traces': traces,
                                         'args': args})]
 
-    [t.start() for t in threads]
+    # daemon threads, so that threads abandoned at shutdown do not keep the pilot from exiting
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # the controller lives as long as its threads, for the shutdown to wait for it
+    [t.join() for t in threads]
 
 
 def _validate_job(job):
@@ -48,7 +62,14 @@ def _validate_job(job):
     return True
 
 
-def send_state(job, state, xml=None):
+def server_url(args, command):
+    """
+    URL of a PanDA server command, e.g. ``getJob``, on the server given by :option:`--url` and :option:`--port`.
+    """
+    return '%s:%s/server/panda/%s' % (args.url, args.port, command)
+
+
+def send_state(job, args, state, xml=None):
     log = logger.getChild(str(job['PandaID']))
     log.debug('set job state=%s' % state)
 
@@ -58,8 +79,13 @@ def send_state(job, state, xml=None):
     if xml is not None:
         data['xml'] = urllib.quote_plus(xml)
 
+    # the final update carries where the time of the job went, see pilot.util.timing
+    if state in ('finished', 'failed') and job.get('timing'):
+        data['pilotTiming'] = pilot_timing(job['timing'])
+        data['pilotTimingBreakdown'] = json.dumps(job['timing'], sort_keys=True)
+
     try:
-        if https.request('https://pandaserver.cern.ch:25443/server/panda/updateJob', data=data) is not None:
+        if https.request(server_url(args, 'updateJob'), data=data) is not None:
             log.info('confirmed job state=%s' % state)
             return True
     except Exception as e:
@@ -70,82 +96,98 @@ def send_state(job, state, xml=None):
     return False
 
 
-def validate(queues, traces, args):
+def validate(registry, traces, args):
 
-    while not args.graceful_stop.is_set():
-        try:
-            job = queues.jobs.get(block=True, timeout=1)
-        except Queue.Empty:
-            continue
+    for job in iter(lambda: registry.next('retrieved'), None):
         log = logger.getChild(str(job['PandaID']))
+        start = args.clock.time()
 
         traces.pilot['nr_jobs'] += 1
 
-        if _validate_job(job):
-
-            log.debug('creating job working directory')
-            job_dir = 'job-%s' % job['PandaID']
-            try:
-                os.mkdir(job_dir)
-                job['working_dir'] = job_dir
-            except Exception as e:
-                log.debug('cannot create job working directory: %s' % str(e))
-                queues.failed_jobs.put(job)
-                break
-
-            log.debug('symlinking pilot log')
-            try:
-                os.symlink('../pilotlog.txt', os.path.join(job_dir, 'pilotlog.txt'))
-            except Exception as e:
-                log.debug('cannot symlink pilot log: %s' % str(e))
-                queues.failed_jobs.put(job)
-                break
-
-            queues.validated_jobs.put(job)
-        else:
-            queues.failed_jobs.put(job)
-
+        if not _validate_job(job):
+            registry.fail(job, 'job did not validate')
+            continue
 
-def create_data_payload(queues, traces, args):
+        log.debug('creating job working directory')
+        try:
+            job_dir = job['working_dir'] = args.workarea.place(job)
+        except Exception as e:
+            log.debug('cannot create job working directory: %s' % str(e))
+            registry.fail(job, 'cannot create job working directory')
+            continue
 
-    while not args.graceful_stop.is_set():
+        log.debug('symlinking pilot log')
         try:
-            job = queues.validated_jobs.get(block=True, timeout=1)
-        except Queue.Empty:
+            # the working directory may be on scratch elsewhere
+            os.symlink(os.path.abspath('pilotlog.txt'), os.path.join(job_dir, 'pilotlog.txt'))
+        except Exception as e:
+            log.debug('cannot symlink pilot log: %s' % str(e))
+            registry.fail(job, 'cannot symlink pilot log')
             continue
 
-        queues.data_in.put(job)
-        queues.payloads.put(job)
+        record(job, 'validate', args.clock.time() - start)
+        registry.transition(job, 'validated')
+
+
+def report_failed(registry, traces, args):
+
+    for job in iter(lambda: registry.next('failed'), None):
+        logger.getChild(str(job['PandaID'])).warning('job failed: %s' % job.get('errmsg', 'unknown error'))
+        with timed(job, 'final_update', args.clock.time):
+            reported = send_state(job, args, 'failed')
+        if reported:
+            checkpoint.remove(job)
+            args.workarea.clean_up(job, keep=True)
+
+
+def retrieve(registry, traces, args):
 
+    # no more jobs are fetched from the first phase of the shutdown on
+    stop = args.shutdown.stopping('fetch')
 
-def retrieve(queues, traces, args):
+    # consecutive answers without a job, for the backoff
+    empty = 0
 
-    while not args.graceful_stop.is_set():
+    while not stop.is_set():
+
+        if args.lifetime_manager.exhausted():
+            logger.info('%.0fs left, too short for another job -- no more jobs are fetched' % args.lifetime_manager.remaining())
+            break
 
         logger.debug('trying to fetch job')
 
         data = {'siteName': args.location.queue,
                 'prodSourceLabel': args.job_label}
 
-        res = https.request('https://pandaserver.cern.ch:25443/server/panda/getJob', data=data)
+        url = server_url(args, 'getJob')
+        start = args.clock.time()
+        res = https.request(url, data=data)
+
+        if 'first_getJob' not in args.timer.phases:
+            args.timer.record('first_getJob', args.timer.start)
 
         if res is None:
-            logger.warning('did not get a job -- sleep 1000s and repeat')
-            for i in xrange(10000):
-                if args.graceful_stop.is_set():
-                    break
-                time.sleep(0.1)
+            delay = https.next_attempt(url)
+            logger.warning('did not get a job -- server unavailable, retry in %.0fs' % delay)
+            args.clock.wait(stop, delay)
         else:
             if res['StatusCode'] != 0:
-                logger.warning('did not get a job -- sleep 1000s and repeat -- status: %s' % res['StatusCode'])
-                for i in xrange(10000):
-                    if args.graceful_stop.is_set():
-                        break
-                    time.sleep(0.1)
+                delay = https.next_attempt(url, attempt=empty)
+                empty += 1
+                logger.warning('did not get a job -- retry in %.0fs -- status: %s' % (delay, res['StatusCode']))
+                args.clock.wait(stop, delay)
             else:
+                empty = 0
+                # rather than downloading the inputs of a job which cannot finish anymore
+                admitted, estimate = args.lifetime_manager.admit(res)
+                if not admitted:
+                    logger.info('not enough time left for job %s: estimated %.0fs, %.0fs left -- giving it back, no more jobs are fetched'
+                                % (res['PandaID'], estimate, args.lifetime_manager.remaining()))
+                    send_state(res, args, RELEASED)
+                    break
+                logger.debug('admitted job %s -- estimated %.0fs, %.0fs left' % (res['PandaID'], estimate, args.lifetime_manager.remaining()))
+
                 logger.info('got job: %s -- sleep 1000s before trying to get another job' % res['PandaID'])
-                queues.jobs.put(res)
-                for i in xrange(10000):
-                    if args.graceful_stop.is_set():
-                        break
-                    time.sleep(0.1)
+                record(res, 'fetch', args.clock.time() - start)
+                registry.add(res)
+                args.clock.wait(stop, 1000)
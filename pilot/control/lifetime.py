@@ -18,18 +18,19 @@ def log_lifetime(sig, frame, traces):
                                                    traces.pilot['lifetime_max']))
 
 
-def control(queues, traces, args):
+def control(registry, traces, args):
 
     traces.pilot['lifetime_start'] = time.time()
-    traces.pilot['lifetime_max'] = time.time()
-
-    runtime = 0
-    while not args.graceful_stop.is_set():
-        if runtime < args.lifetime:
-            time.sleep(1)
-            runtime += 1
-        else:
-            logger.debug('maximum lifetime reached: %s' % args.lifetime)
-            args.graceful_stop.set()
-
-    logger.info('lifetime: %s used, %s maximum' % (runtime, args.lifetime))
+    traces.pilot['lifetime_max'] = args.lifetime
+
+    # the shutdown takes up the end of the lifetime
+    while args.shutdown.reason is None and args.lifetime_manager.remaining() > 0:
+        time.sleep(min(1, args.lifetime_manager.remaining()))
+
+    if args.shutdown.reason is None:
+        logger.debug('maximum lifetime reached: %s -- shutting down in the last %ss' % (args.lifetime, args.shutdown.grace))
+        args.shutdown.request('lifetime')
+
+    args.graceful_stop.wait()
+
+    logger.info('lifetime: %i used, %s maximum' % (int(args.lifetime_manager.elapsed()), args.lifetime))
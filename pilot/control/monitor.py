@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+# Exports the internal state of the pilot for node monitoring: jobs per state
+# and waiting to be handled, live threads, transferred bytes and the server
+# request metrics. The state is written periodically to a file that is replaced
+# atomically, in Prometheus text format (e.g. for the node exporter textfile
+# collector) or as JSON, and can optionally be read from a local Unix socket:
+#
+#   socat - UNIX-CONNECT:pilot_status.sock
+
+import json
+import os
+import socket
+import threading
+import time
+
+from pilot.util import https
+from pilot.util.filehandling import write_atomic
+from pilot.util.metrics import prometheus_histogram, prometheus_labels
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def control(registry, traces, args):
+
+    seen = set()
+    latest = ['']
+
+    server = None
+    if args.metrics_socket:
+        server = _listen(args.metrics_socket)
+        if server is not None:
+            thread = threading.Thread(target=_serve, name='monitor_socket', args=(server, latest, args))
+            thread.daemon = True
+            thread.start()
+
+    render = render_json if args.metrics_format == 'json' else render_prometheus
+
+    # the state is written once more after the stop, for the final counts
+    stopped = False
+    while not stopped:
+        stopped = args.graceful_stop.is_set()
+        latest[0] = render(collect(registry, traces, seen))
+        try:
+            # read by the node monitoring, e.g. the textfile collector of the node exporter
+            write_atomic(args.metrics_file, [latest[0]], mode=0o644)
+        except (OSError, IOError) as e:
+            logger.warning('could not write metrics file: %s' % str(e))
+        args.graceful_stop.wait(args.metrics_interval)
+
+    if server is not None:
+        server.close()
+        _unlink(args.metrics_socket)
+
+
+def collect(registry, traces, seen):
+    """
+    Takes a snapshot of the pilot state.
+
+    :param seen: `set` of the thread names seen in earlier snapshots, so that threads which
+                 have ended are reported with no live instance rather than disappearing
+    :returns: `dict` -- the pilot state
+    """
+    threads = dict((name, 0) for name in seen)
+    for thread in threading.enumerate():
+        threads[thread.name] = threads.get(thread.name, 0) + 1
+        seen.add(thread.name)
+
+    return {'time': time.time(),
+            'waiting': registry.backlog(),
+            'threads': threads,
+            'jobs': registry.counts(),
+            'nr_jobs': traces.pilot['nr_jobs'],
+            'bytes': {'in': traces.pilot['bytes_in'],
+                      'out': traces.pilot['bytes_out']},
+            'stalls': len(traces.rucio.get('stalls', [])),
+            'http': https.get_metrics()}
+
+
+def render_json(state):
+    return json.dumps(state, sort_keys=True)
+
+
+def render_prometheus(state):
+    """
+    :returns: `str` -- the pilot state in Prometheus text format
+    """
+    lines = ['# TYPE pilot_jobs_waiting gauge']
+    lines.extend('pilot_jobs_waiting%s %s' % (prometheus_labels({'state': name}), depth) for name, depth in sorted(state['waiting'].items()))
+
+    lines.append('# TYPE pilot_threads_alive gauge')
+    lines.extend('pilot_threads_alive%s %s' % (prometheus_labels({'thread': name}), count) for name, count in sorted(state['threads'].items()))
+
+    lines.append('# TYPE pilot_jobs gauge')
+    lines.extend('pilot_jobs%s %s' % (prometheus_labels({'state': name}), count) for name, count in sorted(state['jobs'].items()))
+
+    lines.extend(['# TYPE pilot_jobs_total counter',
+                  'pilot_jobs_total %s' % state['nr_jobs'],
+                  '# TYPE pilot_transfer_bytes_total counter'])
+    lines.extend('pilot_transfer_bytes_total%s %s' % (prometheus_labels({'direction': name}), nbytes) for name, nbytes in sorted(state['bytes'].items()))
+    lines.extend(['# TYPE pilot_transfer_stalls_total counter',
+                  'pilot_transfer_stalls_total %s' % state['stalls']])
+
+    # the heartbeats are the requests to the updateJob path
+    lines.extend(['# TYPE pilot_http_requests_total counter',
+                  '# TYPE pilot_http_errors_total counter',
+                  '# TYPE pilot_http_request_seconds histogram'])
+    for path, endpoint in sorted(state['http'].items()):
+        lines.append('pilot_http_requests_total%s %s' % (prometheus_labels({'path': path}), endpoint['requests']))
+        lines.extend('pilot_http_errors_total%s %s' % (prometheus_labels({'path': path, 'error': error}), count)
+                     for error, count in sorted(endpoint['errors'].items()))
+        lines.extend(prometheus_histogram('pilot_http_request_seconds', endpoint['phases']['total'], {'path': path}))
+
+    return '\n'.join(lines) + '\n'
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _listen(path):
+    # a socket left over by an earlier pilot in the same directory would make bind fail
+    _unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+        server.listen(5)
+    except socket.error as e:
+        logger.warning('could not listen on metrics socket %s: %s' % (path, str(e)))
+        server.close()
+        return None
+    server.settimeout(1)
+    return server
+
+
+def _serve(server, latest, args):
+    while not args.graceful_stop.is_set():
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            continue
+        except socket.error:
+            break
+        try:
+            # a client which does not read must not hold up the monitor
+            conn.settimeout(1)
+            conn.sendall(latest[0])
+        except socket.error as e:
+            logger.debug('metrics socket client went away: %s' % str(e))
+        finally:
+            conn.close()
@@ -9,7 +9,6 @@
 # - Daniel Drizhuk, d.drizhuk@gmail.com, 2017
 # - Tobias Wegner, tobias.wegner@cern.ch, 2017
 
-import Queue
 import json
 import os
 import subprocess
@@ -17,41 +16,54 @@ import threading
 import time
 
 from pilot.control.job import send_state
+from pilot.util import offload
+from pilot.util.timing import record, timed
 
 import logging
 logger = logging.getLogger(__name__)
 
+# fields of the job report used by the pilot
+JOB_REPORT_FIELDS = ('files', 'exitCode', 'exitMsg')
 
-def control(queues, traces, args):
+# seconds between the heartbeats of a running payload, and between the checks whether it exited
+HEARTBEAT_INTERVAL = 10
+POLL_INTERVAL = 1
+
+
+def control(registry, traces, args):
 
     threads = [threading.Thread(target=validate_pre,
-                                kwargs={'queues': queues,
+                                name='validate_pre',
+                                kwargs={'registry': registry,
                                         'traces': traces,
                                         'args': args}),
                threading.Thread(target=execute,
-                                kwargs={'queues': queues,
+                                name='execute',
+                                kwargs={'registry': registry,
                                         'traces': traces,
                                         'args': args}),
                threading.Thread(target=validate_post,
-                                kwargs={'queues': queues,
+                                name='validate_post',
+                                kwargs={'registry': registry,
                                         'traces': traces,
                                         'args': args})]
 
-    [t.start() for t in threads]
+    # daemon threads, so that threads abandoned at shutdown do not keep the pilot from exiting
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
 
+    # the controller lives as long as its threads, for the shutdown to wait for it
+    [t.join() for t in threads]
 
-def validate_pre(queues, traces, args):
 
-    while not args.graceful_stop.is_set():
-        try:
-            job = queues.payloads.get(block=True, timeout=1)
-        except Queue.Empty:
-            continue
+def validate_pre(registry, traces, args):
 
+    for job in iter(lambda: registry.next('staged_in'), None):
         if _validate_payload(job):
-            queues.validated_payloads.put(job)
+            registry.transition(job, 'prepared')
         else:
-            queues.failed_payloads.put(job)
+            registry.fail(job, 'payload did not validate')
 
 
 def _validate_payload(job):
@@ -72,7 +84,9 @@ def setup_payload(job, out, err):
         for db_name in ['sqlite200', 'geomDB']:
             src = '/cvmfs/atlas.cern.ch/repo/sw/database/DBRelease/current/%s' % db_name
             link_name = 'job-%s/%s' % (job['PandaID'], db_name)
-            os.symlink(src, link_name)
+            # the links of a payload run before a restart of the pilot are kept
+            if not os.path.islink(link_name):
+                os.symlink(src, link_name)
     except Exception as e:
         log.error('could not create symbolic links to database files: %s' % e)
         return False
@@ -80,7 +94,7 @@ def setup_payload(job, out, err):
     return True
 
 
-def run_payload(job, out, err):
+def run_payload(job, out, err, stdin=None, env=None, preexec_fn=None):
     log = logger.getChild(str(job['PandaID']))
 
     athena_version = job['homepackage'].split('/')[1]
@@ -95,9 +109,12 @@ def run_payload(job, out, err):
     try:
         proc = subprocess.Popen(asetup + cmd,
                                 bufsize=-1,
+                                stdin=stdin,
                                 stdout=out,
                                 stderr=err,
                                 cwd=job['working_dir'],
+                                env=env,
+                                preexec_fn=preexec_fn,
                                 shell=True)
     except Exception as e:
         log.error('could not execute: %s' % str(e))
@@ -108,93 +125,109 @@ def run_payload(job, out, err):
     return proc
 
 
-def wait_graceful(args, proc, job):
+def wait_graceful(args, proc, job, exited=None):
+    """
+    Supervises a running payload: sends its heartbeats, terminates it at shutdown and reaps it.
+    The only caller waiting for the process, others wait for ``exited`` and take its returncode.
+
+    :param exited: `threading.Event` set once the process is reaped
+    :returns: the exit code of the payload
+    """
     log = logger.getChild(str(job['PandaID']))
 
-    breaker = False
-    exit_code = None
-    while True:
-        for i in xrange(100):
-            if args.graceful_stop.is_set():
-                breaker = True
+    # payloads are terminated in the payload phase of the shutdown, and killed at its deadline
+    stop = args.shutdown.stopping('payload')
+
+    try:
+        heartbeat = args.clock.monotonic() + HEARTBEAT_INTERVAL
+        while True:
+            # heartbeats are on the clock, the checks of the process in real time
+            wait = min(heartbeat - args.clock.monotonic(), POLL_INTERVAL * args.clock.speed)
+            if args.clock.wait(stop, max(0, wait)) and proc.poll() is None:
                 log.debug('breaking -- sending SIGTERM pid=%s' % proc.pid)
                 proc.terminate()
-                break
-            time.sleep(0.1)
-        if breaker:
-            log.debug('breaking -- sleep 3s before sending SIGKILL pid=%s' % proc.pid)
-            time.sleep(3)
-            proc.kill()
-            break
-
-        exit_code = proc.poll()
-        log.info('running: pid=%s exit_code=%s' % (proc.pid, exit_code))
-        if exit_code is not None:
-            break
-        else:
-            send_state(job, 'running')
-            continue
-
-    return exit_code
-
-
-def execute(queues, traces, args):
-
-    while not args.graceful_stop.is_set():
-        try:
-            job = queues.validated_payloads.get(block=True, timeout=1)
-            log = logger.getChild(str(job['PandaID']))
-
-            q_snapshot = list(queues.finished_data_in.queue)
-            peek = [s_job for s_job in q_snapshot if job['PandaID'] == s_job['PandaID']]
-            if len(peek) == 0:
-                queues.validated_payloads.put(job)
-                for i in xrange(10):
-                    if args.graceful_stop.is_set():
-                            break
+                grace = args.shutdown.remaining('payload')
+                log.debug('breaking -- waiting %.1fs before sending SIGKILL pid=%s' % (grace, proc.pid))
+                deadline = args.shutdown.clock() + grace
+                while proc.poll() is None and args.shutdown.clock() < deadline:
                     time.sleep(0.1)
-                continue
+                if proc.poll() is None:
+                    proc.kill()
+                return proc.wait()
+
+            exit_code = proc.poll()
+            if exit_code is not None:
+                return exit_code
+            if args.clock.monotonic() >= heartbeat:
+                log.info('running: pid=%s' % proc.pid)
+                send_state(job, args, 'running')
+                heartbeat = args.clock.monotonic() + HEARTBEAT_INTERVAL
+    finally:
+        if exited is not None:
+            exited.set()
 
-            log.debug('opening payload stdout/err logs')
-            out = open(os.path.join(job['working_dir'], 'payload.stdout'), 'wb')
-            err = open(os.path.join(job['working_dir'], 'payload.stderr'), 'wb')
 
-            log.debug('setting up payload environment')
-            send_state(job, 'starting')
+def execute(registry, traces, args):
 
-            exit_code = 1
-            if setup_payload(job, out, err):
-                log.debug('running payload')
-                send_state(job, 'running')
+    for job in iter(lambda: registry.next('prepared'), None):
+        log = logger.getChild(str(job['PandaID']))
+        start = args.clock.time()
+
+        log.debug('opening payload stdout/err logs')
+        out = open(os.path.join(job['working_dir'], 'payload.stdout'), 'wb')
+        err = open(os.path.join(job['working_dir'], 'payload.stderr'), 'wb')
+
+        log.debug('setting up payload environment')
+        send_state(job, args, 'starting')
+        registry.transition(job, 'running')
+
+        exit_code = 1
+        if setup_payload(job, out, err):
+            log.debug('running payload')
+            send_state(job, args, 'running')
+            record(job, 'setup', args.clock.time() - start)
+            with timed(job, 'payload', args.clock.time):
                 proc = run_payload(job, out, err)
                 if proc is not None:
                     exit_code = wait_graceful(args, proc, job)
                     log.info('finished pid=%s exit_code=%s' % (proc.pid, exit_code))
+        else:
+            record(job, 'setup', args.clock.time() - start)
 
-            log.debug('closing payload stdout/err logs')
-            out.close()
-            err.close()
+        log.debug('closing payload stdout/err logs')
+        out.close()
+        err.close()
 
-            if exit_code == 0:
-                queues.finished_payloads.put(job)
-            else:
-                queues.failed_payloads.put(job)
+        if exit_code == 0:
+            registry.transition(job, 'executed')
+        else:
+            registry.fail(job, 'payload failed with exit code %s' % exit_code)
 
-        except Queue.Empty:
-            continue
 
+def read_job_report(path):
+    """
+    Parses a job report, possibly in an offload worker process. Reports can be large, so only
+    the fields the pilot uses are kept.
 
-def validate_post(queues, traces, args):
+    :returns: `dict` -- the job report fields in ``JOB_REPORT_FIELDS``
+    """
+    with open(path) as data_file:
+        report = json.load(data_file)
+    return dict((field, report[field]) for field in JOB_REPORT_FIELDS if field in report)
 
-    while not args.graceful_stop.is_set():
-        try:
-            job = queues.finished_payloads.get(block=True, timeout=1)
-        except Queue.Empty:
-            continue
+
+def validate_post(registry, traces, args):
+
+    for job in iter(lambda: registry.next('executed'), None):
         log = logger.getChild(str(job['PandaID']))
 
         log.debug('adding job report for stageout')
-        with open(os.path.join(job['working_dir'], 'jobReport.json')) as data_file:
-            job['job_report'] = json.load(data_file)
+        try:
+            with timed(job, 'report', args.clock.time):
+                job['job_report'] = offload.call(read_job_report, os.path.join(job['working_dir'], 'jobReport.json'))
+        except (IOError, ValueError) as e:
+            log.warning('cannot read job report: %s' % str(e))
+            registry.fail(job, 'cannot read job report')
+            continue
 
-        queues.data_out.put(job)
+        registry.transition(job, 'staging_out')
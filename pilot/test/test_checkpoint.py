@@ -0,0 +1,90 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pilot.util import checkpoint
+from pilot.util.registry import JobRegistry, STATES
+
+
+class TestCheckpoint(unittest.TestCase):
+    '''
+    Job checkpoints and their resumption by a restarted pilot.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.registry = JobRegistry()
+        self.registry.observe(checkpoint.observe)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _walk(self, panda_id, state):
+        job = {'PandaID': panda_id, 'working_dir': os.path.join(self.directory, 'job-%s' % panda_id)}
+        os.mkdir(job['working_dir'])
+        self.registry.add(job)
+        for following in STATES[1:STATES.index(state) + 1]:
+            self.registry.transition(job, following)
+        return job
+
+    def test_resume(self):
+        '''
+        Jobs resume from the last state which nothing was lost of, with everything they recorded.
+        '''
+        self._walk(1, 'validated')
+        self._walk(2, 'running')
+        job = self._walk(3, 'staging_out')
+        job['uploaded'] = {'log.tgz': {'pfn': 'mock://log.tgz'}}
+        checkpoint.save(job, 'staging_out')
+
+        jobs = checkpoint.load(self.directory)
+        self.assertEqual([(resumed['PandaID'], state) for resumed, state in jobs], [(1, 'validated'), (2, 'staged_in'), (3, 'staging_out')])
+        self.assertEqual(jobs[2][0]['uploaded'], {'log.tgz': {'pfn': 'mock://log.tgz'}})
+
+        registry = JobRegistry()
+        for resumed, state in jobs:
+            registry.add(resumed, state)
+        self.assertEqual(registry.next('staged_in', timeout=1)['PandaID'], 2)
+        self.assertEqual(registry.state(3), 'staging_out')
+
+    def test_final(self):
+        '''
+        Checkpoints are removed once the final state is confirmed, until then the final state is sent again.
+        '''
+        job = self._walk(1, 'staging_out')
+        job['reported'] = True
+        self.registry.transition(job, 'finished')
+        self.assertFalse(os.path.exists(os.path.join(job['working_dir'], checkpoint.FILENAME)))
+
+        job = self._walk(2, 'staging_out')
+        job['reported'] = False
+        self.registry.transition(job, 'finished')
+        self._walk(3, 'validated')
+        self.registry.fail(self.registry.get(3), 'stage-in failed')
+        self.assertEqual([(resumed['PandaID'], state) for resumed, state in checkpoint.load(self.directory)], [(2, 'staging_out'), (3, 'failed')])
+
+        # failed jobs are only handed on to be reported
+        registry = JobRegistry()
+        registry.add(checkpoint.load(self.directory)[1][0], 'failed')
+        self.assertEqual(registry.next('failed', timeout=1)['errmsg'], 'stage-in failed')
+        self.assertEqual(registry.counts()['failed'], 1)
+        self.assertIsNone(registry.get(3))
+
+    def test_broken(self):
+        '''
+        Unreadable checkpoints are ignored.
+        '''
+        self._walk(1, 'prepared')
+        os.mkdir(os.path.join(self.directory, 'job-2'))
+        with open(os.path.join(self.directory, 'job-2', checkpoint.FILENAME), 'w') as f:
+            f.write('{"state": "prep')
+        self.assertEqual([resumed['PandaID'] for resumed, state in checkpoint.load(self.directory)], [1])
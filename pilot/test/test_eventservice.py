@@ -0,0 +1,121 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import argparse
+import fcntl
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+
+from pilot.benchmark.mockserver import MockServer
+from pilot.control.eventservice import RangeBuffer, results_pipe, run_ranges
+from pilot.control.payload import wait_graceful
+from pilot.util import https
+from pilot.util.clock import Clock
+from pilot.util.shutdown import Shutdown
+
+# processes the ranges from stdin, every fifth one fails, and logs to stdout
+PAYLOAD = '''
+import json, os, sys
+results = os.fdopen(int(os.environ['PILOT_EVENT_RESULTS']), 'w')
+for i, line in enumerate(iter(sys.stdin.readline, '')):
+    event_range = json.loads(line)
+    print 'processing %s' % event_range['eventRangeID']
+    results.write(json.dumps({'eventRangeID': event_range['eventRangeID'],
+                              'status': 'failed' if i % 5 == 4 else 'finished'}) + '\\n')
+    results.flush()
+'''
+
+
+class TestEventService(unittest.TestCase):
+    '''
+    Event range prefetching and the range pipeline of a running payload.
+    '''
+
+    def setUp(self):
+        self.server = MockServer(event_ranges=25).start()
+        https._ctx.ssl_context = True
+        https._ctx.user_agent = 'pilot/test'
+        https._ctx.pool = https.ConnectionPool(maxsize=4)
+
+    def tearDown(self):
+        https._ctx.pool.close()
+        https._ctx.ssl_context = None
+        self.server.stop()
+
+    def test_buffer(self):
+        '''
+        The buffer holds the minimum until the payload rate is known, then the ranges of the lookahead time.
+        '''
+        now = [0]
+        ranges = RangeBuffer(2, 10, clock=lambda: now[0])
+        self.assertEqual(ranges.wanted(), 2)
+
+        ranges.put([{'eventRangeID': str(i)} for i in xrange(5)])
+        self.assertEqual(ranges.get()['eventRangeID'], '0')
+        now[0] += 0.5
+        ranges.get()
+        self.assertEqual(ranges.rate, 2)
+        self.assertEqual(ranges.target(), 20)
+        self.assertEqual(ranges.wanted(), 17)
+
+        ranges.get()
+        self.assertEqual(len(ranges.drain()), 2)
+        self.assertIsNone(ranges.get(timeout=0))
+        self.assertEqual(ranges.starved, 1)
+
+        ranges.finish()
+        self.assertEqual(ranges.wanted(), 0)
+        self.assertIsNone(ranges.get())
+
+    def test_ranges(self):
+        '''
+        All ranges of the mock server are processed by the payload and their states reported in batches.
+        '''
+        args = argparse.Namespace(url=self.server.url,
+                                  port=self.server.port,
+                                  graceful_stop=threading.Event(),
+                                  es_batch=10,
+                                  es_lookahead=1,
+                                  es_inflight=2,
+                                  es_update_batch=10,
+                                  es_update_interval=0.5)
+        results, results_fd, kwargs = results_pipe()
+        proc = subprocess.Popen([sys.executable, '-c', PAYLOAD], stdin=subprocess.PIPE, stdout=subprocess.PIPE, **kwargs)
+        # other processes started meanwhile do not hold the results open
+        self.assertTrue(fcntl.fcntl(results_fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC)
+        os.close(results_fd)
+
+        counts = run_ranges({'PandaID': 1, 'scopeOut': 'mock'}, args, None, proc, threading.Event(), results)
+        self.assertEqual(proc.stdout.read().count('processing'), 25)
+        self.assertEqual(proc.wait(), 0)
+        self.assertEqual(counts, {'finished': 20, 'failed': 5})
+        self.assertEqual(len(self.server.event_states), 25)
+        self.assertEqual(self.server.event_states.values().count('failed'), 5)
+        self.assertGreaterEqual(self.server.counters['getEventRanges'], 4)
+        self.assertLess(self.server.counters['updateEventRanges'], 25)
+
+    def test_supervisor(self):
+        '''
+        The payload is reaped by its supervisor only, the others wait for it and take its exit code.
+        '''
+        args = argparse.Namespace(clock=Clock(), shutdown=Shutdown(threading.Event(), grace=1))
+        for command, exit_code in (('exit 3', 3), ('sleep 30', -15)):
+            proc = subprocess.Popen(command, shell=True)
+            exited = threading.Event()
+            supervisor = threading.Thread(target=wait_graceful, args=(args, proc, {'PandaID': 1}, exited))
+            supervisor.start()
+            if exit_code < 0:
+                args.shutdown.start, args.shutdown.available = time.time(), 1
+                args.shutdown.stopping('payload').set()
+            self.assertTrue(exited.wait(5))
+            supervisor.join()
+            self.assertEqual(proc.returncode, exit_code)
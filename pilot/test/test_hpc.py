@@ -0,0 +1,119 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+from pilot.workflow import generic_hpc
+
+
+def _job(panda_id, cores=1, command='true', in_files='', out_files=''):
+    return {'PandaID': panda_id,
+            'coreCount': cores,
+            'homepackage': 'AtlasProduction/20.7.5.1',
+            'transformation': command,
+            'jobPars': '',
+            'inFiles': in_files,
+            'outFiles': out_files,
+            'scopeOut': 'mc15_13TeV',
+            'scopeLog': 'mc15_13TeV',
+            'logFile': 'log.%s.tgz' % panda_id,
+            'logGUID': '00000000-0000-0000-0000-%012d' % panda_id}
+
+
+class TestHPC(unittest.TestCase):
+    '''
+    Packing jobs onto the cores of a node.
+    '''
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.handlers = [signal.getsignal(signal.SIGINT), signal.getsignal(signal.SIGTERM)]
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        signal.signal(signal.SIGINT, self.handlers[0])
+        signal.signal(signal.SIGTERM, self.handlers[1])
+        shutil.rmtree(self.directory)
+
+    def test_pack(self):
+        '''
+        The first jobs that fit are chosen, smaller jobs fill the cores left.
+        '''
+        pending = [_job(1, 4), _job(2, 3), _job(3, 2), _job(4, 1)]
+        self.assertEqual([job['PandaID'] for job in generic_hpc.pack(pending, 6)], [1, 3])
+        self.assertEqual([job['PandaID'] for job in generic_hpc.pack(pending, 1)], [4])
+        self.assertEqual(generic_hpc.pack(pending, 0), [])
+
+    def test_run(self):
+        '''
+        Jobs are run from the jobs file, with inputs and outputs on the shared filesystem, and their states written.
+        '''
+        os.mkdir('shared')
+        with open('shared/IN.5', 'w') as f:
+            f.write('input')
+        jobs = [_job(1, 2, 'echo output > OUT.1', out_files='OUT.1'),
+                _job(2, 1, 'exit 3'),
+                _job(3, 1, in_files='IN.3'),
+                _job(4, 4),
+                _job(5, 1, 'cat IN.5 > OUT.5', in_files='IN.5', out_files='OUT.5')]
+        with open('shared/jobs.json', 'w') as f:
+            json.dump(jobs, f)
+
+        args = argparse.Namespace(graceful_stop=threading.Event(), lifetime=60, shutdown_grace=10, queue='HPC',
+                                  hpc_jobs='shared/jobs.json', hpc_shared=None, hpc_results='results', hpc_cores=2)
+        traces = generic_hpc.run(args)
+
+        states = dict((panda_id, json.load(open('results/%s.json' % panda_id))) for panda_id in xrange(1, 6))
+        self.assertEqual(dict((panda_id, state['state']) for panda_id, state in states.items()),
+                         {1: 'finished', 2: 'failed', 3: 'failed', 4: 'failed', 5: 'finished'})
+        self.assertEqual(states[2]['exitCode'], 3)
+        self.assertEqual(states[4]['errmsg'], 'needs 4 cores, the node has 2')
+        self.assertEqual([output['name'] for output in states[5]['outputs']], ['OUT.5', 'log.5.tgz'])
+        self.assertEqual(open('shared/OUT.5').read(), 'input')
+        self.assertTrue(os.path.exists('shared/log.1.tgz'))
+        self.assertEqual((traces.pilot['nr_jobs'], traces.pilot['finished'], traces.pilot['failed']), (5, 2, 3))
+
+    def test_stage_out(self):
+        '''
+        The payloads on the freed cores are started and supervised while the stage-outs of the jobs done before run.
+        '''
+        with open('jobs.json', 'w') as f:
+            json.dump([_job(1), _job(2), _job(3)], f)
+        stage_out = generic_hpc._stage_out
+        waited = []
+
+        def slow(job, args, shared):
+            # the last job only starts once the scheduler saw the second one finish
+            if job['PandaID'] == 1:
+                deadline = time.time() + 10
+                while not os.path.exists('results/3.json') and time.time() < deadline:
+                    time.sleep(0.05)
+                waited.append(os.path.exists('results/3.json'))
+            return stage_out(job, args, shared)
+
+        args = argparse.Namespace(graceful_stop=threading.Event(), lifetime=60, shutdown_grace=10, queue='HPC',
+                                  hpc_jobs='jobs.json', hpc_shared=None, hpc_results='results', hpc_cores=1)
+        generic_hpc._stage_out = slow
+        try:
+            traces = generic_hpc.run(args)
+        finally:
+            generic_hpc._stage_out = stage_out
+
+        self.assertEqual(waited, [True])
+        self.assertEqual([json.load(open('results/%s.json' % panda_id))['state'] for panda_id in xrange(1, 4)], ['finished'] * 3)
+        self.assertEqual(traces.pilot['finished'], 3)
@@ -0,0 +1,235 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import BaseHTTPServer
+import json
+import threading
+import unittest
+import zlib
+
+from pilot.util import https, metrics
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.clients.add(self.client_address)
+        status, headers = self.server.responses.pop(0) if self.server.responses else (200, {})
+        if self.headers.get('Content-Encoding') == 'gzip':
+            if self.server.reject_gzip:
+                status, body = 415, ''
+            else:
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        self.server.bodies.append(body)
+        body = json.dumps({'StatusCode': 0, 'echo': [body] * 100})
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            headers = dict(headers, **{'Content-Encoding': 'gzip'})
+        self.send_response(status)
+        for header in headers:
+            self.send_header(header, headers[header])
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        # drops the keep-alive connection without telling the client
+        if self.server.drop:
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHTTPS(unittest.TestCase):
+    '''
+    Connection pooling, retries and circuit breaking of the request layer.
+    '''
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.clients = set()
+        self.server.responses = []
+        self.server.bodies = []
+        self.server.reject_gzip = False
+        self.server.drop = False
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.url = 'http://127.0.0.1:%s/server/panda/test' % self.server.server_port
+        https._ctx.ssl_context = True
+        https._ctx.user_agent = 'pilot/test'
+        https._ctx.pool = https.ConnectionPool(maxsize=2)
+        https._breakers.clear()
+        https._uncompressed.clear()
+        https._endpoints.clear()
+        https.set_retry_policy('/server/panda/test', attempts=3, base=0.01, cap=0.01)
+
+    def tearDown(self):
+        https._ctx.pool.close()
+        https._ctx.ssl_context = None
+        https._ctx.compress = False
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keepalive(self):
+        '''
+        Consecutive requests share one persistent connection.
+        '''
+        for i in xrange(5):
+            self.assertEqual(https.request(self.url, data={'i': i})['StatusCode'], 0)
+        self.assertEqual(len(self.server.clients), 1)
+
+        endpoint = https.get_metrics()['/server/panda/test']
+        self.assertEqual(endpoint['requests'], 5)
+        self.assertEqual(endpoint['phases']['connect']['count'], 1)
+        self.assertEqual(endpoint['phases']['tls']['count'], 0)
+        self.assertEqual(endpoint['phases']['first_byte']['count'], 5)
+        self.assertEqual(endpoint['phases']['decode']['count'], 5)
+        self.assertEqual(endpoint['size']['count'], 5)
+        self.assertEqual(endpoint['errors'], {})
+
+    def test_pool(self):
+        '''
+        Released connections are handed out again, those not to be reused are closed and replaced.
+        '''
+        pool = https.ConnectionPool(maxsize=1)
+        key = ('http', '127.0.0.1', self.server.server_port)
+        conn, reused = pool.acquire(key)
+        self.assertFalse(reused)
+        pool.release(key, conn)
+        self.assertEqual(pool.acquire(key), (conn, True))
+        pool.release(key, conn, reuse=False)
+        other, reused = pool.acquire(key)
+        self.assertIsNot(other, conn)
+        self.assertFalse(reused)
+        pool.release(key, other)
+        pool.close()
+
+    def test_stale(self):
+        '''
+        A keep-alive connection the server dropped is replaced by a fresh one, without failing the request.
+        '''
+        self.server.drop = True
+        for i in xrange(3):
+            self.assertEqual(https.request(self.url, data={'i': i})['StatusCode'], 0)
+        self.assertEqual(len(self.server.clients), 3)
+        self.assertEqual(len(self.server.bodies), 3)
+        self.assertEqual(https.get_metrics()['/server/panda/test']['errors'], {})
+
+    def test_retry(self):
+        '''
+        Overload responses are retried, honouring Retry-After.
+        '''
+        self.server.responses = [(503, {'Retry-After': '0'}), (500, {})]
+        self.assertEqual(https.request(self.url, data={'a': 1})['StatusCode'], 0)
+
+    def test_give_up(self):
+        '''
+        Exhausted retries and client errors return None.
+        '''
+        self.server.responses = [(503, {})] * 3
+        self.assertIsNone(https.request(self.url, data={'a': 1}))
+        self.server.responses = [(404, {})]
+        self.assertIsNone(https.request(self.url, data={'a': 1}))
+        self.assertEqual(self.server.responses, [])
+        self.assertEqual(https.get_metrics()['/server/panda/test']['errors'], {'http_5xx': 3, 'http_4xx': 1})
+
+    def test_compression(self):
+        '''
+        Large bodies are compressed unless the server rejects them, responses are gunzipped and streamed.
+        '''
+        https._ctx.compress = True
+        data = {'xml': 'x' * 5000}
+        self.assertEqual(https.request(self.url, data=data, stream=True)['echo'], ['xml=' + 'x' * 5000] * 100)
+        self.assertEqual(https.request(self.url, data={'a': 1})['echo'][0], 'a=1')
+        self.server.reject_gzip = True
+        self.assertEqual(https.request(self.url, data=data)['StatusCode'], 0)
+        self.assertEqual(https.request(self.url, data=data)['StatusCode'], 0)
+        self.assertEqual(len(self.server.bodies), 5)
+        self.assertEqual(https._uncompressed, set(['127.0.0.1:%s' % self.server.server_port]))
+        self.assertEqual(https.request(self.url, data=data, plain=True)[:1], '{')
+
+    def test_histogram(self):
+        '''
+        Histogram buckets, quantiles and snapshots.
+        '''
+        histogram = metrics.Histogram((1, 10, 100))
+        for value in (0.5, 1, 5, 50, 500):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1, 1])
+        self.assertEqual(histogram.quantile(0.5), 10)
+        self.assertEqual(histogram.quantile(1), float('inf'))
+        self.assertEqual(histogram.snapshot()['buckets'], [(1, 2), (10, 3), (100, 4), ('+Inf', 5)])
+        self.assertIsNone(metrics.Histogram().quantile(0.5))
+
+    def test_backoff(self):
+        '''
+        Backoff delays are jittered below the capped exponential delay.
+        '''
+        policy = https.RetryPolicy(attempts=10, base=1, cap=30)
+        for attempt in xrange(10):
+            delay = https.backoff(policy, attempt)
+            self.assertTrue(0 <= delay <= min(30, 2 ** attempt))
+
+        # the getJob policy, 3 attempts from 5s
+        url = 'https://pandaserver.cern.ch:25443/server/panda/getJob'
+        self.assertTrue(0 <= https.next_attempt(url, attempt=0) <= 5)
+        self.assertTrue(0 <= https.next_attempt(url, attempt=2) <= 20)
+        self.assertTrue(0 <= https.next_attempt(url, attempt=10) <= 300)
+
+    def test_retry_after(self):
+        '''
+        Retry-After is accepted in seconds and as HTTP date.
+        '''
+        self.assertEqual(https.retry_after('120'), 120)
+        self.assertEqual(https.retry_after('Thu, 01 Jan 1970 00:01:40 GMT', now=40), 60)
+        self.assertIsNone(https.retry_after(None))
+        self.assertIsNone(https.retry_after('soon'))
+
+    def test_circuit_breaker(self):
+        '''
+        The breaker opens after consecutive failures and lets a single trial through after the cooldown.
+        '''
+        breaker = https.CircuitBreaker(threshold=2, cooldown=10)
+        self.assertTrue(breaker.allow(now=0))
+        breaker.failure(now=0)
+        self.assertTrue(breaker.allow(now=0))
+        breaker.failure(now=0)
+        self.assertFalse(breaker.allow(now=5))
+        self.assertEqual(breaker.remaining(now=5), 5)
+        self.assertTrue(breaker.allow(now=10))
+        self.assertFalse(breaker.allow(now=10))
+        breaker.success()
+        self.assertTrue(breaker.allow(now=10))
+        breaker.failure(now=20, retry_after=100)
+        self.assertFalse(breaker.allow(now=50))
+
+    def test_trial_raises(self):
+        '''
+        A half-open trial request which raises counts as a failure, and lets the next trial through.
+        '''
+        breaker = https.circuit_breaker(self.url)
+        breaker.threshold, breaker.cooldown = 1, 0
+        breaker.failure()
+
+        send = https._send
+
+        def undecodable(*args):
+            raise ValueError('No JSON object could be decoded')
+
+        https._send = undecodable
+        try:
+            self.assertRaises(ValueError, https.request, self.url, data={'a': 1})
+        finally:
+            https._send = send
+        self.assertFalse(breaker.trial)
+        self.assertEqual(https.request(self.url, data={'a': 1})['StatusCode'], 0)
+        self.assertFalse(breaker.tripped())
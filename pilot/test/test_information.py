@@ -0,0 +1,145 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from pilot.benchmark.mockserver import MockServer
+from pilot.util import information, timing
+
+
+class TestInformation(unittest.TestCase):
+    '''
+    Location resolution and AGIS caching against the local mock server.
+    '''
+
+    def setUp(self):
+        self.server = MockServer(filler=50).start()
+        self.cache_dir = tempfile.mkdtemp()
+        self.args = argparse.Namespace(queue='MOCK_QUEUE',
+                                       info_url=self.server.info_url,
+                                       cache_dir=self.cache_dir,
+                                       cache_ttl=3600)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_set_location(self):
+        '''
+        The queue is resolved to its site and active storages.
+        '''
+        self.assertTrue(information.set_location(self.args))
+        self.assertEqual(self.args.location.queue, 'MOCK_QUEUE')
+        self.assertEqual(self.args.location.site, 'MOCK_SITE')
+        self.assertEqual(sorted(self.args.location.storages), ['MOCK_DATADISK', 'MOCK_SCRATCHDISK'])
+
+        self.args.queue = 'NO_SUCH_QUEUE'
+        self.assertFalse(information.set_location(self.args))
+
+    def test_background(self):
+        '''
+        The documents are fetched concurrently, once each, and the storages resolved in the background.
+        '''
+        self.server.latency = 0.2
+        self.args.graceful_stop = threading.Event()
+        timer = timing.PhaseTimer(budget=30)
+        self.assertTrue(information.set_location(self.args, background=True, timer=timer))
+        self.assertEqual(self.args.location.site, 'MOCK_SITE')
+        self.assertTrue(information.wait_storages(self.args))
+        self.assertEqual(sorted(self.args.location.storages), ['MOCK_DATADISK', 'MOCK_SCRATCHDISK'])
+        self.assertEqual(self.server.counters['agis'], 3)
+        self.assertEqual(sorted(timer.summary()['phases']), ['location', 'storages'])
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, information.snapshot_name(self.args))))
+
+    def test_untrusted(self):
+        '''
+        A cache directory others can write to is not used, the documents are fetched every time.
+        '''
+        os.chmod(self.cache_dir, 0o777)
+        self.assertTrue(information.set_location(self.args))
+        self.assertEqual(self.args.location.site, 'MOCK_SITE')
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        requests = self.server.counters['agis']
+        self.assertTrue(information.set_location(self.args))
+        self.assertEqual(self.server.counters['agis'], 2 * requests)
+
+        # created for the user only
+        cache_dir = os.path.join(self.cache_dir, 'new')
+        os.chmod(self.cache_dir, 0o700)
+        self.args.cache_dir = cache_dir
+        self.assertTrue(information.set_location(self.args))
+        self.assertEqual(os.stat(cache_dir).st_mode & 0o777, 0o700)
+        self.assertTrue(os.path.exists(os.path.join(cache_dir, information.snapshot_name(self.args))))
+
+    def test_snapshot(self):
+        '''
+        Later startups use the compact location snapshot without touching AGIS.
+        '''
+        self.assertTrue(information.set_location(self.args))
+        requests = self.server.counters['agis']
+        self.assertTrue(information.set_location(self.args))
+        self.assertEqual(self.server.counters['agis'], requests)
+        self.assertEqual(self.args.location.site, 'MOCK_SITE')
+        self.assertEqual(set(self.args.location.storages_info['MOCK_DATADISK']), set(['name', 'site', 'state', 'type', 'rse']))
+        self.assertLess(os.path.getsize(os.path.join(self.cache_dir, information.snapshot_name(self.args))), 4096)
+
+        # another information system does not share the snapshot
+        other = argparse.Namespace(**vars(self.args))
+        other.info_url = 'https://atlas-agis-api.cern.ch'
+        self.assertNotEqual(information.snapshot_name(other), information.snapshot_name(self.args))
+
+    def test_cache(self):
+        '''
+        Fresh entries are served from the cache, expired entries are revalidated.
+        '''
+        url = '%s/request/pandaqueue/query/list/?json' % self.server.info_url
+        first = information.retrieve_json(url, self.cache_dir, 3600)
+        self.assertEqual(information.retrieve_json(url, self.cache_dir, 3600), first)
+        self.assertEqual(self.server.counters['agis'], 1)
+
+        self.assertEqual(information.retrieve_json(url, self.cache_dir, 0), first)
+        self.assertEqual(self.server.counters['agis'], 2)
+        self.assertEqual(self.server.counters['not_modified'], 1)
+        self.assertEqual([f for f in os.listdir(self.cache_dir) if f.startswith('.tmp')], [])
+
+    def test_predicate(self):
+        '''
+        Streaming parse keeps only the matching entries.
+        '''
+        url = '%s/request/ddmendpoint/query/list/?json' % self.server.info_url
+        result = information.retrieve_json(url, self.cache_dir, 3600, predicate=lambda storage: storage['site'] == 'MOCK_SITE')
+        self.assertEqual(sorted(storage['name'] for storage in result), ['MOCK_DATADISK', 'MOCK_SCRATCHDISK'])
+        self.assertEqual(len(information.retrieve_json(url, self.cache_dir, 3600)), 52)
+
+    def test_concurrent_refresh(self):
+        '''
+        Pilots starting together fetch a document once.
+        '''
+        url = '%s/request/site/query/list/?json' % self.server.info_url
+        self.server.latency = 0.1
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(information.retrieve_json(url, self.cache_dir, 3600)))
+                   for i in xrange(10)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(len(results), 10)
+        self.assertEqual(self.server.counters['agis'], 1)
+
+    def test_stale(self):
+        '''
+        A stale copy is used if the server is unavailable.
+        '''
+        url = '%s/request/ddmendpoint/query/list/?json' % self.server.info_url
+        first = information.retrieve_json(url, self.cache_dir, 0)
+        self.server.failure_rate = 1
+        self.assertEqual(information.retrieve_json(url, self.cache_dir, 0), first)
@@ -0,0 +1,69 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import json
+import StringIO
+import unittest
+import zlib
+
+from pilot.util import jsonstream
+
+
+def _split(text, size):
+    return [text[i:i + size] for i in xrange(0, len(text), size)]
+
+
+class TestJSONStream(unittest.TestCase):
+    '''
+    Incremental decoding of JSON documents.
+    '''
+
+    def setUp(self):
+        self.doc = [{'name': 'QUEUE_%s' % i, 'state': 'ACTIVE' if i % 3 else 'OFFLINE', 'nr': i * 1000003, 'x': [1.5, None, True]}
+                    for i in xrange(200)] + [12345, 'tail']
+        self.text = json.dumps(self.doc, indent=1)
+
+    def test_chunk_boundaries(self):
+        '''
+        Elements split at any position across chunks decode identically.
+        '''
+        for size in (1, 2, 7, 64, 1000, len(self.text)):
+            self.assertEqual(list(jsonstream.iterload(_split(self.text, size))), self.doc)
+
+    def test_predicate(self):
+        '''
+        Only elements matching the predicate are kept.
+        '''
+        result = list(jsonstream.iterload(_split(self.text, 100),
+                                          predicate=lambda e: isinstance(e, dict) and e['state'] == 'OFFLINE'))
+        self.assertEqual(len(result), 67)
+        self.assertTrue(all(e['state'] == 'OFFLINE' for e in result))
+
+    def test_load(self):
+        '''
+        Arrays and objects, empty or not, are decoded.
+        '''
+        self.assertEqual(jsonstream.load(_split(self.text, 10)), self.doc)
+        self.assertEqual(jsonstream.load(['  [ ', ' ]']), [])
+        self.assertEqual(jsonstream.load(['{"StatusCode"', ': 0}']), {'StatusCode': 0})
+
+    def test_malformed(self):
+        '''
+        Truncated documents raise ValueError.
+        '''
+        self.assertRaises(ValueError, list, jsonstream.iterload(_split(self.text[:-50], 10)))
+        self.assertRaises(ValueError, list, jsonstream.iterload(['{"a": 1}']))
+
+    def test_gzip(self):
+        '''
+        Gzip-encoded streams are decompressed on the fly.
+        '''
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress(self.text) + compressor.flush()
+        chunks = jsonstream.iter_chunks(StringIO.StringIO(body), gzip=True, size=16)
+        self.assertEqual(list(jsonstream.iterload(chunks)), self.doc)
@@ -0,0 +1,147 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import argparse
+import threading
+import time
+import unittest
+
+from pilot.benchmark.mockserver import MockServer
+from pilot.control.job import RELEASED, retrieve
+from pilot.util import https
+from pilot.util.clock import Clock
+from pilot.util.lifetime import Lifetime, monotonic, DEFAULT_STAGEOUT
+from pilot.util.registry import JobRegistry, STATES
+from pilot.util.shutdown import Shutdown
+from pilot.util.timing import PhaseTimer
+
+MB = 1024 * 1024
+
+
+class TestLifetime(unittest.TestCase):
+    '''
+    Lifetime deadline, job duration estimates and admission.
+    '''
+
+    def test_monotonic(self):
+        '''
+        The monotonic clock advances with the time.
+        '''
+        start = monotonic()
+        time.sleep(0.1)
+        self.assertTrue(0.09 < monotonic() - start < 1)
+
+    def test_estimates(self):
+        '''
+        Estimates start from the job description and follow the measured durations.
+        '''
+        now = [0]
+        lifetime = Lifetime(400, grace=60, clock=lambda: now[0])
+        job = {'PandaID': 2, 'fsize': '%s,%s' % (100 * MB, 100 * MB), 'maxWalltime': 1000}
+        self.assertEqual(lifetime.estimates.estimate(job), {'stagein': 20, 'payload': 1000, 'stageout': DEFAULT_STAGEOUT})
+        self.assertEqual(lifetime.admit(job), (False, 1080))
+        self.assertFalse(lifetime.exhausted())
+
+        # 100MB staged in in 10s, 30s of a 100s walltime used, 5s stage-out
+        times = {'retrieved': 0, 'validated': 0, 'staged_in': 10, 'prepared': 10, 'running': 20, 'executed': 50, 'staging_out': 50, 'finished': 55}
+        previous = None
+        for state in STATES[:-1]:
+            lifetime.estimates.observe({'PandaID': 1, 'fsize': str(100 * MB), 'maxWalltime': 100}, previous, state, times[state])
+            previous = state
+
+        self.assertEqual(lifetime.estimates.estimate(job), {'stagein': 20, 'payload': 300, 'stageout': 5})
+        self.assertEqual(lifetime.admit(job), (True, 325))
+        now[0] = 20
+        self.assertEqual(lifetime.admit(job), (False, 325))
+        self.assertEqual(lifetime.remaining(), 320)
+
+        # the shortest job took 55s
+        now[0] = 280
+        self.assertFalse(lifetime.exhausted())
+        now[0] = 290
+        self.assertTrue(lifetime.exhausted())
+        now[0] = 1000
+        self.assertEqual(lifetime.remaining(), 0)
+
+    def test_exhausted(self):
+        '''
+        Before any job was measured, even a short lifetime is not exhausted, only its end is.
+        '''
+        now = [0]
+        lifetime = Lifetime(10, grace=5, clock=lambda: now[0])
+        self.assertFalse(lifetime.exhausted())
+        now[0] = 10
+        self.assertEqual(lifetime.remaining(), 0)
+        self.assertFalse(lifetime.exhausted())
+
+    def test_walltime(self):
+        '''
+        Without a walltime limit, the CPU time limit is spread over the cores.
+        '''
+        lifetime = Lifetime(100)
+        self.assertEqual(lifetime.estimates.estimate({'maxCpuCount': 800, 'coreCount': 8})['payload'], 100)
+        self.assertEqual(lifetime.estimates.estimate({'maxWalltime': 0, 'maxCpuCount': 800})['payload'], 800)
+
+
+class TestRetrieve(unittest.TestCase):
+    '''
+    Jobs fetched from the server within the lifetime of the pilot.
+    '''
+
+    def setUp(self):
+        self.server = MockServer(jobs=1).start()
+        https._ctx.ssl_context = True
+        https._ctx.user_agent = 'pilot/test'
+        https._ctx.pool = https.ConnectionPool(maxsize=2)
+        https._breakers.clear()
+
+    def tearDown(self):
+        https._ctx.pool.close()
+        https._ctx.ssl_context = None
+        self.server.stop()
+
+    def _args(self, lifetime):
+        # set up as by the generic workflow, with the defaults of the command line but for the lifetime
+        clock = Clock()
+        grace = min(60, lifetime / 2.0)
+        lifetime_manager = Lifetime(lifetime, grace=grace, clock=clock.monotonic)
+        return argparse.Namespace(url=self.server.url,
+                                  port=self.server.port,
+                                  location=argparse.Namespace(queue='MOCK_QUEUE'),
+                                  job_label='mtest',
+                                  clock=clock,
+                                  timer=PhaseTimer(),
+                                  lifetime_manager=lifetime_manager,
+                                  shutdown=Shutdown(threading.Event(), grace=grace, end=lifetime_manager.end, clock=clock.monotonic))
+
+    def test_default_lifetime(self):
+        '''
+        With the default lifetime of 10s a job is still asked for, and given back as closed since it cannot finish in time.
+        The server does not count a closed job as a failed attempt, and gives its work to another pilot.
+        '''
+        registry = JobRegistry()
+        retrieve(registry, None, self._args(10))
+        self.assertEqual(self.server.counters['getJob'], 1)
+        self.assertEqual(self.server.states.values(), [[RELEASED]])
+        self.assertEqual(RELEASED, 'closed')
+        self.assertEqual(registry.counts()['retrieved'], 0)
+
+    def test_admitted(self):
+        '''
+        A job which fits into the time left is registered, and nothing is sent for it yet.
+        '''
+        args = self._args(7200)
+        registry = JobRegistry()
+        thread = threading.Thread(target=retrieve, args=(registry, None, args))
+        thread.daemon = True
+        thread.start()
+        self.assertEqual(registry.next('retrieved', timeout=5)['StatusCode'], 0)
+        args.shutdown.stopping('fetch').set()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.server.states, {})
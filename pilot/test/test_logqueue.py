@@ -0,0 +1,106 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import json
+import logging
+import Queue
+import unittest
+
+from pilot.util import logqueue
+
+
+class _ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+class TestLogQueue(unittest.TestCase):
+    '''
+    Queued logging, JSON formatting and rate limiting.
+    '''
+
+    def setUp(self):
+        self.logger = logging.getLogger('pilot.test.logqueue')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.target = _ListHandler()
+
+    def tearDown(self):
+        self.logger.handlers = []
+        logging.getLogger().removeHandler(self.target)
+
+    def _record(self, lineno=1, level=logging.INFO):
+        return self.logger.makeRecord(self.logger.name, level, 'test.py', lineno, 'message', None, None)
+
+    def test_writer(self):
+        '''
+        Records are formatted in the calling thread and written by the writer thread; a full queue drops records.
+        '''
+        queue = Queue.Queue(2)
+        handler = logqueue.QueueHandler(queue)
+        self.logger.addHandler(handler)
+        for i in xrange(3):
+            self.logger.info('message %s', i)
+        self.assertEqual(handler.dropped, 1)
+
+        self.target.setFormatter(logqueue.JSONFormatter())
+        writer = logqueue.LogWriter(queue, [self.target], source=handler)
+        writer.start()
+        writer.stop()
+        messages = [json.loads(line)['message'] for line in self.target.lines]
+        self.assertEqual(messages, ['log queue full -- dropped 1 messages', 'message 0', 'message 1'])
+
+    def test_stop(self):
+        '''
+        Records queued until the stop are written before the handlers are attached directly, each exactly once.
+        '''
+        root = logging.getLogger()
+        queue = Queue.Queue()
+        handler = logqueue.QueueHandler(queue)
+        root.addHandler(handler)
+        self.logger.propagate = True
+        writer = logqueue.LogWriter(queue, [self.target], source=handler)
+        writer.start()
+        try:
+            self.logger.info('queued')
+            writer.stop()
+            self.logger.info('direct')
+        finally:
+            root.removeHandler(handler)
+        self.assertNotIn(handler, root.handlers)
+        self.assertEqual(self.target.lines, ['queued', 'direct'])
+
+    def test_json(self):
+        '''
+        Messages of job loggers carry the PandaID.
+        '''
+        formatter = logqueue.JSONFormatter()
+        record = self.logger.makeRecord('pilot.control.job.4242', logging.INFO, 'job.py', 1, 'got %s', ('job',), None)
+        entry = json.loads(formatter.format(record))
+        self.assertEqual(entry['PandaID'], 4242)
+        self.assertEqual(entry['message'], 'got job')
+        self.assertNotIn('PandaID', json.loads(formatter.format(self._record())))
+
+    def test_rate_limit(self):
+        '''
+        Each call site is limited separately, suppressed messages are counted, errors always pass.
+        '''
+        now = [0]
+        limit = logqueue.RateLimitFilter(burst=2, interval=60, clock=lambda: now[0])
+        self.assertEqual([limit.filter(self._record()) for i in xrange(5)], [True, True, False, False, False])
+        self.assertTrue(limit.filter(self._record(lineno=2)))
+        self.assertTrue(limit.filter(self._record(level=logging.ERROR)))
+        now[0] = 60
+        record = self._record()
+        self.assertTrue(limit.filter(record))
+        self.assertEqual(record.getMessage(), 'message (3 similar messages suppressed)')
@@ -0,0 +1,51 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import argparse
+import threading
+import unittest
+
+from pilot.benchmark import micro
+from pilot.util import https
+
+
+class TestMicro(unittest.TestCase):
+    '''
+    Microbenchmark suite of the pilot hot paths and the comparison of its reports.
+    '''
+
+    def test_run(self):
+        '''
+        Every benchmark runs offline and reports the statistics of its calls.
+        '''
+        args = argparse.Namespace(only=[], repeat=2, log_files=5, log_file_size=1024, filler=10, requests=3, handoffs=2, outputs=10,
+                                  http_connections=2, http_compress=False, cacert=None, capath=None, graceful_stop=threading.Event())
+        try:
+            report = micro.run(args)
+            args.only = ['pfc']
+            self.assertEqual(micro.run(args)['benchmarks'].keys(), ['pfc'])
+        finally:
+            https._ctx.pool.close()
+            https._ctx.ssl_context = None
+
+        self.assertEqual(sorted(report['benchmarks']),
+                         ['handoff', 'pfc', 'prepare_log', 'request', 'set_location.cold', 'set_location.warm'])
+        self.assertEqual(report['benchmarks']['request']['n'], 3)
+        # seven handoffs from retrieved to finished per job
+        self.assertEqual(report['benchmarks']['handoff']['n'], 14)
+        self.assertEqual(report['parameters']['outputs'], 10)
+
+    def test_compare(self):
+        '''
+        Medians changing by more than the threshold are regressions or improvements.
+        '''
+        baseline = {'benchmarks': {'a': {'p50': 1.0}, 'b': {'p50': 1.0}, 'c': {'p50': 1.0}, 'd': {'p50': 0}, 'old': {'p50': 1.0}}}
+        report = {'benchmarks': {'a': {'p50': 1.05}, 'b': {'p50': 1.5}, 'c': {'p50': 0.5}, 'd': {'p50': 1.0}, 'new': {'p50': 1.0}}}
+        self.assertEqual([(name, verdict) for name, before, after, ratio, verdict in micro.compare(report, baseline)],
+                         [('a', 'unchanged'), ('b', 'regression'), ('c', 'improvement'), ('d', 'unknown')])
+        self.assertEqual(micro.compare(report, baseline, threshold=0.6)[1][4], 'unchanged')
@@ -0,0 +1,77 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import argparse
+import unittest
+
+from pilot.benchmark.mockserver import MockServer
+from pilot.control.job import server_url
+from pilot.util import https
+
+
+class TestMockServer(unittest.TestCase):
+    '''
+    Server endpoints given on the command line, and the local stand-in for PanDA and AGIS.
+    '''
+
+    def setUp(self):
+        self.server = MockServer(jobs=2, filler=3).start()
+        self.args = argparse.Namespace(url=self.server.url, port=self.server.port, info_url=self.server.info_url)
+        https._ctx.ssl_context = True
+        https._ctx.user_agent = 'pilot/test'
+        https._ctx.pool = https.ConnectionPool(maxsize=2)
+        https._breakers.clear()
+
+    def tearDown(self):
+        https._ctx.pool.close()
+        https._ctx.ssl_context = None
+        self.server.stop()
+
+    def test_endpoints(self):
+        '''
+        PanDA commands go to the server and port given, AGIS documents to the information system URL.
+        '''
+        args = argparse.Namespace(url='https://pandaserver.cern.ch', port=25443, info_url='http://atlas-agis-api.cern.ch')
+        self.assertEqual(server_url(args, 'getJob'), 'https://pandaserver.cern.ch:25443/server/panda/getJob')
+        self.assertEqual(server_url(self.args, 'updateJob'), 'http://127.0.0.1:%s/server/panda/updateJob' % self.server.port)
+
+    def test_jobs(self):
+        '''
+        The given number of jobs is handed out, and their state updates recorded.
+        '''
+        jobs = [https.request(server_url(self.args, 'getJob'), data={'siteName': 'MOCK_QUEUE'}) for i in xrange(3)]
+        self.assertEqual([job['StatusCode'] for job in jobs], [0, 0, 20])
+        self.assertEqual(jobs[1]['PandaID'], jobs[0]['PandaID'] + 1)
+
+        for state in ('starting', 'finished'):
+            self.assertEqual(https.request(server_url(self.args, 'updateJob'), data={'jobId': jobs[0]['PandaID'], 'state': state})['StatusCode'], 0)
+        self.assertEqual(self.server.states, {str(jobs[0]['PandaID']): ['starting', 'finished']})
+        self.assertEqual(self.server.counters['getJob'], 3)
+
+    def test_agis(self):
+        '''
+        The AGIS documents hold the mock queue and the filler entries.
+        '''
+        queues = https.request('%s/request/pandaqueue/query/list/?json' % self.args.info_url)
+        self.assertEqual([queue['name'] for queue in queues], ['MOCK_QUEUE', 'FILLER_QUEUE_0', 'FILLER_QUEUE_1', 'FILLER_QUEUE_2'])
+        storages = https.request('%s/request/ddmendpoint/query/list/?json' % self.args.info_url)
+        self.assertEqual([storage['rse'] for storage in storages if storage['site'] == 'MOCK_SITE'], ['MOCK_DATADISK', 'MOCK_SCRATCHDISK'])
+
+    def test_failures(self):
+        '''
+        Injected failures are answered with 503 and the Retry-After hint given.
+        '''
+        self.server.failure_rate = 1
+        self.server.retry_after = 0
+        https.set_retry_policy('/server/panda/getJob', attempts=2, base=0.01, cap=0.01)
+        try:
+            self.assertIsNone(https.request(server_url(self.args, 'getJob'), data={'siteName': 'MOCK_QUEUE'}))
+        finally:
+            https.set_retry_policy('/server/panda/getJob', attempts=3, base=5, cap=300)
+        self.assertEqual(self.server.counters['failures'], 2)
+        self.assertEqual(self.server.counters['getJob'], 0)
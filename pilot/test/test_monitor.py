@@ -0,0 +1,105 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from collections import namedtuple
+
+from pilot.control import monitor
+from pilot.util.registry import JobRegistry
+
+
+class TestMonitor(unittest.TestCase):
+    '''
+    Export of the pilot state.
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.registry = JobRegistry()
+        self.registry.add({'PandaID': 1})
+        self.traces = namedtuple('traces', ['pilot', 'rucio'])
+        self.traces.pilot = {'nr_jobs': 1, 'bytes_in': 10, 'bytes_out': 20}
+        self.traces.rucio = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_prometheus(self):
+        '''
+        Jobs and threads are rendered, ended threads stay visible.
+        '''
+        seen = set(['retrieve'])
+        text = monitor.render_prometheus(monitor.collect(self.registry, self.traces, seen))
+        self.assertIn('pilot_jobs_waiting{state="retrieved"} 1\n', text)
+        self.assertIn('pilot_jobs_waiting{state="validated"} 0\n', text)
+        self.assertIn('pilot_jobs{state="retrieved"} 1\n', text)
+        self.assertIn('pilot_threads_alive{thread="retrieve"} 0\n', text)
+        self.assertIn('pilot_threads_alive{thread="MainThread"} 1\n', text)
+        self.assertIn('pilot_transfer_bytes_total{direction="out"} 20\n', text)
+
+    def test_control(self):
+        '''
+        The state file is replaced atomically and served on the socket until the pilot stops.
+        '''
+        args = argparse.Namespace(graceful_stop=threading.Event(),
+                                  metrics_file=os.path.join(self.tmp_dir, 'status.json'),
+                                  metrics_format='json',
+                                  metrics_interval=0.05,
+                                  metrics_socket=os.path.join(self.tmp_dir, 'status.sock'))
+        thread = threading.Thread(target=monitor.control, args=(self.registry, self.traces, args))
+        thread.start()
+        try:
+            args.graceful_stop.wait(0.2)
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(args.metrics_socket)
+            data = ''.join(iter(lambda: client.recv(4096), ''))
+            client.close()
+        finally:
+            args.graceful_stop.set()
+            thread.join()
+
+        self.assertEqual(json.loads(data)['jobs']['retrieved'], 1)
+        with open(args.metrics_file) as infile:
+            self.assertEqual(json.load(infile)['nr_jobs'], 1)
+        self.assertFalse(os.path.exists(args.metrics_socket))
+        self.assertEqual([f for f in os.listdir(self.tmp_dir) if f.startswith('.tmp')], [])
+        self.assertEqual(os.stat(args.metrics_file).st_mode & 0o777, 0o644)
+
+    def test_stuck_client(self):
+        '''
+        A client which connects and does not read is given up, the next one is served.
+        '''
+        path = os.path.join(self.tmp_dir, 'status.sock')
+        server = monitor._listen(path)
+        args = argparse.Namespace(graceful_stop=threading.Event())
+        # more than the socket buffers hold
+        latest = ['x' * 16 * 1024 * 1024]
+        thread = threading.Thread(target=monitor._serve, args=(server, latest, args))
+        thread.start()
+        try:
+            stuck = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            stuck.connect(path)
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(path)
+            client.settimeout(10)
+            size = sum(len(chunk) for chunk in iter(lambda: client.recv(1024 * 1024), ''))
+            client.close()
+            stuck.close()
+        finally:
+            args.graceful_stop.set()
+            thread.join()
+            server.close()
+        self.assertEqual(size, len(latest[0]))
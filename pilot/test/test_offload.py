@@ -0,0 +1,78 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import json
+import os
+import shutil
+import signal
+import tarfile
+import tempfile
+import time
+import unittest
+import zlib
+
+from pilot.control.data import _make_log_tarball
+from pilot.control.payload import read_job_report
+from pilot.util import offload
+from pilot.util.filehandling import adler32
+
+
+class TestOffload(unittest.TestCase):
+    '''
+    CPU-heavy data tasks in worker processes.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'payload.stdout'), 'wb') as f:
+            f.write('output\n' * 10000)
+        with open(os.path.join(self.directory, 'jobReport.json'), 'wb') as f:
+            json.dump({'files': {'output': []}, 'exitCode': 0, 'resource': {'samples': range(1000)}}, f)
+
+    def tearDown(self):
+        offload.stop()
+        shutil.rmtree(self.directory)
+
+    def _tasks(self):
+        path = os.path.join(self.directory, 'log.tgz')
+        summary = offload.call(_make_log_tarball, path, self.directory, ['payload.stdout'], 'tarball')
+        self.assertEqual(summary, {'bytes': os.path.getsize(path), 'adler32': '%08x' % (zlib.adler32(open(path, 'rb').read()) & 0xffffffff)})
+        self.assertEqual(tarfile.open(path).getnames(), ['tarball/payload.stdout'])
+
+        self.assertEqual(offload.call(read_job_report, os.path.join(self.directory, 'jobReport.json')), {'files': {'output': []}, 'exitCode': 0})
+        self.assertRaises(IOError, offload.call, read_job_report, os.path.join(self.directory, 'missing.json'))
+
+    def test_inline(self):
+        '''
+        Without workers the tasks run in the calling thread.
+        '''
+        self._tasks()
+        self.assertEqual(adler32(os.path.join(self.directory, 'payload.stdout'), blocksize=7), adler32(os.path.join(self.directory, 'payload.stdout')))
+
+    def test_workers(self):
+        '''
+        Workers return the same results, and their exceptions are raised in the caller.
+        '''
+        offload.setup(2)
+        self._tasks()
+
+    def test_signals(self):
+        '''
+        Workers outlive the signals sent to the pilot, and are still stopped at once.
+        '''
+        offload.setup(1)
+        pid = offload.call(os.getpid)
+        self.assertEqual(os.getpgid(pid), os.getpgrp())
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            os.kill(pid, signum)
+        self.assertEqual(offload.call(os.getpid), pid)
+
+        start = time.time()
+        offload.stop()
+        self.assertLess(time.time() - start, 5)
+        self.assertRaises(OSError, os.kill, pid, 0)
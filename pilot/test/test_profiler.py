@@ -0,0 +1,56 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from pilot.util import profiler
+
+
+def _busy(stop):
+    while not stop.is_set():
+        sum(xrange(1000))
+
+
+class TestProfiler(unittest.TestCase):
+    '''
+    Sampling profiler output.
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_collapsed_stacks(self):
+        '''
+        Stacks are counted per thread name and written when sampling is switched off.
+        '''
+        filename = os.path.join(self.tmp_dir, 'profile.txt')
+        stop = threading.Event()
+        busy = threading.Thread(target=_busy, name='busy', args=(stop,))
+        busy.start()
+
+        sampler = profiler.start(0.01, filename)
+        sampler.toggle()
+        stop.wait(0.3)
+        sampler.toggle()
+        sampler.stop()
+        stop.set()
+        busy.join()
+
+        with open(filename) as infile:
+            lines = [line.rsplit(' ', 1) for line in infile]
+        busy_samples = sum(int(count) for stack, count in lines if stack.startswith('busy;'))
+        self.assertGreater(busy_samples, 5)
+        self.assertTrue(any(stack.endswith('pilot.test.test_profiler._busy') for stack, count in lines))
+        self.assertFalse(any(stack.startswith('profiler;') for stack, count in lines))
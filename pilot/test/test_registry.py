@@ -0,0 +1,114 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import threading
+import unittest
+
+from pilot.util.registry import JobRegistry, TransitionError, STATES
+
+
+class TestRegistry(unittest.TestCase):
+    '''
+    Job states, transitions and retirement.
+    '''
+
+    def test_flow(self):
+        '''
+        A job walks through all states, handed from one waiting controller to the next, and is retired at the end.
+        '''
+        registry = JobRegistry()
+        transitions = []
+        registry.observe(lambda job, previous, state, now: transitions.append((previous, state)))
+
+        job = {'PandaID': 1}
+        registry.add(job)
+        self.assertIs(registry.get(1), job)
+        for previous, state in zip(STATES[:-2], STATES[1:-1]):
+            # running jobs are handed on by the controller which started them
+            if previous != 'running':
+                self.assertIs(registry.next(previous, timeout=1), job)
+            self.assertEqual(registry.state(1), previous)
+            registry.transition(job, state)
+
+        self.assertIsNone(registry.get(1))
+        self.assertEqual(registry.counts()['finished'], 1)
+        self.assertEqual(len(transitions), len(STATES) - 1)
+        self.assertEqual(sum(registry.backlog().values()), 0)
+        self.assertNotIn('running', registry.backlog())
+
+    def test_picked(self):
+        '''
+        The time a job is picked up is kept until it leaves its state.
+        '''
+        now = [10]
+        registry = JobRegistry(clock=lambda: now[0])
+        picked = []
+        registry.observe(lambda job, previous, state, when: picked.append(registry.picked(job['PandaID'])))
+        registry.add({'PandaID': 1})
+        self.assertIsNone(registry.picked(1))
+        now[0] = 15
+        job = registry.next('retrieved', timeout=1)
+        self.assertEqual(registry.picked(1), 15)
+        now[0] = 20
+        registry.transition(job, 'validated')
+        self.assertEqual(picked, [None, 15])
+        self.assertIsNone(registry.picked(1))
+
+    def test_illegal(self):
+        '''
+        Skipping states, unknown jobs and leaving terminal states are refused.
+        '''
+        registry = JobRegistry()
+        registry.add({'PandaID': 1})
+        self.assertRaises(TransitionError, registry.transition, {'PandaID': 1}, 'running')
+        self.assertRaises(TransitionError, registry.add, {'PandaID': 1})
+        self.assertRaises(TransitionError, registry.add, {'PandaID': 2}, 'finished')
+        registry.fail(registry.get(1), 'broken')
+        self.assertRaises(TransitionError, registry.transition, {'PandaID': 1}, 'failed')
+        self.assertEqual(registry.next('failed', timeout=1), {'PandaID': 1, 'errmsg': 'broken'})
+        self.assertEqual(registry.counts()['failed'], 1)
+
+    def test_close(self):
+        '''
+        Closing releases all controllers waiting for jobs.
+        '''
+        registry = JobRegistry()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(registry.next('validated'))) for i in xrange(3)]
+        [t.start() for t in threads]
+        registry.close()
+        [t.join(5) for t in threads]
+        self.assertEqual(results, [None] * 3)
+
+    def test_close_states(self):
+        '''
+        Closing some states returns the jobs waiting in them, and jobs moved into them later fail.
+        '''
+        registry = JobRegistry()
+        registry.add({'PandaID': 1})
+        registry.add({'PandaID': 2})
+        job = registry.next('retrieved', timeout=1)
+        self.assertEqual(registry.close(['retrieved', 'validated']), [{'PandaID': 2}])
+        self.assertIsNone(registry.next('retrieved', timeout=1))
+        self.assertFalse(registry.closed)
+
+        registry.transition(job, 'validated')
+        self.assertEqual(registry.next('failed', timeout=1), {'PandaID': 1, 'errmsg': 'abandoned at shutdown'})
+        self.assertEqual(registry.state(2), 'retrieved')
+
+    def test_close_race(self):
+        '''
+        A job entering a state while it is closed is failed, never left behind the end of the queue.
+        '''
+        registry = JobRegistry()
+        # closes the state between the registration of the job and its queueing
+        registry.observe(lambda job, previous, state, now: state == 'retrieved' and registry.close(['retrieved']))
+        registry.add({'PandaID': 1})
+        self.assertIsNone(registry.next('retrieved', timeout=1))
+        self.assertEqual(registry.backlog()['retrieved'], 0)
+        self.assertEqual(registry.next('failed', timeout=1), {'PandaID': 1, 'errmsg': 'abandoned at shutdown'})
@@ -0,0 +1,70 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import threading
+import time
+import unittest
+
+from pilot.util.registry import JobRegistry, STATES
+from pilot.util.shutdown import PHASES, Shutdown
+
+
+class TestShutdown(unittest.TestCase):
+    '''
+    Shutdown phases, their order and deadlines.
+    '''
+
+    def test_phases(self):
+        '''
+        Jobs not started fail, running jobs get until the payload deadline, stage-out until the stageout deadline.
+        '''
+        registry = JobRegistry()
+        # as in the pilot, running jobs are handled by the controller which started them, not taken from their queue
+        for panda_id, state in ((4, 'finished'), (3, 'staging_out'), (2, 'running'), (1, 'validated')):
+            registry.add({'PandaID': panda_id})
+            for previous, following in zip(STATES, STATES[1:STATES.index(state) + 1]):
+                registry.transition(registry.get(panda_id) if previous == 'running' else registry.next(previous, timeout=1), following)
+
+        shutdown = Shutdown(threading.Event(), grace=1, end=time.time() + 100)
+        shutdown.request('SIGTERM')
+        shutdown.request('lifetime')
+        begun = []
+
+        def payload():
+            begun.append(shutdown.stopping('payload').wait(5) and 'payload')
+            registry.transition(registry.get(2), 'executed')
+
+        def stageout():
+            begun.append(shutdown.stopping('exit').wait(5) and 'exit')
+
+        threads = [threading.Thread(target=payload), threading.Thread(target=stageout)]
+        [t.start() for t in threads]
+        report = shutdown.run(registry, threads)
+
+        self.assertEqual(report['reason'], 'SIGTERM')
+        self.assertEqual(begun, ['payload', 'exit'])
+        self.assertEqual(sorted(report['phases']), sorted(PHASES))
+        # the executed job and the one staging out never finished, the failed one waits to be reported
+        self.assertEqual(sorted((job['PandaID'], job['state']) for job in report['abandoned']), [(1, 'failed'), (2, 'executed'), (3, 'staging_out')])
+        self.assertEqual(report['threads'], [])
+        self.assertTrue(0.9 <= time.time() - shutdown.start < 2)
+        self.assertTrue(registry.closed)
+
+    def test_deadlines(self):
+        '''
+        The phases share the grace period, which is limited by the end of the batch slot.
+        '''
+        now = [1000]
+        shutdown = Shutdown(threading.Event(), grace=60, end=1030, clock=lambda: now[0])
+        self.assertEqual(shutdown.remaining('exit'), 60)
+        self.assertIsNone(shutdown.deadline('exit'))
+        shutdown.start, shutdown.available = 1000, 30
+        self.assertEqual([shutdown.deadline(phase) for phase in PHASES], [1000, 1009, 1027, 1030])
+        now[0] = 1010
+        self.assertEqual(shutdown.remaining('payload'), 0)
+        self.assertEqual(shutdown.remaining('stageout'), 17)
@@ -0,0 +1,143 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from pilot.benchmark import simulation
+from pilot.util.clock import Clock
+from pilot.util.filehandling import adler32
+
+
+class TestSimulation(unittest.TestCase):
+    '''
+    Accelerated clock, fake executables, replayed jobs and the simulation report.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage = os.path.join(self.directory, 'storage')
+        os.mkdir(self.storage)
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+        self.environ = dict(os.environ)
+        os.environ.update({'PILOT_SIMULATION_SPEED': '1000',
+                           'PILOT_SIMULATION_BANDWIDTH': str(1024 * 1024),
+                           'PILOT_SIMULATION_STORAGE': self.storage})
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_clock(self):
+        '''
+        An accelerated clock runs faster, and waits shorter, than the real time.
+        '''
+        clock = Clock(10)
+        start, real = clock.monotonic(), time.time()
+        self.assertFalse(clock.wait(threading.Event(), 1))
+        self.assertTrue(0.09 < time.time() - real < 0.5)
+        self.assertTrue(0.9 < clock.monotonic() - start < 5)
+        self.assertTrue(abs(Clock().time() - time.time()) < 0.1)
+
+    def test_copytool(self):
+        '''
+        The fake copytool downloads from and uploads to the storage with the nominal sizes.
+        '''
+        job = simulation.simulated(simulation.synthetic_job(1), simulation.PROFILE, self.storage)
+        self.assertEqual(job['fsize'], '1048576')
+        os.mkdir('job')
+        os.chdir('job')
+        self.assertEqual(simulation.rucio(['-v', 'download', '--no-subdir', '--rse', 'MOCK', '%s:%s' % (job['scopeIn'], job['inFiles'])]), 0)
+        self.assertEqual(os.stat(job['inFiles']).st_size, 1048576)
+        self.assertEqual(simulation.rucio(['-v', 'download', '--no-subdir', '--rse', 'MOCK', 'mock:missing']), 1)
+
+        with open('log.tgz', 'wb') as f:
+            f.write('log' * 1000)
+        self.assertEqual(simulation.rucio(['-v', 'upload', '--summary', '--no-register', '--guid', 'abc', '--rse', 'MOCK',
+                                           '--scope', 'mock', 'log.tgz']), 0)
+        with open('rucio_upload.json') as f:
+            summary = json.load(f)['mock:log.tgz']
+        self.assertEqual(summary['bytes'], 3000)
+        self.assertEqual(summary['adler32'], adler32('log.tgz'))
+        self.assertEqual(os.stat(os.path.join(self.storage, 'mock', 'log.tgz')).st_size, 3000)
+
+    def test_payload(self):
+        '''
+        The fake payload runs for the simulated time and reports its outputs and exit code.
+        '''
+        start = time.time()
+        self.assertEqual(simulation.payload(['--runtime', '200', '--cpu', '0.5', '--memory', '1', '--exit-code', '3',
+                                             '--outputs', 'HITS.1=100,HITS.2=200']), 3)
+        self.assertTrue(0.15 < time.time() - start < 1)
+        with open('jobReport.json') as f:
+            report = json.load(f)
+        self.assertEqual(report['exitCode'], 3)
+        self.assertEqual([(output['subFiles'][0]['name'], output['subFiles'][0]['file_size']) for output in report['files']['output']],
+                         [('HITS.1', 100), ('HITS.2', 200)])
+        self.assertEqual(os.stat('HITS.2').st_size, 200)
+
+    def test_replay(self):
+        '''
+        Traces are replayed in order, with new PandaIDs, the pilot fields dropped and their own profiles.
+        '''
+        with open('trace.json', 'w') as trace:
+            trace.write(json.dumps({'PandaID': 7, 'inFiles': 'EVNT.1,EVNT.2', 'fsize': '10,20', 'outFiles': 'AOD.1,log.1',
+                                    'logFile': 'log.1', 'simulation': {'runtime': 30}}) + '\n\n')
+            trace.write(json.dumps({'state': 'staging_out', 'job': {'PandaID': 8, 'working_dir': 'job-8', 'uploaded': {}}}) + '\n')
+        replay = simulation.Replay('trace.json', simulation.PROFILE, self.storage)
+
+        job = replay(100)
+        self.assertEqual(job['PandaID'], 100)
+        self.assertEqual(job['transformation'], simulation.PAYLOAD)
+        self.assertIn('--runtime 30 ', job['jobPars'])
+        self.assertTrue(job['jobPars'].endswith('--outputs AOD.1=%s' % simulation.PROFILE['output_size']))
+        self.assertEqual(os.stat(os.path.join(self.storage, job['scopeIn'], 'EVNT.2')).st_size, 20)
+
+        job = replay(101)
+        self.assertNotIn('working_dir', job)
+        self.assertNotIn('uploaded', job)
+        self.assertIn('--runtime %s ' % simulation.PROFILE['runtime'], job['jobPars'])
+        self.assertIsNone(replay(102))
+
+    def test_report(self):
+        '''
+        The report has the time spent in every state, the overhead around the payloads and the slot utilization.
+        '''
+        sim = simulation.Simulation(Clock(), 1024 * 1024)
+        sim.server.start()
+        now = sim.clock.time()
+        sim.start = now - 1000
+        for panda_id, transitions in ((1, [('retrieved', -1000), ('validated', -990), ('staged_in', -980), ('prepared', -980),
+                                           ('running', -970), ('executed', -370), ('staging_out', -370), ('finished', -350)]),
+                                      (2, [('retrieved', -300), ('failed', -299)]),
+                                      (3, [('retrieved', -120), ('validated', -120), ('staged_in', -110), ('prepared', -110),
+                                           ('running', -100)])):
+            previous = None
+            for state, seconds in transitions:
+                sim.observe({'PandaID': panda_id}, previous, state, now + seconds)
+                previous = state
+
+        report = sim.stop(os.path.join(self.directory, 'pilot_simulation.json'))
+        self.assertEqual(report['jobs'], {'finished': 1, 'failed': 1})
+        self.assertEqual(report['stages']['validated']['n'], 2)
+        self.assertAlmostEqual(report['stages']['validated']['mean'], 10)
+        self.assertAlmostEqual(report['stages']['running']['max'], 600)
+        self.assertAlmostEqual(report['overhead']['mean'], 50)
+        self.assertAlmostEqual(report['slot']['busy'], 700, delta=1)
+        self.assertAlmostEqual(report['slot']['utilization'], 0.7, delta=0.01)
+        self.assertFalse(os.path.exists(sim.directory))
+        with open(os.path.join(self.directory, 'pilot_simulation.json')) as f:
+            self.assertEqual(json.load(f)['jobs']['finished'], 1)
@@ -0,0 +1,120 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import __builtin__
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from pilot.util import timing
+from pilot.util.registry import JobRegistry, STATES
+
+
+class TestTiming(unittest.TestCase):
+    '''
+    Startup phase timing, import profiling and job timing.
+    '''
+
+    def test_phases(self):
+        '''
+        Phases are recorded with their duration, relative to the timer start.
+        '''
+        now = [100.0]
+        timer = timing.PhaseTimer(budget=5, clock=lambda: now[0])
+        with timer.phase('setup'):
+            now[0] += 2
+        now[0] += 4
+        timer.record('first_getJob', timer.start)
+        self.assertEqual(timer.summary(), {'phases': {'setup': 2, 'first_getJob': 6}, 'elapsed': 6, 'budget': 5})
+
+    def test_import_profiler(self):
+        '''
+        Newly loaded modules are recorded with their importer, and the builtin import is restored.
+        '''
+        original = __builtin__.__import__
+        sys.modules.pop('colorsys', None)
+        profiler = timing.ImportProfiler().install()
+        try:
+            import colorsys  # noqa: F401
+            import os  # noqa: F401
+        finally:
+            profiler.uninstall()
+        self.assertIs(__builtin__.__import__, original)
+        self.assertEqual(profiler.modules.keys(), ['colorsys'])
+        self.assertEqual(profiler.modules['colorsys']['importer'], __name__)
+        self.assertGreaterEqual(profiler.modules['colorsys']['inclusive'], profiler.modules['colorsys']['exclusive'])
+
+    def test_startup_imports(self):
+        '''
+        The import profiler and the workflows load no pilot modules before they are needed.
+        '''
+        def loaded(module):
+            return subprocess.check_output([sys.executable, '-c', 'import sys; import %s; print(" ".join(m for m in sys.modules '
+                                            'if m.startswith("pilot.") and sys.modules[m]))' % module]).split()
+
+        self.assertEqual(sorted(loaded('pilot.util.timing')), ['pilot.util', 'pilot.util.timing'])
+        self.assertEqual([module for module in loaded('pilot.workflow.generic') if module.startswith('pilot.control')], [])
+
+        # the pilot itself, as far as its options are parsed
+        script = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'pilot.py')
+        modules = subprocess.check_output([sys.executable, '-c', 'import sys; sys.argv = ["pilot.py", "--help"]\n'
+                                           'try:\n    execfile(%r, {"__name__": "__main__"})\nexcept SystemExit:\n    pass\n'
+                                           'sys.stderr.write(" ".join(m for m in sys.modules if sys.modules[m]))' % script],
+                                          stderr=subprocess.STDOUT).split()
+        for module in ('multiprocessing', 'pilot.util.offload', 'pilot.util.profiler', 'pilot.util.logqueue', 'pilot.util.information',
+                       'pilot.util.clock'):
+            self.assertNotIn(module, modules)
+
+    def test_job_timer(self):
+        '''
+        Phases and queue waits are recorded per job, and summarized over the jobs that ended.
+        '''
+        now = [100.0]
+        registry = JobRegistry(clock=lambda: now[0])
+        timer = timing.JobTimer(registry)
+        registry.observe(timer.observe)
+
+        job = {'PandaID': 1}
+        timing.record(job, 'fetch', 2)
+        registry.add(job)
+        for previous, state in zip(STATES[:-2], STATES[1:-1]):
+            now[0] += 1
+            if previous != 'running':
+                self.assertIs(registry.next(previous, timeout=1), job)
+            with timing.timed(job, 'payload' if previous == 'running' else 'setup', clock=lambda: now[0]):
+                now[0] += 10
+            registry.transition(job, state)
+
+        self.assertEqual(job['timing']['fetch'], 2)
+        self.assertEqual(job['timing']['wait.retrieved'], 1)
+        self.assertNotIn('wait.running', job['timing'])
+        self.assertEqual(job['timing']['payload'], 10)
+        self.assertEqual(job['timing']['total'], 2 + 7 * 11)
+        self.assertEqual(timing.pilot_timing(job['timing']), '2|0|10|0|60')
+
+        registry.add({'PandaID': 2})
+        now[0] += 5
+        registry.fail(registry.next('retrieved', timeout=1), 'broken')
+        timing.record(registry.next('failed', timeout=1), 'final_update', 3)
+
+        directory = tempfile.mkdtemp()
+        try:
+            summary = timer.dump(os.path.join(directory, 'pilot_timing.json'))
+            with open(os.path.join(directory, 'pilot_timing.json')) as f:
+                self.assertEqual(json.load(f)['breakdown']['2']['final_update'], 3)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(summary['jobs'], {'finished': 1, 'failed': 1})
+        self.assertEqual(summary['phases']['total']['n'], 2)
+        self.assertEqual(summary['phases']['wait.retrieved']['max'], 5)
+        self.assertEqual(summary['overhead']['max'], 2 + 7 * 11 - 10)
+        self.assertGreater(summary['cpu']['pilot'], 0)
@@ -0,0 +1,129 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+
+from pilot.control import data
+from pilot.util.clock import Clock
+
+
+class TestTransferMonitor(unittest.TestCase):
+    '''
+    Stall detection of running transfers from their byte progress.
+    '''
+
+    def setUp(self):
+        self.progress = [0]
+        self.monitor = data.TransferMonitor(rate=100, window=10, probe=lambda: self.progress[0])
+
+    def test_no_verdict_before_window(self):
+        '''
+        A transfer cannot be stalled before a full window has been observed.
+        '''
+        for now in xrange(10):
+            self.assertFalse(self.monitor.update(now=now))
+
+    def test_stalled(self):
+        '''
+        No progress for a full window marks the transfer as stalled.
+        '''
+        self.monitor.update(now=0)
+        self.progress[0] = 500
+        self.monitor.update(now=5)
+        self.assertTrue(self.monitor.update(now=10))
+        self.assertEqual(self.monitor.bytes, 500)
+        self.assertAlmostEqual(self.monitor.throughput, 50.0)
+
+    def test_progressing(self):
+        '''
+        Steady progress above the threshold keeps the transfer alive.
+        '''
+        for now in xrange(30):
+            self.progress[0] = now * 200
+            self.assertFalse(self.monitor.update(now=now))
+
+    def test_sliding_window(self):
+        '''
+        A fast start does not hide a later stall.
+        '''
+        self.monitor.update(now=0)
+        self.progress[0] = 100000
+        self.assertFalse(self.monitor.update(now=10))
+        for now in xrange(11, 20):
+            self.assertFalse(self.monitor.update(now=now))
+        self.assertTrue(self.monitor.update(now=20))
+
+    def test_disabled(self):
+        '''
+        A zero window disables stall detection.
+        '''
+        monitor = data.TransferMonitor(rate=100, window=0, probe=lambda: 0)
+        self.assertFalse(monitor.update(now=0))
+        self.assertFalse(monitor.update(now=1000))
+
+    def test_file_progress(self):
+        '''
+        Download progress includes partially written files.
+        '''
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmp_dir, 'a'), 'wb') as f:
+                f.write('x' * 10)
+            with open(os.path.join(tmp_dir, 'b.part'), 'wb') as f:
+                f.write('x' * 5)
+            self.assertEqual(data._file_progress(tmp_dir, ['a', 'b', 'c']), 15)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestPoolFileCatalog(unittest.TestCase):
+    '''
+    PoolFileCatalog of the uploaded files, sent with the final job state.
+    '''
+
+    def test_build_pfc(self):
+        '''
+        Every file has its entry with location, size and checksum.
+        '''
+        pfc = data.build_pfc([{'guid': 'guid-%s' % i, 'name': 'HITS.%s' % i, 'pfn': 'mock://HITS.%s' % i, 'bytes': i, 'adler32': '%08x' % i}
+                              for i in xrange(3)])
+        self.assertTrue(pfc.startswith('<?xml'))
+        self.assertTrue(pfc.endswith('</POOLFILECATALOG>'))
+        self.assertEqual(pfc.count('<File ID='), 3)
+        self.assertIn('<lfn name="HITS.2"/>', pfc)
+        self.assertIn('<metadata att_name="surl" att_value="mock://HITS.2"/>', pfc)
+        self.assertIn('<metadata att_name="adler32" att_value="00000002"/>', pfc)
+        self.assertEqual(data.build_pfc([]).count('<File'), 0)
+
+
+class TestStageOut(unittest.TestCase):
+    '''
+    Checks of the files uploaded at the end of a job.
+    '''
+
+    def setUp(self):
+        self.prepare_log, self.stage_out = data.prepare_log, data._stage_out_monitored
+        data.prepare_log = lambda job, tarball_name: {'scope': job['scopeLog'], 'name': job['logFile'], 'guid': 'guid-log', 'bytes': 1, 'adler32': '00000001'}
+
+    def tearDown(self):
+        data.prepare_log, data._stage_out_monitored = self.prepare_log, self.stage_out
+
+    def test_checksum(self):
+        '''
+        A file whose checksum changed in the upload fails the stage-out, and is not recorded as uploaded.
+        '''
+        data._stage_out_monitored = lambda args, outfile, job, traces: {'%s:%s' % (outfile['scope'], outfile['name']): {'pfn': 'mock://' + outfile['name'],
+                                                                                                                        'adler32': '00000002'}}
+        job = {'PandaID': 1, 'scopeLog': 'user.pilot', 'logFile': 'log.tgz', 'scopeOut': 'user.pilot', 'job_report': {'files': {'output': []}}}
+        args = argparse.Namespace(clock=Clock(), queue='MOCK_QUEUE')
+        self.assertFalse(data._stage_out_all(job, args, None))
+        self.assertEqual(job['uploaded'], {})
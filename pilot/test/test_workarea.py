@@ -0,0 +1,164 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pilot.util import workarea
+from pilot.util.workarea import WorkArea
+
+
+class TestWorkArea(unittest.TestCase):
+    '''
+    Placement of the job working directories on scratch, and their cleanup.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pilot = os.path.join(self.directory, 'pilot')
+        self.scratch = os.path.join(self.directory, 'scratch')
+        os.mkdir(self.pilot)
+        os.mkdir(self.scratch)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _workarea(self, **kwargs):
+        kwargs.setdefault('headroom', 0)
+        return WorkArea([self.scratch], failed_dir=os.path.join(self.pilot, 'failed_jobs'), directory=self.pilot, **kwargs)
+
+    def _write(self, job, name, nbytes):
+        with open(os.path.join(self.pilot, job['working_dir'], name), 'wb') as f:
+            f.write('x' * nbytes)
+
+    def test_classify(self):
+        '''
+        Filesystems are ranked by the most specific mount point, network filesystems are never scratch.
+        '''
+        mounts = [['/dev/mapper/root', '/', 'xfs'],
+                  ['tmpfs', '/dev/shm', 'tmpfs'],
+                  ['server:/export', '/data', 'nfs4'],
+                  ['/dev/mapper/local', '/data/local', 'ext4'],
+                  ['/dev/fuse', '/eos', 'fuse.eosxd']]
+        self.assertEqual(workarea.classify('/dev/shm/pilot', mounts), workarea.TMPFS)
+        self.assertIsNone(workarea.classify('/data/pilot', mounts))
+        self.assertIsNone(workarea.classify('/eos/atlas', mounts))
+        self.assertEqual(workarea.classify('/data/local/pilot', mounts), workarea.DISK)
+        self.assertIsNone(workarea.classify('/data/localdisk', mounts))
+
+    def test_place(self):
+        '''
+        Jobs go to scratch behind a symlink while they fit, and to the pilot directory otherwise.
+        '''
+        area = self._workarea()
+        try:
+            job = {'PandaID': 1, 'fsize': '1000,2000'}
+            self.assertEqual(area.need(job), 6000)
+            self.assertEqual(area.place(job), 'job-1')
+            link = os.path.join(self.pilot, 'job-1')
+            self.assertTrue(os.path.islink(link))
+            self.assertTrue(os.path.realpath(link).startswith(os.path.realpath(self.scratch)))
+
+            # more than the free space of the scratch
+            job = {'PandaID': 2, 'fsize': str(10 ** 18)}
+            self.assertEqual(area.place(job), 'job-2')
+            self.assertFalse(os.path.islink(os.path.join(self.pilot, 'job-2')))
+            self.assertTrue(os.path.isdir(os.path.join(self.pilot, 'job-2')))
+        finally:
+            area.stop()
+
+    def test_clean_up(self):
+        '''
+        Finished jobs are removed, failed ones kept without their inputs and outputs and the oldest dropped beyond the size limit.
+        '''
+        area = self._workarea(failed_size=1500)
+        jobs = [{'PandaID': panda_id, 'inFiles': 'EVNT.1', 'outFiles': 'HITS.1,log.tgz'} for panda_id in xrange(3)]
+        for job in jobs:
+            job['working_dir'] = area.place(job)
+            self._write(job, 'EVNT.1', 10000)
+            self._write(job, 'HITS.1', 10000)
+            self._write(job, 'payload.stdout', 1000)
+        scratch = os.path.realpath(os.path.join(self.pilot, 'job-0'))
+
+        area.observe(dict(jobs[0], reported=False), 'staging_out', 'finished', 0)
+        area.observe(dict(jobs[0], reported=True), 'staging_out', 'finished', 0)
+        area.clean_up(jobs[1], keep=True)
+        area.clean_up(jobs[2], keep=True)
+        area.stop()
+
+        self.assertFalse(os.path.lexists(os.path.join(self.pilot, 'job-0')))
+        self.assertFalse(os.path.exists(scratch))
+        self.assertEqual(os.listdir(self.scratch), [])
+        self.assertEqual(sorted(os.listdir(self.pilot)), ['failed_jobs'])
+        # the first failed job was dropped for the second one
+        self.assertEqual(os.listdir(os.path.join(self.pilot, 'failed_jobs')), ['job-2'])
+        self.assertEqual(os.listdir(os.path.join(self.pilot, 'failed_jobs', 'job-2')), ['payload.stdout'])
+
+    def test_keep_limit(self):
+        '''
+        A failed job larger than the size limit is not kept, and does not push out the ones kept before.
+        '''
+        area = self._workarea(failed_size=1500)
+        jobs = [{'PandaID': panda_id} for panda_id in xrange(2)]
+        for job, nbytes in zip(jobs, (1000, 2000)):
+            job['working_dir'] = area.place(job)
+            self._write(job, 'payload.stdout', nbytes)
+            area.clean_up(job, keep=True)
+        area.stop()
+
+        self.assertEqual(os.listdir(os.path.join(self.pilot, 'failed_jobs')), ['job-0'])
+        self.assertFalse(os.path.lexists(os.path.join(self.pilot, 'job-1')))
+        self.assertEqual(os.listdir(self.scratch), [])
+
+    def test_resume(self):
+        '''
+        The space of a job on scratch is reserved again when it is resumed by a new pilot.
+        '''
+        area = self._workarea()
+        job = {'PandaID': 1, 'fsize': '1000'}
+        job['working_dir'] = area.place(job)
+        area.stop()
+
+        area = self._workarea()
+        try:
+            area.resume(job)
+            os.mkdir(os.path.join(self.pilot, 'job-2'))
+            area.resume({'PandaID': 2, 'working_dir': 'job-2'})
+            self.assertEqual(area._reserved, {1: (self.scratch, 2000)})
+        finally:
+            area.stop()
+
+    def test_reserved(self):
+        '''
+        The space of a job is reserved until it finished or failed, whether or not the server confirmed it.
+        '''
+        area = self._workarea()
+        try:
+            for panda_id in xrange(3):
+                area.place({'PandaID': panda_id, 'fsize': '1000'})
+            self.assertEqual(sorted(area._reserved), [0, 1, 2])
+            area.observe({'PandaID': 0, 'reported': False}, 'staging_out', 'finished', 0)
+            area.observe({'PandaID': 1}, 'running', 'failed', 0)
+            area.observe({'PandaID': 2}, 'staged_in', 'prepared', 0)
+            self.assertEqual(sorted(area._reserved), [2])
+            # the directories are left for the final update to be sent again
+            self.assertTrue(os.path.lexists(os.path.join(self.pilot, 'job-0')))
+            self.assertTrue(os.path.lexists(os.path.join(self.pilot, 'job-1')))
+        finally:
+            area.stop()
+
+    def test_dangling(self):
+        '''
+        Links to working directories that are gone are removed at startup.
+        '''
+        os.symlink(os.path.join(self.scratch, 'gone'), os.path.join(self.pilot, 'job-1'))
+        os.mkdir(os.path.join(self.pilot, 'job-2'))
+        self._workarea().stop()
+        self.assertEqual(os.listdir(self.pilot), ['job-2'])
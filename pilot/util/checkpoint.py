@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+# Checkpoints of the jobs, so that a pilot restarted in the same directory,
+# e.g. after a crash or a node drain, continues the jobs of its predecessor
+# instead of having them fetched and staged in again elsewhere. The checkpoint
+# of a job is written to checkpoint.json in its working directory at every
+# state transition and after every file uploaded, and removed once the server
+# confirmed the final state of the job.
+#
+# A job resumes from the last state which nothing was lost of:
+#
+#   validated               the stage-in starts again
+#   staged_in ... running   the inputs are kept, the payload runs again
+#   executed, staging_out   the outputs are kept, files in job['uploaded']
+#                           are not uploaded again
+#   finished                the final state is sent again
+#   failed                  the failure is reported again
+
+import glob
+import json
+import os
+
+from pilot.util.filehandling import write_atomic
+
+import logging
+logger = logging.getLogger(__name__)
+
+FILENAME = 'checkpoint.json'
+
+# the state a job resumes from, by the state of its checkpoint
+RESUME = {'validated': 'validated',
+          'staged_in': 'staged_in',
+          'prepared': 'staged_in',
+          'running': 'staged_in',
+          'executed': 'executed',
+          'staging_out': 'staging_out',
+          'finished': 'staging_out',
+          'failed': 'failed'}
+
+
+def save(job, state):
+    """
+    Atomically writes the checkpoint of a job, once it has a working directory.
+    """
+    if 'working_dir' in job:
+        write_atomic(os.path.join(job['working_dir'], FILENAME), [json.dumps({'state': state, 'job': job}, sort_keys=True)])
+
+
+def remove(job):
+    """
+    Removes the checkpoint of a job, once the server confirmed its final state.
+    """
+    try:
+        os.unlink(os.path.join(job['working_dir'], FILENAME))
+    except (KeyError, OSError):
+        pass
+
+
+def observe(job, previous, state, now):
+    """
+    Registry observer checkpointing the jobs at every transition.
+    """
+    if job.get('reported'):
+        remove(job)
+    else:
+        save(job, state)
+
+
+def load(directory='.'):
+    """
+    Finds the checkpoints of the jobs of a previous pilot in its directory.
+
+    :returns: `list` of (job, state to resume from)
+    """
+    jobs = []
+    for path in sorted(glob.glob(os.path.join(directory, 'job-*', FILENAME))):
+        try:
+            with open(path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            jobs.append((checkpoint['job'], RESUME[checkpoint['state']]))
+        except (IOError, ValueError, KeyError) as e:
+            logger.warning('ignoring checkpoint %s: %s' % (path, str(e)))
+    return jobs
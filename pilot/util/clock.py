@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+# Time as seen by the pilot. The controllers take the time, sleep and wait
+# through the clock in args.clock instead of the time module, so that a
+# simulation can run the pilot faster than the real time, see
+# pilot.benchmark.simulation. A clock of speed 1 is the real time; at speed
+# 10, every second of the pilot takes a tenth of a real second.
+#
+# Only what the pilot decides by itself is accelerated: its lifetime, the
+# waits between job requests and heartbeats, and the time stamps of its jobs.
+# The polling of processes and of the server is not.
+
+import time
+
+from pilot.util.lifetime import monotonic
+
+
+class Clock(object):
+    """
+    :param float speed: seconds of the clock per real second
+    """
+
+    def __init__(self, speed=1.0):
+        self.speed = float(speed)
+        self._start = monotonic()
+        self._wall = time.time()
+
+    def time(self):
+        """
+        :returns: `float` -- seconds since the epoch
+        """
+        if self.speed == 1:
+            return time.time()
+        return self._wall + (monotonic() - self._start) * self.speed
+
+    def monotonic(self):
+        """
+        :returns: `float` -- seconds of the monotonic clock
+        """
+        return self._start + (monotonic() - self._start) * self.speed
+
+    def sleep(self, seconds):
+        time.sleep(seconds / self.speed)
+
+    def wait(self, event, seconds):
+        """
+        Waits for an event for at most the given seconds of the clock, forever if `None`.
+
+        :returns: `bool` -- whether the event is set
+        """
+        return event.wait(None if seconds is None else seconds / self.speed)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import os
+import tempfile
+import zlib
+
+# read once at import, as setting the umask to read it affects all threads
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def write_atomic(path, chunks, mode=None):
+    """
+    Writes a file next to its destination and renames it into place, so that
+    readers see either the previous or the complete new content.
+
+    :param str path: destination file
+    :param chunks: iterable of `str` chunks of the content
+    :param int mode: permissions of the file, those of a file created with `open` if `None`
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp.')
+    try:
+        # mkstemp creates the file readable by the owner only
+        os.fchmod(fd, 0o666 & ~_UMASK if mode is None else mode)
+        with os.fdopen(fd, 'wb') as outfile:
+            for chunk in chunks:
+                outfile.write(chunk)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def adler32(path, blocksize=1024 * 1024):
+    """
+    :returns: `str` -- the adler32 checksum of a file as 8 hex digits, as reported by rucio
+    """
+    value = 1
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(blocksize), ''):
+            value = zlib.adler32(block, value)
+    return '%08x' % (value & 0xffffffff)
@@ -9,20 +9,54 @@
 # - Mario Lassnig, mario.lassnig@cern.ch, 2017
 
 import collections
-import commands
+import httplib
 import json
 import os
-import platform
+import random
+import socket
 import ssl
+import subprocess
 import sys
+import threading
+import time
 import urllib
-import urllib2
-import pipes
+import urlparse
+import zlib
+
+from pilot.util import jsonstream, metrics
 
 import logging
 logger = logging.getLogger(__name__)
 
-_ctx = collections.namedtuple('_ctx', 'ssl_context user_agent capath cacert')
+_ctx = collections.namedtuple('_ctx', 'ssl_context user_agent capath cacert pool graceful_stop compress')
+_ctx.graceful_stop = threading.Event()
+_ctx.compress = False
+
+# request bodies smaller than this are not worth compressing
+COMPRESS_MIN_SIZE = 1024
+
+# servers which rejected compressed request bodies
+_uncompressed = set()
+
+# attempts is the total number of tries, delays grow from base to cap seconds
+RetryPolicy = collections.namedtuple('RetryPolicy', 'attempts base cap')
+
+DEFAULT_RETRY_POLICY = RetryPolicy(attempts=3, base=1, cap=60)
+
+# status codes after which the server may answer differently on the next try
+RETRIABLE_STATUS = (408, 429, 500, 502, 503, 504)
+
+_policies = {'/server/panda/getJob': RetryPolicy(attempts=3, base=5, cap=300),
+             '/server/panda/updateJob': RetryPolicy(attempts=6, base=2, cap=120)}
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+# request phases recorded per URL path
+PHASES = ('dns', 'connect', 'tls', 'first_byte', 'decode', 'total')
+
+_endpoints = {}
+_endpoints_lock = threading.Lock()
 
 
 def _tester(func, *args):
@@ -94,6 +128,394 @@ def cacert(args=None):
                    cacert_default_location())
 
 
+def _timed_connect(conn):
+    """
+    Resolves and connects the socket of a connection, timing both phases.
+
+    :returns: `dict` -- duration of the ``dns`` and ``connect`` phases in seconds
+    """
+    timings = {}
+    start = time.time()
+    addresses = socket.getaddrinfo(conn.host, conn.port, 0, socket.SOCK_STREAM)
+    timings['dns'] = time.time() - start
+
+    start = time.time()
+    for i, address in enumerate(addresses):
+        try:
+            conn.sock = socket.create_connection(address[4][:2], conn.timeout, conn.source_address)
+            break
+        except socket.error:
+            if i + 1 == len(addresses):
+                raise
+    timings['connect'] = time.time() - start
+
+    if conn._tunnel_host:
+        conn._tunnel()
+    return timings
+
+
+class _HTTPConnection(httplib.HTTPConnection):
+    """
+    `httplib.HTTPConnection` recording the duration of its connection phases in ``timings``.
+    """
+
+    def connect(self):
+        self.timings = _timed_connect(self)
+
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+    """
+    `httplib.HTTPSConnection` recording the duration of its connection phases, including the TLS handshake, in ``timings``.
+    """
+
+    def connect(self):
+        self.timings = _timed_connect(self)
+        start = time.time()
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self._tunnel_host or self.host)
+        self.timings['tls'] = time.time() - start
+
+
+class _CountingResponse(object):
+    """
+    Wraps a response to count the bytes read from the network.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.bytes = 0
+
+    def read(self, *args):
+        data = self.response.read(*args)
+        self.bytes += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of persistent HTTP(S) connections, keyed by scheme, host and port.
+
+    Idle connections are kept open with keep-alive and handed out again, so that the TCP
+    and TLS handshakes are paid once per connection rather than once per request. At most
+    ``maxsize`` connections per host are open at the same time; further requests wait for
+    a free slot.
+
+    :param ssl_context: `ssl.SSLContext` used for all HTTPS connections
+    :param int maxsize: maximum number of connections per host
+    :param float timeout: socket timeout in seconds
+    """
+
+    def __init__(self, ssl_context=None, maxsize=4, timeout=60):
+        self.ssl_context = ssl_context
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+
+    def _connect(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            return _HTTPSConnection(host, port, timeout=self.timeout, context=self.ssl_context)
+        return _HTTPConnection(host, port, timeout=self.timeout)
+
+    def acquire(self, key):
+        """
+        Get a connection to the host, reusing an idle one if possible.
+
+        :param key: (scheme, host, port)
+        :returns: (connection, reused) -- `reused` is `True` if the connection was idle in the pool
+        """
+        with self._lock:
+            slots = self._slots.setdefault(key, threading.BoundedSemaphore(self.maxsize))
+        slots.acquire()
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if idle:
+                return idle.pop(), True
+        return self._connect(key), False
+
+    def release(self, key, conn, reuse=True):
+        """
+        Give a connection back to the pool, or close it if it cannot be reused.
+        """
+        if reuse:
+            with self._lock:
+                self._idle.setdefault(key, []).append(conn)
+        else:
+            conn.close()
+        self._slots[key].release()
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            for idle in self._idle.values():
+                while idle:
+                    idle.pop().close()
+
+    def request(self, method, url, body=None, headers=None, reader=None, timings=None):
+        """
+        Send a request over a pooled connection.
+
+        A reused keep-alive connection may have been closed by the server in the meantime,
+        so a failure on a reused connection is retried once on a fresh one.
+
+        :param reader: function(response) consuming the whole response body (default: ``response.read()``)
+        :param dict timings: filled with the duration of the request phases and the response ``size``
+        :returns: (status, headers, body) -- body as returned by ``reader``
+        """
+        parsed = urlparse.urlsplit(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        timings = {} if timings is None else timings
+        while True:
+            conn, reused = self.acquire(key)
+            start = time.time()
+            try:
+                conn.request(method, path, body, headers or {})
+                response = _CountingResponse(conn.getresponse())
+            except (httplib.HTTPException, socket.error):
+                self.release(key, conn, reuse=False)
+                if reused:
+                    logger.debug('stale keep-alive connection to %s:%s -- reconnecting' % (parsed.hostname, parsed.port))
+                    continue
+                raise
+            first_byte = time.time()
+            timings.update(getattr(conn, 'timings', {}))
+            conn.timings = {}
+            try:
+                output = response.read() if reader is None else reader(response)
+            except Exception:
+                self.release(key, conn, reuse=False)
+                raise
+            timings['first_byte'] = first_byte - start - sum(timings.get(phase, 0) for phase in ('dns', 'connect', 'tls'))
+            timings['total'] = time.time() - start
+            timings['size'] = response.bytes
+            self.release(key, conn, reuse=not response.will_close)
+            return response.status, dict(response.getheaders()), output
+
+
+class CircuitBreaker(object):
+    """
+    Fails requests to an unhealthy server fast instead of letting every caller wait for timeouts.
+
+    The breaker opens after ``threshold`` consecutive failures and rejects all requests for
+    ``cooldown`` seconds. Afterwards it is half-open: a single trial request is let through,
+    which closes the breaker on success or opens it again on failure. A server
+    :mailheader:`Retry-After` hint holds off all requests until the given time.
+
+    :param int threshold: consecutive failures before the breaker opens
+    :param float cooldown: seconds the breaker stays open
+    """
+
+    def __init__(self, threshold=5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0
+        self.trial = False
+        self._lock = threading.Lock()
+
+    def allow(self, now=None):
+        """
+        :returns: `True` if a request may be sent now
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            if now < self.open_until:
+                return False
+            if self.failures >= self.threshold:
+                # half-open: only one trial request at a time
+                if self.trial:
+                    return False
+                self.trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.trial = False
+
+    def failure(self, now=None, retry_after=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self.failures += 1
+            self.trial = False
+            if self.failures >= self.threshold:
+                self.open_until = max(self.open_until, now + self.cooldown)
+            if retry_after is not None:
+                self.open_until = max(self.open_until, now + retry_after)
+
+    def tripped(self):
+        """
+        :returns: `True` if the breaker opened because of consecutive failures
+        """
+        with self._lock:
+            return self.failures >= self.threshold
+
+    def remaining(self, now=None):
+        """
+        :returns: seconds until the next request will be let through
+        """
+        now = time.time() if now is None else now
+        return max(0, self.open_until - now)
+
+
+def set_retry_policy(path, attempts, base, cap):
+    """
+    Sets the retry policy for all requests to a URL path, e.g. ``/server/panda/getJob``.
+
+    :param str path: URL path of the endpoint
+    :param int attempts: total number of tries
+    :param float base: backoff delay of the first retry in seconds
+    :param float cap: maximum backoff delay in seconds
+    """
+    _policies[path] = RetryPolicy(attempts=attempts, base=base, cap=cap)
+
+
+def backoff(policy, attempt):
+    """
+    Exponential backoff with full jitter: a random delay between zero and the exponential delay,
+    so that pilots failing at the same time do not retry in lockstep.
+
+    :param policy: `RetryPolicy` of the endpoint
+    :param int attempt: number of the failed attempt, starting from 0
+    :returns: `float` -- delay in seconds
+    """
+    return random.uniform(0, min(policy.cap, policy.base * 2 ** attempt))
+
+
+def retry_after(value, now=None):
+    """
+    Parses a :mailheader:`Retry-After` header given either in seconds or as an HTTP date.
+
+    :returns: `float` -- delay in seconds, or `None` if absent or malformed
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    # only needed for the rare HTTP date form, so not imported at startup
+    import email.utils
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    now = time.time() if now is None else now
+    return max(0.0, email.utils.mktime_tz(date) - now)
+
+
+def circuit_breaker(url):
+    """
+    :returns: the `CircuitBreaker` of the server of the URL
+    """
+    netloc = urlparse.urlsplit(url).netloc
+    with _breakers_lock:
+        if netloc not in _breakers:
+            _breakers[netloc] = CircuitBreaker()
+        return _breakers[netloc]
+
+
+def next_attempt(url, attempt=None):
+    """
+    Tells a caller whose request failed, or was answered without result, how long to wait before
+    asking the same endpoint again: until the circuit breaker lets requests through, or a jittered
+    backoff of the endpoint policy.
+
+    :param string url: the URL of the request
+    :param int attempt: number of consecutive requests without result, starting from 0,
+                        the attempts of the endpoint policy if `None`
+    :returns: `float` -- delay in seconds
+    """
+    policy = _policies.get(urlparse.urlsplit(url).path, DEFAULT_RETRY_POLICY)
+    return max(circuit_breaker(url).remaining(), backoff(policy, policy.attempts if attempt is None else attempt))
+
+
+class EndpointMetrics(object):
+    """
+    Latency histograms of the request phases, response sizes and error counts of one URL path.
+
+    The phases are ``dns``, ``connect`` and ``tls`` for new connections only, ``first_byte``
+    from sending the request to receiving the response headers, ``decode`` for the JSON
+    decoding (including reading the body when streaming), and ``total``.
+    """
+
+    def __init__(self):
+        self.phases = dict((phase, metrics.Histogram(metrics.LATENCY_BUCKETS)) for phase in PHASES)
+        self.size = metrics.Histogram(metrics.SIZE_BUCKETS)
+        self.requests = 0
+        self.errors = collections.defaultdict(int)
+        self._lock = threading.Lock()
+
+    def observe(self, timings, error=None):
+        with self._lock:
+            self.requests += 1
+            for phase in PHASES:
+                if phase in timings:
+                    self.phases[phase].observe(timings[phase])
+            if 'size' in timings:
+                self.size.observe(timings['size'])
+            if error is not None:
+                self.errors[error] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {'requests': self.requests,
+                    'errors': dict(self.errors),
+                    'size': self.size.snapshot(),
+                    'phases': dict((phase, self.phases[phase].snapshot()) for phase in PHASES)}
+
+
+def endpoint_metrics(url):
+    """
+    :returns: the `EndpointMetrics` of the path of the URL
+    """
+    path = urlparse.urlsplit(url).path
+    with _endpoints_lock:
+        if path not in _endpoints:
+            _endpoints[path] = EndpointMetrics()
+        return _endpoints[path]
+
+
+def get_metrics():
+    """
+    Snapshot of the request metrics of all URL paths, readable at any time.
+
+    :returns: `dict` -- `EndpointMetrics` snapshots keyed by URL path
+    """
+    with _endpoints_lock:
+        endpoints = dict(_endpoints)
+    return dict((path, endpoints[path].snapshot()) for path in endpoints)
+
+
+def dump_metrics(filename):
+    """
+    Writes the request metrics of all URL paths as JSON.
+    """
+    with open(filename, 'w') as outfile:
+        json.dump(get_metrics(), outfile, indent=1, sort_keys=True)
+
+
+def _error_class(exception):
+    if isinstance(exception, socket.timeout):
+        return 'timeout'
+    if isinstance(exception, socket.gaierror):
+        return 'dns'
+    if isinstance(exception, ssl.SSLError):
+        return 'tls'
+    if isinstance(exception, socket.error):
+        return 'connection'
+    return 'protocol'
+
+
 def https_setup(args, version):
     """
     Sets up the context for future HTTPS requests:
@@ -101,14 +523,17 @@ def https_setup(args, version):
     1. Selects the certificate paths
     2. Sets up :mailheader:`User-Agent`
     3. Tries to create `ssl.SSLContext` for future use (falls back to :command:`curl` if fails)
+    4. Creates the `ConnectionPool` sharing this context, limited to :option:`--http-connections` per host
+    5. Makes retry delays interruptible by the pilot graceful stop
+    6. Enables compressed request bodies if :option:`--http-compress` is given
 
     :param args: arguments, parsed by `argparse`
     :param str version: pilot version string (for :mailheader:`User-Agent`)
     """
     _ctx.user_agent = 'pilot/%s (Python %s; %s %s)' % (version,
                                                        sys.version.split()[0],
-                                                       platform.system(),
-                                                       platform.machine())
+                                                       os.uname()[0],
+                                                       os.uname()[4])
     logger.debug('User-Agent: %s' % _ctx.user_agent)
 
     _ctx.capath = capath(args)
@@ -125,21 +550,169 @@ def https_setup(args, version):
             logger.warn('SSL communication is impossible due to SSL error: %s -- falling back to curl' % str(e))
             _ctx.ssl_context = None
 
+    if _ctx.ssl_context is not None:
+        _ctx.pool = ConnectionPool(ssl_context=_ctx.ssl_context, maxsize=args.http_connections)
+
+    _ctx.graceful_stop = args.graceful_stop
+    _ctx.compress = args.http_compress
+
+
+def _send_curl(url, data, plain, timings):
+    if data:
+        url += '?' + urllib.urlencode(data)
+    req = ['curl', '-sS', '--compressed',
+           '--connect-timeout', '1', '--max-time', '3',
+           '-H', 'User-Agent: %s' % _ctx.user_agent,
+           '-w', '\n%{http_code} %{time_namelookup} %{time_connect} %{time_appconnect} %{time_starttransfer} %{time_total} %{size_download}']
+    if _ctx.capath is not None:
+        req += ['--capath', _ctx.capath]
+    if _ctx.cacert is not None:
+        req += ['--cert', _ctx.cacert, '--cacert', _ctx.cacert, '--key', _ctx.cacert]
+    if not plain:
+        req += ['-H', 'Accept: application/json']
+    req.append(url)
+    logger.debug('request: %s' % req)
+
+    try:
+        process = subprocess.Popen(req, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        logger.warn('request failed: %s' % str(e))
+        return None, {}, None
+    output, error = process.communicate()
+    if process.returncode != 0:
+        logger.warn('request failed (%s): %s' % (process.returncode, error))
+        # curl exit codes 6, 28 and 35 are DNS, timeout and TLS failures
+        timings['error'] = {6: 'dns', 28: 'timeout', 35: 'tls'}.get(process.returncode, 'connection')
+        return None, {}, None
+
+    output, status = output.rsplit('\n', 1)
+    status, dns, connect, tls, first_byte, total, size = status.split()
+    connect, tls = float(connect), float(tls) or float(connect)
+    timings.update({'dns': float(dns),
+                    'connect': connect - float(dns),
+                    'first_byte': float(first_byte) - tls,
+                    'total': float(total),
+                    'size': int(float(size))})
+    if tls > connect:
+        timings['tls'] = tls - connect
+
+    status = int(status)
+    if status < 400 and not plain:
+        start = time.time()
+        output = json.loads(output)
+        timings['decode'] = time.time() - start
+    return status, {}, output
+
+
+def _gzip(body):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def _reader(plain, stream, timings):
+    """
+    Creates a response reader which gunzips the body if necessary and decodes successful
+    JSON responses, incrementally if ``stream`` is set. The decoding time is added to ``timings``.
+    """
+    def read(response):
+        gzip = response.getheader('content-encoding', '').lower() == 'gzip'
+        if plain or response.status >= 400:
+            return ''.join(jsonstream.iter_chunks(response, gzip=gzip)) if gzip else response.read()
+        start = time.time()
+        if stream:
+            output = jsonstream.load(jsonstream.iter_chunks(response, gzip=gzip))
+            response.read()
+        else:
+            output = ''.join(jsonstream.iter_chunks(response, gzip=True)) if gzip else response.read()
+            start = time.time()
+            output = json.loads(output)
+        timings['decode'] = time.time() - start
+        return output
+    return read
+
+
+def _send_pool(url, data, plain, stream, timings):
+    netloc = urlparse.urlsplit(url).netloc
+    headers = {'User-Agent': _ctx.user_agent,
+               'Connection': 'keep-alive',
+               'Accept-Encoding': 'gzip'}
+    if not plain:
+        headers['Accept'] = 'application/json'
+    if data:
+        method, body = 'POST', urllib.urlencode(data)
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    else:
+        method, body = 'GET', None
+
+    compressed = _ctx.compress and body is not None and len(body) >= COMPRESS_MIN_SIZE and netloc not in _uncompressed
+    try:
+        if compressed:
+            status, response_headers, output = _ctx.pool.request(method, url, body=_gzip(body),
+                                                                 headers=dict(headers, **{'Content-Encoding': 'gzip'}),
+                                                                 reader=_reader(plain, stream, timings),
+                                                                 timings=timings)
+            if status != 415:
+                return status, response_headers, output
+            logger.info('server does not accept compressed requests -- sending uncompressed: %s' % netloc)
+            _uncompressed.add(netloc)
+        return _ctx.pool.request(method, url, body=body, headers=headers, reader=_reader(plain, stream, timings), timings=timings)
+    except (httplib.HTTPException, socket.error) as e:
+        logger.warn('connection error: %s' % str(e))
+        timings['error'] = _error_class(e)
+        return None, {}, None
+
+
+def _send(url, data, plain, stream=False):
+    """
+    Sends the request once and records its metrics.
 
-def request(url, data=None, plain=False):
+    :returns: (status, headers, body) -- status is `None` if the server could not be reached,
+              body is decoded from JSON if the request succeeded and ``plain`` is not set
+    """
+    timings = {}
+    try:
+        if _ctx.ssl_context is None:
+            status, headers, output = _send_curl(url, data, plain, timings)
+        else:
+            status, headers, output = _send_pool(url, data, plain, stream, timings)
+    except ValueError:
+        endpoint_metrics(url).observe(timings, error='decode')
+        raise
+
+    error = timings.get('error')
+    if status is not None and status >= 500:
+        error = 'http_5xx'
+    elif status is not None and status >= 400:
+        error = 'http_4xx'
+    endpoint_metrics(url).observe(timings, error=error)
+
+    return status, headers, output
+
+
+def request(url, data=None, plain=False, stream=False):
     """
     This function sends a request using HTTPS.
     Sends :mailheader:`User-Agent` and certificates previously being set up by `https_setup`.
-    If `ssl.SSLContext` is available, uses `urllib2` as a request processor. Otherwise uses :command:`curl`.
+    If `ssl.SSLContext` is available, sends the request over a persistent connection from the `ConnectionPool`.
+    Otherwise executes :command:`curl` directly, without an intermediate shell.
 
     If ``data`` is provided, encodes it as a URL form data and sends it to the server.
+    If compression is enabled by :option:`--http-compress`, large bodies are sent gzip-compressed,
+    unless the server rejected compressed bodies before. Responses are always requested compressed.
 
     Treats the request as JSON unless a parameter ``plain`` is `True`.
     If JSON is expected, sends ``Accept: application/json`` header.
 
+    Failed requests are retried according to the `RetryPolicy` of the URL path, with jittered
+    exponential backoff or the delay of a server :mailheader:`Retry-After` hint. While the
+    server is unhealthy, its `CircuitBreaker` fails requests immediately; callers can ask
+    `next_attempt` how long to wait. While the server only asked to hold off with
+    :mailheader:`Retry-After`, requests wait for the given time instead.
+
     :param string url: the URL of the resource
     :param dict data: data to send
     :param boolean plain: if true, treats the response as a plain text.
+    :param boolean stream: if true, decodes JSON arrays incrementally while the response is read.
 
     Returns:
         - :keyword:`dict` -- if everything went OK
@@ -147,33 +720,44 @@ def request(url, data=None, plain=False):
         - `None` -- if something went wrong
     """
 
-    # _ctx.ssl_context = None  # no time to deal with this now
-
-    if _ctx.ssl_context is None:
-        req = 'curl -sS --compressed --connect-timeout %s --max-time %s '\
-              '--capath %s --cert %s --cacert %s --key %s '\
-              '-H %s %s %s' % (1, 3,
-                               pipes.quote(_ctx.capath), pipes.quote(_ctx.cacert), pipes.quote(_ctx.cacert), pipes.quote(_ctx.cacert),
-                               pipes.quote('User-Agent: %s' % _ctx.user_agent),
-                               "-H " + pipes.quote('Accept: application/json') if not plain else '',
-                               pipes.quote(url + '?' + urllib.urlencode(data) if data else ''))
-        logger.debug('request: %s' % req)
-        status, output = commands.getstatusoutput(req)
-        if status != 0:
-            logger.warn('request failed (%s): %s' % (status, output))
-            return None
-    else:
-        req = urllib2.Request(url, urllib.urlencode(data))
-        if not plain:
-            req.add_header('Accept', 'application/json')
-        req.add_header('User-Agent', _ctx.user_agent)
+    policy = _policies.get(urlparse.urlsplit(url).path, DEFAULT_RETRY_POLICY)
+    breaker = circuit_breaker(url)
+
+    for attempt in xrange(policy.attempts):
+        while not breaker.allow():
+            if breaker.tripped():
+                logger.warn('server unhealthy -- failing fast for another %.0fs: %s' % (breaker.remaining(), url))
+                return None
+            # only held back by a Retry-After hint
+            if _ctx.graceful_stop.wait(breaker.remaining()):
+                return None
+
         try:
-            output = urllib2.urlopen(req, context=_ctx.ssl_context)
-        except urllib2.HTTPError as e:
-            logger.warn('server error (%s): %s' % (e.code, e.read()))
+            status, headers, output = _send(url, data, plain, stream)
+        except Exception:
+            # e.g. an undecodable response; a trial request left pending would keep the breaker half-open for good
+            breaker.failure()
+            raise
+
+        if status is not None and status < 400:
+            breaker.success()
+            break
+
+        if status is not None and status not in RETRIABLE_STATUS:
+            # the server is healthy, it just does not like this request
+            breaker.success()
+            logger.warn('server error (%s): %s' % (status, output))
             return None
-        except urllib2.URLError as e:
-            logger.warn('connection error: %s' % e.reason)
+
+        hint = retry_after(headers.get('retry-after'))
+        breaker.failure(retry_after=hint)
+        if attempt + 1 == policy.attempts:
+            logger.warn('giving up after %s attempts: %s' % (policy.attempts, url))
+            return None
+
+        delay = hint if hint is not None else backoff(policy, attempt)
+        logger.warn('request failed (%s) -- retrying in %.1fs (attempt %s/%s)' % (status, delay, attempt + 1, policy.attempts))
+        if _ctx.graceful_stop.wait(delay):
             return None
 
-    return output if plain else json.loads(output)
+    return output
@@ -10,99 +10,433 @@
 
 
 # This is a stub implementation of the information component. It retrieves
-# sites, storages, and queues from AGIS and tries to locally cache them.
-# No cache update is involved, just remove the .cache files.
+# sites, storages, and queues from AGIS and caches them in a node-wide cache
+# directory shared by all pilots of the same user. Entries expire after their
+# TTL and are then refreshed with a conditional request, which costs only a
+# 304 answer if the document did not change. Refreshes are serialised by a
+# lock file per entry, so that pilots starting together fetch each document
+# once, and files are replaced atomically, so that readers never see a
+# partially written document.
+#
+# The default cache directory has a predictable name in /tmp, so another user
+# could create it first and plant forged documents. It is only used if it
+# belongs to the user and nobody else can write to it; otherwise nothing is
+# cached.
 
 import collections
+import errno
+import fcntl
 import hashlib
 import json
 import os
-import urllib2
+import shutil
+import stat
+import tempfile
+import threading
+import time
+
+from pilot.util import jsonstream, timing
+from pilot.util.filehandling import write_atomic
 
 import logging
 logger = logging.getLogger(__name__)
 
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'pilot-cache-%s' % os.getuid())
+CACHE_TTL = 3600
+
+# cache directories found unsafe, warned about once
+_untrusted = set()
+
+
+# the only fields of the AGIS documents kept in the location snapshot
+QUEUE_FIELDS = ('name', 'site', 'state', 'type', 'maxtime', 'maxrss', 'corecount', 'maxinputsize', 'timefloor')
+SITE_FIELDS = ('name', 'state', 'cloud', 'tier_level')
+STORAGE_FIELDS = ('name', 'site', 'state', 'type', 'rse', 'token')
+
 
-def set_location(args, site=None):
+def set_location(args, site=None, background=False, timer=None):
     '''
     Set up all necessary site information.
     Resolve everything from the specified queue name, and fill extra lookup structure.
 
     If site is specified, return the site and storage information only.
+
+    The resolved location is stored as a compact snapshot in the cache directory, so that
+    later pilots on the node load a few kilobytes instead of the full AGIS documents.
+
+    The AGIS documents are fetched concurrently. With ``background``, the function returns as soon
+    as the queue and site are confirmed, and the storages, which are only needed for stage-out,
+    are resolved in a separate thread; ``args.location.storages_ready`` is set once they are known.
+
+    :param timer: :class:`pilot.util.timing.PhaseTimer` the lookups are timed with
     '''
 
     args.location = collections.namedtuple('location', ['queue', 'site', 'storages',
-                                                        'queue_info', 'site_info', 'storages_info'])
+                                                        'queue_info', 'site_info', 'storages_info',
+                                                        'storages_ready'])
+    args.location.storages_ready = threading.Event()
+    timer = timer or timing.PhaseTimer()
 
-    if site is None:
-        # verify that the queue is active
-        all_queues = retrieve_json('http://atlas-agis-api.cern.ch/request/pandaqueue/query/list/?json')
-        if args.queue not in [queue['name'] for queue in all_queues]:
-            logger.critical('specified queue NOT FOUND: %s -- aborting' % args.queue)
-            return False
-        if not [queue for queue in all_queues if queue['name'] == args.queue and queue['state'] == 'ACTIVE']:
-            logger.critical('specified queue is NOT ACTIVE: %s -- aborting' % args.queue)
-            return False
-        args.location.queue = str(args.queue)
-        args.location.queue_info = [queue for queue in all_queues if queue['name'] == args.queue][0]
-
-        # find the associated site
-        all_sites = retrieve_json('http://atlas-agis-api.cern.ch/request/site/query/list/?json')
-        matching_sites = [queue for queue in all_queues if queue['name'] == args.queue]
-        if len(matching_sites) != 1:
-            logger.critical('queue is not explicitly mapped to a single site, found: %s' % [tmp_site['name'] for tmp_site in matching_sites])
-            return False
+    name = snapshot_name(args, site)
+    with timer.phase('location'):
+        snapshot = _read_snapshot(args.cache_dir, name, args.cache_ttl)
+        if snapshot is not None:
+            logger.debug('location snapshot found: %s' % name)
         else:
-            args.location.site = str(matching_sites[0]['site'])
-            args.location.site_info = [tmp_site for tmp_site in all_sites if tmp_site['name'] == args.location.site][0]
-
-    else:
-        # find the associated site
-        all_sites = retrieve_json('http://atlas-agis-api.cern.ch/request/site/query/list/?json')
-        result = [tmp_site for tmp_site in all_sites if tmp_site['name'] == site]
-        if len(result) == 0:
-            raise Exception('Specified site not found: %s' % site)
-        args.location.site = site
-        args.location.site_info = result[0]
+            documents = ['site', 'ddmendpoint'] if site is not None else ['pandaqueue', 'site', 'ddmendpoint']
+            prefetch([_document_url(args, document) for document in documents], args.cache_dir, args.cache_ttl)
+            if site is None:
+                snapshot = _resolve_queue(args)
+                if snapshot is None:
+                    return False
+            else:
+                snapshot = _resolve_site(args, site)
 
-    # find all enabled storages at site
-    all_storages = retrieve_json('http://atlas-agis-api.cern.ch/request/ddmendpoint/query/list/?json')
-    args.location.storages = [str(storage['name']) for storage in all_storages
-                              if storage['site'] == args.location.site and storage['state'] == 'ACTIVE']
-    args.location.storages_info = {}
-    for tmp_storage in args.location.storages:
-        args.location.storages_info[tmp_storage] = [storage for storage in all_storages
-                                                    if storage['name'] == tmp_storage and storage['state'] == 'ACTIVE'][0]
+    for field in snapshot:
+        setattr(args.location, field, snapshot[field])
 
     logger.info('queue: %s' % args.location.queue)
     logger.info('site: %s' % args.location.site)
-    logger.info('storages: %s' % args.location.storages)
 
+    if 'storages' in snapshot:
+        _storages_resolved(args)
+    elif background:
+        thread = threading.Thread(target=_resolve_storages_background, name='storages', args=(args, name, snapshot, timer))
+        thread.daemon = True
+        thread.start()
+    else:
+        _set_storages(args, name, snapshot, timer)
+
+    return True
+
+
+def wait_storages(args):
+    """
+    Waits until the storages of the location are resolved, or the pilot is stopped.
+
+    :returns: boolean -- `True` if the storages are known
+    """
+    while not args.location.storages_ready.wait(1):
+        if args.graceful_stop.is_set():
+            return False
     return True
 
 
-def retrieve_json(url):
+def _set_storages(args, name, snapshot, timer):
+    with timer.phase('storages'):
+        snapshot.update(_resolve_storages(args, snapshot['site']))
+    _write_snapshot(args.cache_dir, name, snapshot)
+    args.location.storages = snapshot['storages']
+    args.location.storages_info = snapshot['storages_info']
+    _storages_resolved(args)
+
+
+def _resolve_storages_background(args, name, snapshot, timer):
+    try:
+        _set_storages(args, name, snapshot, timer)
+    except Exception as e:
+        logger.error('could not resolve storages of site %s: %s' % (snapshot['site'], str(e)))
+        args.location.storages = []
+        args.location.storages_info = {}
+        args.location.storages_ready.set()
+
+
+def _storages_resolved(args):
+    logger.info('storages: %s' % args.location.storages)
+    args.location.storages_ready.set()
+
+
+def index(entries, key='name'):
+    """
+    Indexes a list of AGIS entries by one of their fields. The first entry wins on duplicates.
+
+    :returns: `dict` -- entry by field value
+    """
+    result = {}
+    for entry in entries:
+        result.setdefault(entry[key], entry)
+    return result
+
+
+def group(entries, key):
+    """
+    Groups a list of AGIS entries by one of their fields.
+
+    :returns: `dict` -- list of entries by field value
+    """
+    result = collections.defaultdict(list)
+    for entry in entries:
+        result[entry[key]].append(entry)
+    return result
+
+
+def compact(entry, fields):
+    """
+    :returns: `dict` -- only the given fields of an AGIS entry
+    """
+    return dict((field, entry[field]) for field in fields if field in entry)
+
+
+def snapshot_name(args, site=None):
+    """
+    Name of the location snapshot in the cache directory. Pilots on the node may use different
+    AGIS instances, so the name is keyed by the information system URL as well.
+    """
+    m = hashlib.md5()
+    m.update(args.info_url)
+    return 'location.%s.%s' % (args.queue if site is None else 'site.%s' % site, m.hexdigest()[:12])
+
+
+def _document_url(args, document):
+    return '%s/request/%s/query/list/?json' % (args.info_url, document)
+
+
+def _resolve_queue(args):
+    # verify that the queue is active
+    queues = index(retrieve_json(_document_url(args, 'pandaqueue'), args.cache_dir, args.cache_ttl,
+                                 predicate=lambda queue: queue['name'] == args.queue))
+    queue = queues.get(args.queue)
+    if queue is None:
+        logger.critical('specified queue NOT FOUND: %s -- aborting' % args.queue)
+        return None
+    if queue['state'] != 'ACTIVE':
+        logger.critical('specified queue is NOT ACTIVE: %s -- aborting' % args.queue)
+        return None
+
+    # find the associated site
+    sites = index(retrieve_json(_document_url(args, 'site'), args.cache_dir, args.cache_ttl,
+                                predicate=lambda site: site['name'] == queue['site']))
+    site = sites.get(queue['site'])
+    if site is None:
+        logger.critical('queue is not mapped to a known site, found: %s' % queue['site'])
+        return None
+
+    return {'queue': str(args.queue),
+            'queue_info': compact(queue, QUEUE_FIELDS),
+            'site': str(queue['site']),
+            'site_info': compact(site, SITE_FIELDS)}
+
+
+def _resolve_site(args, site):
+    sites = index(retrieve_json(_document_url(args, 'site'), args.cache_dir, args.cache_ttl,
+                                predicate=lambda entry: entry['name'] == site))
+    if site not in sites:
+        raise Exception('Specified site not found: %s' % site)
+    return {'queue': None,
+            'queue_info': None,
+            'site': site,
+            'site_info': compact(sites[site], SITE_FIELDS)}
+
+
+def _resolve_storages(args, site):
+    # find all enabled storages at site
+    storages = group(retrieve_json(_document_url(args, 'ddmendpoint'), args.cache_dir, args.cache_ttl,
+                                   predicate=lambda storage: storage['site'] == site), 'site')
+    active = [storage for storage in storages.get(site, []) if storage['state'] == 'ACTIVE']
+    return {'storages': [str(storage['name']) for storage in active],
+            'storages_info': dict((str(storage['name']), compact(storage, STORAGE_FIELDS)) for storage in active)}
+
+
+def _read_snapshot(cache_dir, name, ttl):
+    if not _trusted(cache_dir):
+        return None
+    path = os.path.join(cache_dir, name)
+    try:
+        if time.time() - os.path.getmtime(path) >= ttl:
+            return None
+        with open(path, 'rb') as infile:
+            return json.load(infile)
+    except (OSError, IOError, ValueError):
+        return None
+
+
+def _write_snapshot(cache_dir, name, snapshot):
+    if not _trusted(cache_dir):
+        return
+    try:
+        write_atomic(os.path.join(cache_dir, name), [json.dumps(snapshot)])
+    except (OSError, IOError) as e:
+        logger.warning('could not write location snapshot %s: %s' % (name, str(e)))
+
+
+def retrieve_json(url, cache_dir=CACHE_DIR, ttl=CACHE_TTL, predicate=None):
+    """
+    Retrieves a JSON document through the node-wide cache.
+
+    A cached document younger than its TTL is used as is. Otherwise one pilot refreshes it while
+    holding the entry lock, with a conditional request if the server gave an :mailheader:`ETag` or
+    :mailheader:`Last-Modified`, and the others wait for and use the refreshed copy. If the
+    refresh fails, a stale cached copy is used rather than failing.
+
+    :param str url: document URL
+    :param str cache_dir: cache directory, created if necessary, not used if another user could write to it
+    :param int ttl: maximum age in seconds of a cached document before it is refreshed
+    :param predicate: function(entry)->boolean -- if given, the document must be a list, which is
+                      parsed incrementally keeping only the matching entries, so that memory use
+                      scales with the result rather than with the document
+    :returns: decoded document
+    """
     logger.debug('retrieving: %s' % url)
-    j = _read_cache(url)
-    if j is not None:
+    if not _trusted(cache_dir):
+        # fetched without the cache, into a directory of this pilot only
+        private = tempfile.mkdtemp(prefix='pilot-')
+        try:
+            entry = os.path.join(private, 'document')
+            _refresh(url, entry, None)
+            return _load(entry, predicate)
+        finally:
+            shutil.rmtree(private, ignore_errors=True)
+    return _load(_update(url, cache_dir, ttl), predicate)
+
+
+def prefetch(urls, cache_dir=CACHE_DIR, ttl=CACHE_TTL):
+    """
+    Brings documents into the cache concurrently, each in a background thread. A later
+    :func:`retrieve_json` of one of them waits for its refresh in progress instead of
+    fetching it again.
+
+    :returns: list of the started threads, none without a cache
+    """
+    if not _trusted(cache_dir):
+        return []
+    threads = [threading.Thread(target=_prefetch, name='prefetch', args=(url, cache_dir, ttl)) for url in urls]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    return threads
+
+
+def _prefetch(url, cache_dir, ttl):
+    try:
+        _update(url, cache_dir, ttl)
+    except Exception as e:
+        # the caller retrieving the document gets the error
+        logger.debug('could not prefetch %s: %s' % (url, str(e)))
+
+
+def _update(url, cache_dir, ttl):
+    """
+    Refreshes the cache entry of a document unless it is fresh.
+
+    :returns: path of the cache entry, without extension
+    """
+    entry = _cache_entry(cache_dir, url)
+
+    meta = _read_meta(entry)
+    if _fresh(entry, meta, ttl):
         logger.debug('cached version found: %s' % url)
-        return j
-    j = json.loads(urllib2.urlopen(url).read())
-    logger.debug('caching: %s' % url)
-    _write_cache(url, j)
-    return j
+        return entry
+
+    with _Lock(entry + '.lock'):
+        # somebody else may have refreshed the entry while we were waiting for the lock
+        meta = _read_meta(entry)
+        if _fresh(entry, meta, ttl):
+            logger.debug('cached version refreshed by another pilot: %s' % url)
+            return entry
 
+        try:
+            _refresh(url, entry, meta)
+        except IOError as e:  # includes urllib2.URLError
+            if not os.path.exists(entry + '.json'):
+                raise
+            logger.warning('could not refresh %s, using stale cached version: %s' % (url, str(e)))
 
-def _read_cache(url):
+    return entry
+
+
+def _trusted(cache_dir):
+    """
+    Creates the cache directory, accessible by the user only, if it does not exist yet.
+
+    :returns: `bool` -- whether the directory belongs to the user and nobody else can write to it
+    """
+    try:
+        os.makedirs(cache_dir, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            logger.warning('cannot create cache directory %s, not caching: %s' % (cache_dir, str(e)))
+            return False
+    try:
+        info = os.stat(cache_dir)
+    except OSError as e:
+        logger.warning('cannot check cache directory %s, not caching: %s' % (cache_dir, str(e)))
+        return False
+    if stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        return True
+    if cache_dir not in _untrusted:
+        _untrusted.add(cache_dir)
+        logger.warning('cache directory %s is not a directory of this user only, not caching' % cache_dir)
+    return False
+
+
+def _cache_entry(cache_dir, url):
     m = hashlib.md5()
     m.update(url)
-    if os.path.exists('.cache.%s' % m.hexdigest()):
-        with open('.cache.%s' % m.hexdigest(), 'rb') as infile:
+    return os.path.join(cache_dir, m.hexdigest())
+
+
+def _fresh(entry, meta, ttl):
+    return meta is not None and time.time() - meta['fetched'] < ttl and os.path.exists(entry + '.json')
+
+
+def _read_meta(entry):
+    try:
+        with open(entry + '.meta', 'rb') as infile:
             return json.load(infile)
+    except (IOError, ValueError):
+        return None
 
 
-def _write_cache(url, j):
-    m = hashlib.md5()
-    m.update(url)
-    with open('.cache.%s' % m.hexdigest(), 'wb') as outfile:
-        json.dump(j, outfile)
+def _load(entry, predicate=None):
+    with open(entry + '.json', 'rb') as infile:
+        if predicate is None:
+            return json.load(infile)
+        return list(jsonstream.iterload(jsonstream.iter_chunks(infile), predicate))
+
+
+def _refresh(url, entry, meta):
+    # not imported at startup, which needs no request at all while the location snapshot is fresh
+    import urllib2
+
+    req = urllib2.Request(url)
+    if meta is not None and os.path.exists(entry + '.json'):
+        if meta.get('etag'):
+            req.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            req.add_header('If-Modified-Since', meta['last_modified'])
+
+    try:
+        response = urllib2.urlopen(req)
+    except urllib2.HTTPError as e:
+        if e.code != 304:
+            raise
+        logger.debug('cached version not modified: %s' % url)
+        meta['fetched'] = time.time()
+        write_atomic(entry + '.meta', [json.dumps(meta)])
+        return
+
+    logger.debug('caching: %s' % url)
+    write_atomic(entry + '.json', iter(lambda: response.read(64 * 1024), ''))
+    write_atomic(entry + '.meta', [json.dumps({'url': url,
+                                               'fetched': time.time(),
+                                               'etag': response.info().getheader('ETag'),
+                                               'last_modified': response.info().getheader('Last-Modified')})])
+
+
+class _Lock(object):
+    """
+    Exclusive advisory lock on a file, shared between processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
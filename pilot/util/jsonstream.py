@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+# Incremental JSON decoding of large documents. The body is read in chunks,
+# gunzipped on the fly if necessary, and the elements of a top-level JSON
+# array are decoded one at a time, so that the raw, decompressed, and decoded
+# copies of the full document never have to be in memory together.
+
+import json
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_whitespace = ' \t\n\r'
+
+
+def iter_chunks(fileobj, gzip=False, size=CHUNK_SIZE):
+    """
+    Reads a file-like object in chunks.
+
+    :param fileobj: object with a ``read(size)`` method
+    :param boolean gzip: decompress a gzip-encoded stream on the fly
+    :param int size: chunk size in bytes
+    :returns: generator of `str` chunks
+    """
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzip else None
+    while True:
+        chunk = fileobj.read(size)
+        if not chunk:
+            break
+        if inflater is not None:
+            chunk = inflater.decompress(chunk)
+        if chunk:
+            yield chunk
+    if inflater is not None:
+        tail = inflater.flush()
+        if tail:
+            yield tail
+
+
+class _Buffer(object):
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.data = ''
+        self.pos = 0
+        self.eof = False
+
+    def more(self):
+        """
+        Appends the next chunk, dropping everything already consumed.
+
+        :returns: `False` if the stream is exhausted
+        """
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            return False
+        self.data = self.data[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        :returns: the next non-whitespace character, or `None` at the end of the stream
+        """
+        while True:
+            while self.pos < len(self.data) and self.data[self.pos] in _whitespace:
+                self.pos += 1
+            if self.pos < len(self.data):
+                return self.data[self.pos]
+            if not self.more():
+                return None
+
+    def value(self):
+        """
+        Decodes the JSON value at the current position.
+        """
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(self.data, self.pos)
+            except ValueError:
+                if not self.more():
+                    raise
+                continue
+            # a number at the very end of the buffer may continue in the next chunk
+            if end == len(self.data) and not self.eof and self.more():
+                continue
+            self.pos = end
+            return obj
+
+
+def iterload(chunks, predicate=None):
+    """
+    Decodes the elements of a top-level JSON array one by one.
+
+    :param chunks: iterable of `str` chunks of the document
+    :param predicate: function(element)->boolean, only matching elements are returned
+    :returns: generator of decoded elements
+    :raises ValueError: if the document is not a well-formed JSON array
+    """
+    buf = _Buffer(chunks)
+    if buf.peek() != '[':
+        raise ValueError('JSON document is not an array')
+    buf.pos += 1
+    if buf.peek() == ']':
+        return
+
+    while True:
+        buf.peek()
+        element = buf.value()
+        if predicate is None or predicate(element):
+            yield element
+        separator = buf.peek()
+        buf.pos += 1
+        if separator == ']':
+            return
+        if separator != ',':
+            raise ValueError('expected , or ] in JSON array, found: %s' % separator)
+
+
+def load(chunks):
+    """
+    Decodes a JSON document given in chunks. Arrays are decoded incrementally,
+    any other document is joined and decoded at once.
+
+    :param chunks: iterable of `str` chunks of the document
+    :returns: decoded document
+    """
+    chunks = iter(chunks)
+    head = ''
+    for chunk in chunks:
+        head += chunk
+        if head.strip():
+            break
+
+    if head.lstrip().startswith('['):
+        return list(iterload(_prepend(head, chunks)))
+    return json.loads(''.join(_prepend(head, chunks)))
+
+
+def _prepend(head, chunks):
+    yield head
+    for chunk in chunks:
+        yield chunk
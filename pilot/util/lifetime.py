@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+# Lifetime of the pilot, and the admission of jobs into what is left of it.
+# The deadline is kept on the monotonic clock, so that changes of the system
+# time neither shorten nor extend the lifetime. A job is admitted only if its
+# estimated stage-in, payload and stage-out times fit into the time left
+# before the shutdown. The estimates start from the job description and
+# conservative defaults, and follow the durations measured for the jobs of
+# the pilot:
+#
+#   stagein   input bytes at the throughput of the recent stage-ins
+#   payload   requested walltime, times the fraction of it recent payloads
+#             used, at the 90th percentile
+#   stageout  seconds of the recent stage-outs, at the 90th percentile
+
+import collections
+import ctypes
+import os
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# estimates without measurements
+DEFAULT_STAGEIN_RATE = 10 * 1024 * 1024
+DEFAULT_PAYLOAD_FRACTION = 1.0
+DEFAULT_STAGEOUT = 60
+
+# measurements kept per phase
+HISTORY = 20
+
+# the phases measured, by the states of the job at their beginning and end
+PHASES = {'stagein': ('validated', 'staged_in'),
+          'payload': ('running', 'executed'),
+          'stageout': ('staging_out', 'finished')}
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _clock_gettime():
+    # in librt for older glibc, in the libc already linked into the interpreter otherwise
+    for library in ('librt.so.1', None):
+        try:
+            clock_gettime = ctypes.CDLL(library, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        return clock_gettime
+    return None
+
+
+_clock = _clock_gettime()
+
+
+def monotonic():
+    """
+    :returns: `float` -- seconds of the monotonic clock, or of the system clock where there is none
+    """
+    if _clock is not None:
+        t = _timespec()
+        # CLOCK_MONOTONIC
+        if _clock(1, ctypes.byref(t)) == 0:
+            return t.tv_sec + t.tv_nsec * 1e-9
+        logger.debug('clock_gettime failed: %s' % os.strerror(ctypes.get_errno()))
+    return time.time()
+
+
+def walltime(job):
+    """
+    :returns: `float` -- seconds the payload of a job may run, its CPU time limit spread over its cores if
+              the job has no walltime limit
+    """
+    if int(job.get('maxWalltime') or 0) > 0:
+        return float(job['maxWalltime'])
+    return float(job.get('maxCpuCount') or 0) / int(job.get('coreCount') or 1)
+
+
+def input_bytes(job):
+    return sum(int(size) for size in str(job.get('fsize') or '').split(',') if size)
+
+
+def _percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+
+class Estimates(object):
+    """
+    Durations of the phases of jobs, estimated from the job descriptions and the durations
+    measured for the jobs of the pilot. Measures the jobs as registry observer.
+    """
+
+    def __init__(self):
+        self.stagein = collections.deque(maxlen=HISTORY)
+        self.payload = collections.deque(maxlen=HISTORY)
+        self.stageout = collections.deque(maxlen=HISTORY)
+        self.jobs = collections.deque(maxlen=HISTORY)
+        self._began = {}
+
+    def observe(self, job, previous, state, now):
+        began = self._began.setdefault(job['PandaID'], {})
+        for phase, (first, last) in PHASES.items():
+            if state == first:
+                began[phase] = now
+            elif state == last and phase in began:
+                self.measured(phase, job, now - began[phase])
+        if state == 'retrieved':
+            began['job'] = now
+        elif state == 'finished' and 'job' in began:
+            self.jobs.append(now - began['job'])
+        if state in ('finished', 'failed'):
+            del self._began[job['PandaID']]
+
+    def measured(self, phase, job, seconds):
+        """
+        Adds the measured duration of a phase of a job.
+        """
+        if phase == 'stagein':
+            self.stagein.append((input_bytes(job), seconds))
+        elif phase == 'payload' and walltime(job) > 0:
+            self.payload.append(seconds / walltime(job))
+        elif phase == 'stageout':
+            self.stageout.append(seconds)
+
+    def estimate(self, job):
+        """
+        :returns: `dict` -- estimated seconds of each phase of a job
+        """
+        stagein_bytes, stagein_seconds = [sum(column) for column in zip(*self.stagein)] or (0, 0)
+        rate = stagein_bytes / stagein_seconds if stagein_bytes and stagein_seconds else DEFAULT_STAGEIN_RATE
+        return {'stagein': input_bytes(job) / rate,
+                'payload': walltime(job) * (_percentile(self.payload, 0.9) if self.payload else DEFAULT_PAYLOAD_FRACTION),
+                'stageout': _percentile(self.stageout, 0.9) if self.stageout else DEFAULT_STAGEOUT}
+
+    def shortest(self):
+        """
+        :returns: `float` -- seconds of the shortest recent job from its retrieval to its end, `None` without any
+        """
+        return min(self.jobs) if self.jobs else None
+
+
+class Lifetime(object):
+    """
+    Deadline of the pilot on the monotonic clock, and the admission of jobs into the time left
+    before the shutdown.
+
+    :param float seconds: lifetime of the pilot
+    :param float grace: seconds at the end of the lifetime taken by the shutdown
+    """
+
+    def __init__(self, seconds, grace=0, clock=monotonic):
+        self.seconds = seconds
+        self.grace = grace
+        self.clock = clock
+        self.start = clock()
+        self.end = self.start + seconds
+        self.estimates = Estimates()
+
+    def elapsed(self):
+        return self.clock() - self.start
+
+    def remaining(self):
+        """
+        :returns: `float` -- seconds left before the shutdown begins
+        """
+        return max(0.0, self.end - self.grace - self.clock())
+
+    def admit(self, job):
+        """
+        :returns: `tuple` -- whether the job fits into the time left, and its estimated seconds
+        """
+        estimate = sum(self.estimates.estimate(job).values())
+        return estimate <= self.remaining(), estimate
+
+    def exhausted(self):
+        """
+        :returns: `bool` -- whether the time left is too short even for the shortest recent job, never before
+                  a job was measured, the admission of each job decides until then
+        """
+        shortest = self.estimates.shortest()
+        return shortest is not None and self.remaining() < shortest
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+# Non-blocking logging. Threads only format the message of a record and put
+# it on a bounded queue; a single writer thread passes the records on to the
+# actual handlers, so that a slow disk or terminal never stalls a transfer or
+# supervision thread. If the queue is full, records are dropped and counted
+# instead of blocking the caller.
+
+import json
+import logging
+import Queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SIZE = 10000
+
+_STOP = object()
+
+
+class QueueHandler(logging.Handler):
+    """
+    Puts records on a queue for the :class:`LogWriter` thread.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        # the arguments and traceback may not survive until the writer thread gets to the record
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging._defaultFormatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class LogWriter(threading.Thread):
+    """
+    Writes the queued records to the handlers, each of which only gets the records at or above its level.
+    """
+
+    def __init__(self, queue, handlers, source=None):
+        threading.Thread.__init__(self, name='logwriter')
+        self.daemon = True
+        self.queue = queue
+        self.handlers = handlers
+        self.source = source
+        self._dropped = 0
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is _STOP:
+                break
+            self._report_dropped()
+            self.handle(record)
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _report_dropped(self):
+        if self.source is not None and self.source.dropped > self._dropped:
+            dropped, self._dropped = self.source.dropped - self._dropped, self.source.dropped
+            self.handle(logger.makeRecord(logger.name, logging.WARNING, __file__, 0,
+                                          'log queue full -- dropped %s messages' % dropped, None, None))
+
+    def stop(self, timeout=10):
+        """
+        Writes out the records still queued, then attaches the handlers to the root logger
+        directly, so that messages logged during the pilot exit are not lost. The handlers
+        replace the queue in one step, so every record goes one way or the other, never both.
+        """
+        self.queue.put(_STOP)
+        self.join(timeout)
+
+        root = logging.getLogger()
+        logging._acquireLock()
+        try:
+            root.handlers = [handler for handler in root.handlers if handler is not self.source] + \
+                            [handler for handler in self.handlers if handler not in root.handlers]
+        finally:
+            logging._releaseLock()
+
+        if self.is_alive():
+            logger.warning('log writer did not stop in %ss' % timeout)
+            return
+        # records queued after the stop, before the handlers were swapped
+        while True:
+            try:
+                record = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if record is not _STOP:
+                self.handle(record)
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats records as single-line JSON objects. Messages of a job logger, named after the
+    PandaID as in ``logger.getChild(str(job['PandaID']))``, carry the PandaID as a field.
+    """
+
+    def format(self, record):
+        entry = {'time': record.created,
+                 'level': record.levelname,
+                 'thread': record.threadName,
+                 'logger': record.name,
+                 'function': record.funcName,
+                 'message': record.getMessage()}
+        pandaid = record.name.rsplit('.', 1)[-1]
+        if pandaid.isdigit():
+            entry['PandaID'] = int(pandaid)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Limits every call site to ``burst`` messages per ``interval`` seconds. Errors are never
+    suppressed. The number of suppressed messages is appended to the next one let through.
+    """
+
+    def __init__(self, burst=60, interval=60, clock=time.time):
+        logging.Filter.__init__(self)
+        self.burst = burst
+        self.interval = interval
+        self.clock = clock
+        self._sites = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+
+        key = (record.pathname, record.lineno)
+        now = self.clock()
+        with self._lock:
+            start, count, suppressed = self._sites.get(key, (now, 0, 0))
+            if now - start >= self.interval:
+                start, count = now, 0
+            if count >= self.burst:
+                self._sites[key] = (start, count, suppressed + 1)
+                return False
+            self._sites[key] = (start, count + 1, 0)
+
+        if suppressed:
+            record.msg = '%s (%s similar messages suppressed)' % (record.getMessage(), suppressed)
+            record.args = None
+        return True
+
+
+def start(handlers, level=logging.INFO, rate=None, size=QUEUE_SIZE):
+    """
+    Routes all logging through a queue and a single writer thread.
+
+    :param handlers: list of handlers the writer thread passes the records to
+    :param level: level of the root logger
+    :param int rate: messages per minute and call site before they are suppressed, `None` for no limit
+    :param int size: maximum number of queued records
+    :returns: the started :class:`LogWriter`
+    """
+    queue = Queue.Queue(size)
+    handler = QueueHandler(queue)
+    if rate:
+        handler.addFilter(RateLimitFilter(burst=rate, interval=60))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+
+    writer = LogWriter(queue, handlers, source=handler)
+    writer.start()
+    return writer
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import bisect
+
+# upper bounds in seconds, from 1 ms to 1 min
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# upper bounds in bytes, from 256 B to 64 MB
+SIZE_BUCKETS = tuple(256 * 4 ** i for i in xrange(10))
+
+
+class Histogram(object):
+    """
+    Fixed-bucket histogram. Observing a value is a binary search over the bucket bounds and a
+    few integer additions, so it is cheap enough to be updated on every request.
+
+    :param bounds: sorted upper bounds of the buckets, values above the last one go to an overflow bucket
+    """
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimates a quantile as the upper bound of the bucket containing it.
+
+        :param float q: quantile between 0 and 1
+        :returns: bucket bound, `float('inf')` for the overflow bucket, or `None` if empty
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[i] if i < len(self.bounds) else float('inf')
+        return float('inf')
+
+    def snapshot(self):
+        """
+        :returns: `dict` -- cumulative bucket counts keyed by upper bound, plus count and sum
+        """
+        buckets = []
+        seen = 0
+        for bound, count in zip(list(self.bounds) + ['+Inf'], self.counts):
+            seen += count
+            buckets.append((bound, seen))
+        return {'buckets': buckets,
+                'count': self.count,
+                'sum': self.sum}
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_labels(labels):
+    """
+    :returns: `str` -- labels in Prometheus text format, e.g. ``{path="/getJob"}``, empty if there are none
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _label_value(labels[name])) for name in sorted(labels))
+
+
+def prometheus_histogram(name, snapshot, labels=None):
+    """
+    Renders a histogram snapshot as Prometheus text format samples.
+
+    :param str name: metric name
+    :param snapshot: `dict` returned by :meth:`Histogram.snapshot`
+    :param labels: `dict` of labels common to all samples
+    :returns: `list` of `str` lines
+    """
+    labels = labels or {}
+    lines = ['%s_bucket%s %s' % (name, prometheus_labels(dict(labels, le=bound)), count) for bound, count in snapshot['buckets']]
+    lines.append('%s_sum%s %s' % (name, prometheus_labels(labels), snapshot['sum']))
+    lines.append('%s_count%s %s' % (name, prometheus_labels(labels), snapshot['count']))
+    return lines
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile of a list of values.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+
+def summarize(values):
+    """
+    :returns: `dict` -- number, mean, median, 90th and 99th percentile and maximum of a list of values
+    """
+    return {'n': len(values),
+            'mean': sum(values) / len(values) if values else None,
+            'p50': percentile(values, 50),
+            'p90': percentile(values, 90),
+            'p99': percentile(values, 99),
+            'max': max(values) if values else None}
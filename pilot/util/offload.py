@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+# Runs CPU-heavy data tasks, like compressing the log tarball or parsing the
+# job report, in a pool of worker processes instead of the pilot process, so
+# that they do not hold the interpreter lock while the control threads send
+# heartbeats and supervise the payload. Without a pool the tasks run in the
+# calling thread.
+#
+# Tasks are module-level functions whose arguments and results are pickled
+# between the processes. They work on files and return small summaries, e.g.
+# the size and checksum of a tarball rather than its content.
+
+import collections
+import os
+import signal
+
+import logging
+logger = logging.getLogger(__name__)
+
+_ctx = collections.namedtuple('_ctx', 'pool workers')
+_ctx.pool = None
+_ctx.workers = 0
+
+
+def _init_worker():
+    # the pilot decides when the workers stop, the signals it handles must not kill them first;
+    # they stay in its process group, so that a SIGKILL of the batch system does not leave them behind
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def setup(workers):
+    """
+    Starts the worker processes. They are forked from the calling process, so call this before
+    any other threads are started.
+
+    :param int workers: number of worker processes, 0 runs the tasks in the calling thread
+    """
+    if workers > 0:
+        # only loaded with workers, it takes a while to import
+        import multiprocessing.pool
+
+        class Worker(multiprocessing.Process):
+            def terminate(self):
+                # the workers ignore SIGTERM, which the pool terminates them with
+                os.kill(self.pid, signal.SIGKILL)
+
+        class Pool(multiprocessing.pool.Pool):
+            Process = Worker
+
+        _ctx.pool = Pool(workers, _init_worker)
+        _ctx.workers = workers
+
+
+def call(func, *args):
+    """
+    Runs ``func(*args)`` in a worker process, and waits for the result.
+
+    :param func: module-level function, so that it can be pickled
+    :returns: the result of the function
+    :raises: any exception raised by the function
+    """
+    if _ctx.pool is None:
+        return func(*args)
+
+    result = _ctx.pool.apply_async(func, args)
+    # waits with a timeout stay interruptible
+    while not result.ready():
+        result.wait(1)
+    return result.get()
+
+
+def stop():
+    """
+    Stops the worker processes, abandoning any tasks still running.
+    """
+    if _ctx.pool is not None:
+        _ctx.pool.terminate()
+        _ctx.pool.join()
+        _ctx.pool = None
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+# Statistical profiler for the pilot threads. A background thread takes the
+# current stack of every other thread at a fixed rate and counts identical
+# stacks per thread name. Nothing is traced between samples, so the overhead
+# only depends on the sampling rate and the pilot can be profiled in
+# production. The result is written in the collapsed stack format read by
+# flame graph tools, one line per stack:
+#
+#   retrieve;pilot.control.job.retrieve;pilot.util.https.request;... 42
+
+import collections
+import sys
+import threading
+
+from pilot.util.filehandling import write_atomic
+
+import logging
+logger = logging.getLogger(__name__)
+
+MAX_DEPTH = 64
+
+
+def collapse(frame, max_depth=MAX_DEPTH):
+    """
+    :returns: `str` -- the stack of a frame as semicolon-separated `module.function` names, outermost first
+    """
+    names = []
+    while frame is not None and len(names) < max_depth:
+        names.append('%s.%s' % (frame.f_globals.get('__name__', '?'), frame.f_code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Samples the stacks of all threads while enabled. Samples are accumulated over all the
+    periods the profiler is enabled, and written whenever it is disabled.
+
+    :param float interval: seconds between samples
+    :param str filename: output file of :meth:`dump`
+    """
+
+    def __init__(self, interval=0.1, filename='pilot_profile.txt'):
+        threading.Thread.__init__(self, name='profiler')
+        self.daemon = True
+        self.interval = interval
+        self.filename = filename
+        self.samples = collections.defaultdict(int)
+        self.enabled = threading.Event()
+        self._halt = threading.Event()
+        self._dump = False
+        self._lock = threading.Lock()
+
+    def run(self):
+        while not self._halt.is_set():
+            if self.enabled.is_set():
+                self.sample()
+                self._halt.wait(self.interval)
+                continue
+            # written here rather than in disable(), which may run in a signal handler
+            if self._dump:
+                self._dump = False
+                self.dump()
+            self.enabled.wait(1)
+
+    def sample(self):
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        stacks = [(names.get(ident, str(ident)), collapse(frame))
+                  for ident, frame in sys._current_frames().items() if ident != self.ident]
+        with self._lock:
+            for name, stack in stacks:
+                self.samples['%s;%s' % (name, stack)] += 1
+
+    def enable(self):
+        self.enabled.set()
+
+    def disable(self):
+        self._dump = True
+        self.enabled.clear()
+
+    def toggle(self, *args):
+        """
+        Enables or disables sampling, usable as signal handler.
+        """
+        if self.enabled.is_set():
+            self.disable()
+        else:
+            self.enable()
+
+    def stop(self):
+        """
+        Stops the profiler thread and writes the profile if anything was sampled since the last write.
+        """
+        dump = self._dump or self.enabled.is_set()
+        self.enabled.clear()
+        self._halt.set()
+        self.join()
+        if dump or self._dump:
+            self.dump()
+
+    def dump(self, filename=None):
+        """
+        Atomically writes the collapsed stacks collected so far.
+        """
+        filename = filename or self.filename
+        with self._lock:
+            lines = ['%s %s\n' % (stack, count) for stack, count in sorted(self.samples.items())]
+        try:
+            write_atomic(filename, lines)
+            logger.info('profiler wrote %s stacks to %s' % (len(lines), filename))
+        except (OSError, IOError) as e:
+            logger.warning('could not write profile: %s' % str(e))
+
+
+def start(interval, filename, enabled=False):
+    """
+    Starts the profiler thread, sampling right away if ``enabled``.
+    """
+    profiler = SamplingProfiler(interval, filename)
+    profiler.start()
+    if enabled:
+        profiler.enable()
+    logger.info('profiler ready -- sampling every %ss while enabled, writing to %s' % (interval, filename))
+    return profiler
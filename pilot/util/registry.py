@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+# Central registry of the jobs of a pilot. Every job is in exactly one state
+# and moves through the states of the workflow by explicit transitions:
+#
+#   retrieved -> validated -> staged_in -> prepared -> running -> executed -> staging_out -> finished
+#
+# and from any state to failed. A controller waits for the jobs entering the
+# state it handles with next(state), which blocks until there is one, and
+# hands the job on with transition(). Running jobs are not queued, the
+# controller starting the payload hands them on itself. Jobs reaching
+# finished or failed are retired from the registry, only their counts are
+# kept; failed jobs are still handed to a controller, to report them to the
+# server.
+#
+# The time a job entered its state and the time a controller picked it up
+# from the queue of that state are kept, so the time jobs spend waiting in
+# every queue can be told apart from the time they are worked on.
+
+import collections
+import Queue
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+STATES = ('retrieved', 'validated', 'staged_in', 'prepared', 'running', 'executed', 'staging_out', 'finished', 'failed')
+TERMINAL = ('finished', 'failed')
+
+# the regular successor of every state, failed can be reached from any state that is not terminal
+TRANSITIONS = dict(zip(STATES[:-2], STATES[1:-1]))
+
+# states without a controller waiting for their jobs: the one starting the payload hands running
+# jobs on itself, and nothing is left to do for finished ones
+UNQUEUED = ('running', 'finished')
+
+
+class TransitionError(Exception):
+    pass
+
+
+class JobRegistry(object):
+    """
+    Jobs by PandaID with their state, and the queues of jobs waiting to be handled in each state.
+
+    :param clock: function returning the time of the transitions
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._jobs = {}
+        self._states = {}
+        self._since = {}
+        self._picked = {}
+        self._queues = dict((state, Queue.Queue()) for state in STATES if state not in UNQUEUED)
+        self._observers = []
+        self._retired = collections.defaultdict(int)
+        self._closed = set()
+        self._lock = threading.Lock()
+
+    def add(self, job, state='retrieved'):
+        """
+        Registers a job retrieved from the server, or a job of a previous pilot in the state it
+        continues from. Failed jobs are retired at once, and only handed on to be reported.
+
+        :raises TransitionError: if the job is already registered or the state is not queued
+        """
+        if state not in self._queues:
+            raise TransitionError('job %s cannot be added in state %s' % (job['PandaID'], state))
+        now = self.clock()
+        with self._lock:
+            if job['PandaID'] in self._jobs:
+                raise TransitionError('job %s is already registered' % job['PandaID'])
+            if state == 'failed':
+                self._retired[state] += 1
+            else:
+                self._jobs[job['PandaID']] = job
+                self._states[job['PandaID']] = state
+                self._since[job['PandaID']] = now
+        self._notify(job, None, state, now)
+
+    def transition(self, job, state):
+        """
+        Moves a job to a new state and hands it to the controller waiting for that state. A job
+        moved to a state that was closed fails instead, as nothing would handle it anymore.
+
+        :raises TransitionError: if the job is not registered or the transition is not legal
+        """
+        panda_id = job['PandaID']
+        now = self.clock()
+        with self._lock:
+            if panda_id not in self._jobs:
+                raise TransitionError('job %s is not registered' % panda_id)
+            previous = self._states[panda_id]
+            if state != TRANSITIONS.get(previous) and state != 'failed':
+                raise TransitionError('job %s cannot go from %s to %s' % (panda_id, previous, state))
+            if state in self._closed and state != 'failed':
+                job.setdefault('errmsg', 'abandoned at shutdown')
+                state = 'failed'
+            if state in TERMINAL:
+                del self._jobs[panda_id], self._states[panda_id], self._since[panda_id]
+                self._retired[state] += 1
+            else:
+                self._states[panda_id] = state
+                self._since[panda_id] = now
+        self._notify(job, previous, state, now)
+
+    def fail(self, job, errmsg=None):
+        """
+        Moves a job to failed, keeping the first error message.
+        """
+        if errmsg is not None:
+            job.setdefault('errmsg', errmsg)
+        self.transition(job, 'failed')
+
+    def _notify(self, job, previous, state, now):
+        logger.getChild(str(job['PandaID'])).debug('job state %s -> %s' % (previous, state))
+        with self._lock:
+            observers = list(self._observers)
+        for observer in observers:
+            try:
+                observer(job, previous, state, now)
+            except Exception as e:
+                logger.warning('job state observer failed: %s' % str(e))
+        self._picked.pop(job['PandaID'], None)
+        if state not in self._queues:
+            return
+        # queued under the lock of close(), so that a job is either drained by it or not queued at all
+        with self._lock:
+            closed = state in self._closed
+            if not closed:
+                self._queues[state].put(job)
+        if not closed:
+            return
+        if state == 'failed':
+            logger.getChild(str(job['PandaID'])).warning('job failed after the shutdown stopped the reporting -- not reported')
+        else:
+            self.fail(job, 'abandoned at shutdown')
+
+    def next(self, state, timeout=None):
+        """
+        Waits for a job entering a state. Each job is handed to one caller only.
+
+        :param float timeout: seconds to wait at most, forever if `None`
+        :returns: the job, or `None` if the registry was closed or the timeout expired
+        """
+        try:
+            job = self._queues[state].get(timeout=timeout)
+        except Queue.Empty:
+            return None
+        if job is None:
+            # wake up the next caller waiting for this state as well
+            self._queues[state].put(None)
+        elif state not in TERMINAL:
+            self._picked[job['PandaID']] = self.clock()
+        return job
+
+    def observe(self, observer):
+        """
+        Calls ``observer(job, previous, state, time)`` on every transition, in the thread making it.
+        """
+        with self._lock:
+            self._observers.append(observer)
+
+    def close(self, states=None):
+        """
+        Releases all callers waiting in :meth:`next` for the given states, for which it returns
+        `None` from now on.
+
+        :param states: states to close, all if `None`
+        :returns: `list` of the jobs that were still waiting to be handled in these states
+        """
+        waiting = []
+        with self._lock:
+            states = [state for state in (states or self._queues) if state in self._queues and state not in self._closed]
+            self._closed.update(states)
+            for state in states:
+                while True:
+                    try:
+                        job = self._queues[state].get_nowait()
+                    except Queue.Empty:
+                        break
+                    if job is not None:
+                        waiting.append(job)
+                self._queues[state].put(None)
+        return waiting
+
+    @property
+    def closed(self):
+        return len(self._closed) == len(self._queues)
+
+    def get(self, panda_id):
+        """
+        :returns: the job with this PandaID, or `None` if it is unknown or retired
+        """
+        return self._jobs.get(panda_id)
+
+    def state(self, panda_id):
+        """
+        :returns: `str` -- the state of the job, or `None` if it is unknown or retired
+        """
+        return self._states.get(panda_id)
+
+    def picked(self, panda_id):
+        """
+        :returns: `float` -- time a controller picked the job up in its current state, or `None` if it is still waiting
+        """
+        return self._picked.get(panda_id)
+
+    def jobs(self):
+        """
+        :returns: `list` of (job, state, seconds in state) of all jobs not yet retired
+        """
+        now = self.clock()
+        with self._lock:
+            return [(self._jobs[panda_id], self._states[panda_id], now - self._since[panda_id]) for panda_id in self._jobs]
+
+    def counts(self):
+        """
+        :returns: `dict` -- number of jobs by state, the finished and failed ones counted since the start
+        """
+        with self._lock:
+            counts = dict((state, 0) for state in STATES)
+            for state in self._states.itervalues():
+                counts[state] += 1
+            for state in TERMINAL:
+                counts[state] = self._retired[state]
+        return counts
+
+    def backlog(self):
+        """
+        :returns: `dict` -- number of jobs waiting to be handled by state
+        """
+        return dict((state, max(0, queue.qsize() - (state in self._closed))) for state, queue in self._queues.items())
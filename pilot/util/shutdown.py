@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+# Ordered shutdown of the pilot. Once requested, by a signal or at the end of
+# the lifetime, the shutdown goes through its phases one after the other:
+#
+#   fetch     stop fetching jobs, fail the jobs that have not started yet
+#   payload   terminate the running payloads
+#   stageout  let the stage-outs and the final state updates finish
+#   exit      stop everything else
+#
+# Every phase has to be over by a deadline, a fixed share of the time left
+# for the shutdown, after which the coordinator moves on regardless. Whatever
+# could not be finished is reported as abandoned.
+
+import threading
+import time
+
+from pilot.util.registry import STATES
+
+import logging
+logger = logging.getLogger(__name__)
+
+PHASES = ('fetch', 'payload', 'stageout', 'exit')
+
+# share of the grace period by the end of which each phase has to be over
+SHARES = {'fetch': 0.0,
+          'payload': 0.3,
+          'stageout': 0.9,
+          'exit': 1.0}
+
+# jobs in these states have not started their payload yet
+NOT_STARTED = STATES[:STATES.index('running')]
+
+
+class Shutdown(object):
+    """
+    Coordinates the shutdown phases. Controllers wait on the event of the phase that stops
+    them, see :meth:`stopping`; the event of the exit phase is the pilot graceful stop.
+
+    :param graceful_stop: event of the exit phase
+    :param float grace: seconds the shutdown may take at most
+    :param float end: time at which the batch slot ends, on the clock given, `None` if unknown
+    """
+
+    def __init__(self, graceful_stop, grace=60, end=None, clock=time.time):
+        self.grace = grace
+        self.end = end
+        self.clock = clock
+        self.events = dict((phase, threading.Event()) for phase in PHASES)
+        self.events['exit'] = graceful_stop
+        self.reason = None
+        self.start = None
+        self.available = None
+        self.phases = {}
+
+    def request(self, reason):
+        """
+        Requests the shutdown, only the first request counts. Safe to call from a signal handler.
+        """
+        if self.reason is None:
+            self.reason = reason
+
+    def stopping(self, phase):
+        """
+        :returns: `threading.Event` set when the phase begins
+        """
+        return self.events[phase]
+
+    def deadline(self, phase):
+        """
+        :returns: time by which the phase has to be over, `None` before the shutdown
+        """
+        if self.start is None:
+            return None
+        return self.start + SHARES[phase] * self.available
+
+    def remaining(self, phase):
+        """
+        :returns: `float` -- seconds left until the deadline of the phase, or the full grace period before the shutdown
+        """
+        if self.start is None:
+            return self.grace
+        return max(0.0, self.deadline(phase) - self.clock())
+
+    def wait_requested(self, poll=0.5):
+        # signal handlers only set the reason, so poll for it
+        while self.reason is None:
+            time.sleep(poll)
+
+    def run(self, registry, threads):
+        """
+        Goes through the shutdown phases.
+
+        :param registry: `JobRegistry` of the pilot
+        :param threads: controller threads to wait for in the exit phase
+        :returns: `dict` -- the shutdown report, with the abandoned jobs and threads
+        """
+        self.start = self.clock()
+        self.available = self.grace if self.end is None else max(0.0, min(self.grace, self.end - self.start))
+        logger.warning('shutdown (%s) -- %.0fs to finish' % (self.reason, self.available))
+
+        self._begin('fetch')
+        for job in registry.close(NOT_STARTED):
+            registry.fail(job, 'abandoned at shutdown')
+
+        self._begin('payload')
+        self._wait(lambda: not registry.counts()['running'], 'payload')
+
+        self._begin('stageout')
+        self._wait(lambda: not registry.jobs() and not registry.backlog()['failed'], 'stageout')
+
+        self._begin('exit')
+        waiting = registry.close()
+        for thread in threads:
+            thread.join(self.remaining('exit'))
+        self._end('exit')
+
+        report = {'reason': self.reason,
+                  'available': self.available,
+                  'phases': self.phases,
+                  'abandoned': [{'PandaID': job['PandaID'], 'state': state} for job, state, since in registry.jobs()],
+                  'threads': [thread.name for thread in threads if thread.is_alive()]}
+        report['abandoned'].extend({'PandaID': job['PandaID'], 'state': 'failed'} for job in waiting if job['PandaID'] not in
+                                   [abandoned['PandaID'] for abandoned in report['abandoned']])
+
+        for abandoned in report['abandoned']:
+            logger.warning('shutdown abandoned job %s in state %s' % (abandoned['PandaID'], abandoned['state']))
+        if report['threads']:
+            logger.warning('shutdown abandoned threads: %s' % ', '.join(report['threads']))
+        logger.info('shutdown done in %.1fs' % (self.clock() - self.start))
+        return report
+
+    def _begin(self, phase):
+        if self.phases:
+            self._end(PHASES[PHASES.index(phase) - 1])
+        logger.info('shutdown phase %s -- %.1fs left' % (phase, self.remaining(phase)))
+        self.phases[phase] = self.clock()
+        self.events[phase].set()
+
+    def _end(self, phase):
+        self.phases[phase] = self.clock() - self.phases[phase]
+
+    def _wait(self, done, phase, poll=0.1):
+        while not done():
+            if self.clock() >= self.deadline(phase):
+                logger.warning('shutdown phase %s did not finish in time' % phase)
+                return False
+            time.sleep(poll)
+        return True
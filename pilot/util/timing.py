@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+import __builtin__
+import collections
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# phases of a job timed by the controllers, in the order they run; the time a job waits in the
+# queue of a state until a controller picks it up is recorded as wait.<state>
+JOB_PHASES = ('fetch', 'validate', 'stagein', 'setup', 'payload', 'report', 'log', 'stageout', 'final_update')
+
+
+class PhaseTimer(object):
+    """
+    Times the phases of the pilot startup against a latency budget. Phases may
+    run concurrently; each one is logged when it ends, together with the time
+    elapsed since the timer was created, and a warning is given once that
+    exceeds the budget.
+
+    :param budget: startup budget in seconds, `None` to only log at debug level
+    """
+
+    def __init__(self, budget=None, clock=time.time):
+        self.budget = budget
+        self.clock = clock
+        self.start = clock()
+        self.phases = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, start)
+
+    def record(self, name, start, end=None):
+        """
+        Records a phase that ran from ``start`` until ``end``, or until now.
+        """
+        end = self.clock() if end is None else end
+        elapsed = end - self.start
+        with self._lock:
+            self.phases[name] = end - start
+
+        if self.budget is None:
+            logger.debug('startup phase %s took %.3fs' % (name, end - start))
+        elif elapsed > self.budget:
+            logger.warning('startup phase %s took %.3fs -- %.3fs since startup exceed the budget of %ss'
+                           % (name, end - start, elapsed, self.budget))
+        else:
+            logger.info('startup phase %s took %.3fs -- %.3fs since startup, budget %ss' % (name, end - start, elapsed, self.budget))
+
+    def elapsed(self):
+        return self.clock() - self.start
+
+    def summary(self):
+        """
+        :returns: `dict` -- duration of every phase so far, and the elapsed time in total
+        """
+        with self._lock:
+            phases = dict(self.phases)
+        return {'phases': phases,
+                'elapsed': self.elapsed(),
+                'budget': self.budget}
+
+
+class ImportProfiler(object):
+    """
+    Measures the cost of every module loaded while it is installed, by wrapping the builtin
+    ``__import__``. For each module the inclusive time, with everything it imports itself,
+    and the exclusive time, of its own body only, are recorded.
+
+    Install it before the modules of interest are imported, and uninstall it once startup is
+    over, as the wrapper adds a little overhead to every import statement executed afterwards.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.modules = collections.OrderedDict()
+        self._import = None
+        self._local = threading.local()
+
+    def install(self):
+        self._import = __builtin__.__import__
+        __builtin__.__import__ = self._profiled_import
+        return self
+
+    def uninstall(self):
+        if self._import is not None:
+            __builtin__.__import__ = self._import
+            self._import = None
+
+    def _profiled_import(self, name, globals=None, locals=None, fromlist=None, level=-1):
+        stack = self._local.__dict__.setdefault('stack', [])
+        # only real modules count, failed implicit relative imports leave `None` in sys.modules
+        loaded = self._loaded(name, fromlist)
+        stack.append(0)
+        start = self.clock()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            inclusive = self.clock() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += inclusive
+            if self._loaded(name, fromlist) > loaded and name not in self.modules:
+                importer = globals.get('__name__') if globals else None
+                self.modules[name] = {'inclusive': inclusive,
+                                      'exclusive': inclusive - nested,
+                                      'importer': importer}
+
+    @staticmethod
+    def _loaded(name, fromlist):
+        names = [name] + ['%s.%s' % (name, item) for item in fromlist or () if item != '*']
+        return len([module for module in names if sys.modules.get(module) is not None])
+
+    def report(self, top=None):
+        """
+        :param int top: number of modules to return, all if `None`
+        :returns: `list` of `dict` -- modules by decreasing exclusive import time
+        """
+        modules = [dict(self.modules[name], module=name) for name in self.modules]
+        modules.sort(key=lambda module: module['exclusive'], reverse=True)
+        return modules[:top]
+
+
+def dump_profile(filename, timer, profiler=None, top=10):
+    """
+    Logs the most expensive imports and writes the startup phases and all import times to a JSON file.
+    """
+    imports = profiler.report() if profiler is not None else []
+    for module in imports[:top]:
+        logger.info('import %s took %.1fms (%.1fms including its imports)'
+                    % (module['module'], module['exclusive'] * 1000, module['inclusive'] * 1000))
+    try:
+        with open(filename, 'w') as outfile:
+            json.dump({'startup': timer.summary(), 'imports': imports}, outfile, indent=2)
+    except IOError as e:
+        logger.warning('could not write startup profile: %s' % str(e))
+
+
+def record(job, phase, seconds):
+    """
+    Adds the seconds spent in a phase to the timing of a job, kept in ``job['timing']``.
+    """
+    timing = job.setdefault('timing', {})
+    timing[phase] = timing.get(phase, 0) + seconds
+
+
+@contextlib.contextmanager
+def timed(job, phase, clock=time.time):
+    start = clock()
+    try:
+        yield
+    finally:
+        record(job, phase, clock() - start)
+
+
+def pilot_timing(timing):
+    """
+    :returns: `str` -- the timing of a job as the PanDA server expects it, in whole seconds:
+              getJob|stagein|exec|stageout|setup
+    """
+    def seconds(*phases):
+        return int(round(sum(timing.get(phase, 0) for phase in phases)))
+
+    return '%s|%s|%s|%s|%s' % (seconds('fetch'), seconds('stagein'), seconds('payload'),
+                               seconds('log', 'stageout'), seconds('validate', 'setup', 'report'))
+
+
+class JobTimer(object):
+    """
+    Job state observer, see :meth:`pilot.util.registry.JobRegistry.observe`, recording the time
+    every job waits in the queue of each state, and keeping the timing of the jobs that ended for
+    a summary at pilot exit. The timing of a job stays shared with the job, so the final update of
+    a failed job, made after it was retired, is still counted.
+
+    :param registry: the job registry, for the time the jobs are picked up
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.jobs = {}
+        self._start = {}
+        self._entered = {}
+        self._lock = threading.Lock()
+
+    def observe(self, job, previous, state, now):
+        # this module hosts the import profiler, it imports no other pilot modules at its top
+        from pilot.util.registry import TERMINAL
+
+        panda_id = job['PandaID']
+        timing = job.setdefault('timing', {})
+        with self._lock:
+            if previous is None:
+                self._start[panda_id] = now - timing.get('fetch', 0)
+            else:
+                picked = self.registry.picked(panda_id)
+                if picked is not None and panda_id in self._entered:
+                    record(job, 'wait.%s' % previous, picked - self._entered[panda_id])
+            if state in TERMINAL:
+                self._entered.pop(panda_id, None)
+                # jobs resumed after a restart add to the time of the previous pilot
+                timing['total'] = timing.get('total', 0) + now - self._start.pop(panda_id, now)
+                self.jobs[panda_id] = (state, timing)
+            else:
+                self._entered[panda_id] = now
+
+    def summary(self):
+        """
+        :returns: `dict` -- percentiles of every phase over the jobs that ended, the pilot overhead
+                  around the payloads, and the CPU time of the pilot against that of its children
+        """
+        from pilot.util.metrics import summarize
+        from pilot.util.registry import TERMINAL
+
+        with self._lock:
+            jobs = dict(self.jobs)
+        phases = {}
+        for state, timing in jobs.values():
+            for phase, seconds in timing.items():
+                phases.setdefault(phase, []).append(seconds)
+        overhead = [timing['total'] - timing.get('payload', 0) for state, timing in jobs.values() if 'total' in timing]
+        times = os.times()
+        return {'jobs': dict((state, len([job for job in jobs.values() if job[0] == state])) for state in TERMINAL),
+                'phases': dict((phase, summarize(values)) for phase, values in phases.items()),
+                'overhead': summarize(overhead),
+                'cpu': {'pilot': times[0] + times[1],
+                        'children': times[2] + times[3]},
+                'breakdown': dict((str(panda_id), timing) for panda_id, (state, timing) in jobs.items())}
+
+    def dump(self, filename):
+        """
+        Logs the percentiles of every phase and writes the summary to a JSON file.
+        """
+        summary = self.summary()
+        for phase in JOB_PHASES + tuple(sorted(phase for phase in summary['phases'] if phase not in JOB_PHASES)):
+            if phase in summary['phases']:
+                logger.info('job %s: p50 %.1fs p90 %.1fs max %.1fs over %s jobs'
+                            % (phase, summary['phases'][phase]['p50'], summary['phases'][phase]['p90'],
+                               summary['phases'][phase]['max'], summary['phases'][phase]['n']))
+        logger.info('pilot cpu %.1fs, payload and copytool cpu %.1fs' % (summary['cpu']['pilot'], summary['cpu']['children']))
+        try:
+            with open(filename, 'w') as outfile:
+                json.dump(summary, outfile, indent=2, sort_keys=True)
+        except IOError as e:
+            logger.warning('could not write job timing: %s' % str(e))
+        return summary
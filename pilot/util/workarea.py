@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+# Working directories of the jobs. A job runs in job-<PandaID> in the pilot
+# directory, which is either the directory itself or a symlink to a directory
+# on the fastest scratch given with --scratch that the job fits on:
+#
+#   tmpfs                   memory, fastest
+#   local SSD               non-rotational block device
+#   local disk              rotational or unknown block device
+#   pilot directory         always, if no scratch fits
+#
+# Scratch is only what is given, as e.g. a tmpfs takes the memory of the node
+# the payloads may need. Network filesystems are never used. A job fits if the free space
+# left, after what the jobs already placed there may still need, covers its
+# inputs, as much again for its outputs and a headroom, which stays reserved
+# until the job finished or failed, also for the jobs resumed from a previous
+# pilot. The symlink keeps the relative paths of the controllers and the
+# checkpoints working wherever the directory really is.
+#
+# Once the server confirmed the final state of a job, its directory is removed
+# in the background. The directories of failed jobs, without their inputs and
+# outputs, are moved to a directory for debugging instead, of which the oldest
+# are removed beyond a size limit.
+
+import glob
+import os
+import Queue
+import shutil
+import tempfile
+import threading
+
+from pilot.util.registry import TERMINAL
+
+import logging
+logger = logging.getLogger(__name__)
+
+# filesystem types by speed, lower is faster
+TMPFS, SSD, DISK = 0, 1, 2
+
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smbfs', 'afs', 'lustre', 'gpfs', 'ceph', 'glusterfs', 'beegfs', 'cvmfs', 'eos', 'fuse')
+
+HEADROOM = 2 * 1024 * 1024 * 1024
+
+
+def _mounts(path='/proc/mounts'):
+    try:
+        with open(path) as mounts:
+            return [line.split()[:3] for line in mounts if len(line.split()) > 2]
+    except IOError:
+        return []
+
+
+def _rotational(device):
+    # /dev/sda1 -> sda, /dev/nvme0n1p1 -> nvme0n1
+    name = os.path.basename(os.path.realpath(device))
+    while name and not os.path.exists('/sys/block/%s' % name):
+        if os.path.exists('/sys/class/block/%s/partition' % name):
+            name = os.path.basename(os.path.dirname(os.path.realpath('/sys/class/block/%s' % name)))
+        else:
+            return None
+    try:
+        with open('/sys/block/%s/queue/rotational' % name) as rotational:
+            return rotational.read().strip() == '1'
+    except IOError:
+        return None
+
+
+def classify(path, mounts=None):
+    """
+    :returns: `int` -- speed of the filesystem of a directory, ``TMPFS``, ``SSD`` or ``DISK``,
+              or `None` if it is a network filesystem
+    """
+    path = os.path.realpath(path)
+    best = None
+    for mount in mounts if mounts is not None else _mounts():
+        device, mount_point, fstype = mount
+        if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and (best is None or len(mount_point) > len(best[1])):
+            best = mount
+    if best is None:
+        return DISK
+    device, mount_point, fstype = best
+    if fstype in ('tmpfs', 'ramfs'):
+        return TMPFS
+    if fstype.split('.')[0] in NETWORK_FILESYSTEMS:
+        return None
+    if device.startswith('/dev/') and _rotational(device) is False:
+        return SSD
+    return DISK
+
+
+def size(path, exclude=()):
+    """
+    :param exclude: names of the files and directories not counted
+    :returns: `int` -- bytes of all files below a directory, symlinks not followed
+    """
+    total = 0
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [name for name in dirs if name not in exclude]
+        for name in files:
+            if name in exclude:
+                continue
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class WorkArea(object):
+    """
+    Places the working directories of the jobs, and removes them once the jobs are done.
+
+    :param scratch: candidate scratch directories
+    :param int headroom: bytes a job needs besides its inputs and outputs
+    :param str failed_dir: directory for the directories of failed jobs, `None` to remove them as well
+    :param int failed_size: bytes the directories of failed jobs may take together, 0 to remove them as well
+    :param str directory: pilot directory
+    """
+
+    def __init__(self, scratch=(), headroom=HEADROOM, failed_dir='failed_jobs', failed_size=100 * 1024 * 1024, directory='.'):
+        self.headroom = headroom
+        self.failed_dir = failed_dir if failed_size > 0 else None
+        self.failed_size = failed_size
+        self.directory = directory
+        self.scratch = []
+        for path in scratch:
+            speed = classify(path)
+            if speed is None:
+                logger.warning('ignoring scratch %s on a network filesystem' % path)
+            elif not os.path.isdir(path) or not os.access(path, os.W_OK | os.X_OK):
+                logger.warning('ignoring scratch %s -- not a writable directory' % path)
+            else:
+                self.scratch.append((speed, path))
+        # sort is stable, so equally fast scratch is used in the order given
+        self.scratch.sort(key=lambda candidate: candidate[0])
+
+        # scratch of a previous pilot that did not survive, e.g. tmpfs after a reboot
+        for link in glob.glob(os.path.join(directory, 'job-*')):
+            if os.path.islink(link) and not os.path.exists(link):
+                logger.warning('removing %s -- its working directory is gone' % link)
+                os.unlink(link)
+
+        self._reserved = {}
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='workarea')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def need(self, job):
+        """
+        :returns: `int` -- bytes a job needs: its inputs, as much again for its outputs, and the headroom
+        """
+        try:
+            inputs = sum(int(nbytes) for nbytes in str(job.get('fsize') or '').split(',') if nbytes.strip())
+        except ValueError:
+            inputs = 0
+        return 2 * inputs + self.headroom
+
+    def _available(self, path):
+        stat = os.statvfs(path)
+        reserved = sum(need for scratch, need in self._reserved.values() if scratch == path)
+        return stat.f_bavail * stat.f_frsize - reserved
+
+    def place(self, job):
+        """
+        Creates the working directory of a job, on the fastest scratch it fits on.
+
+        :returns: `str` -- job-<PandaID>, relative to the pilot directory
+        :raises OSError: if the directory cannot be created
+        """
+        log = logger.getChild(str(job['PandaID']))
+        name = 'job-%s' % job['PandaID']
+        link = os.path.join(self.directory, name)
+        need = self.need(job)
+
+        with self._lock:
+            for speed, scratch in self.scratch:
+                try:
+                    if self._available(scratch) < need:
+                        continue
+                    path = tempfile.mkdtemp(prefix='%s-' % name, dir=scratch)
+                except OSError as e:
+                    log.warning('cannot use scratch %s: %s' % (scratch, str(e)))
+                    continue
+                try:
+                    os.symlink(os.path.abspath(path), link)
+                except OSError:
+                    os.rmdir(path)
+                    raise
+                self._reserved[job['PandaID']] = (scratch, need)
+                log.info('working directory on scratch %s, %s bytes needed' % (path, need))
+                return name
+
+        os.mkdir(link)
+        log.debug('working directory in the pilot directory, %s bytes needed' % need)
+        return name
+
+    def resume(self, job):
+        """
+        Reserves the space of a job of a previous pilot again, if its working directory is on scratch.
+        """
+        link = os.path.join(self.directory, job.get('working_dir') or 'job-%s' % job['PandaID'])
+        if not os.path.islink(link):
+            return
+        path = os.path.realpath(link)
+        for speed, scratch in self.scratch:
+            if path.startswith(os.path.realpath(scratch).rstrip('/') + '/'):
+                with self._lock:
+                    self._reserved[job['PandaID']] = (scratch, self.need(job))
+                return
+
+    def clean_up(self, job, keep=False):
+        """
+        Removes the working directory of a job in the background, or moves it to the directory
+        of failed jobs if ``keep`` is given.
+        """
+        if 'working_dir' in job:
+            self._queue.put((job, keep))
+
+    def observe(self, job, previous, state, now):
+        """
+        Registry observer releasing the space reserved for the jobs that finished or failed, and
+        cleaning up the directories of the finished jobs the server confirmed.
+        """
+        if state in TERMINAL:
+            with self._lock:
+                self._reserved.pop(job['PandaID'], None)
+        if state == 'finished' and job.get('reported'):
+            self.clean_up(job)
+
+    def stop(self, timeout=None):
+        """
+        Waits for the directories cleaned up so far to be removed.
+        """
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning('job directories are still being removed -- leaving them behind')
+
+    def _run(self):
+        for job, keep in iter(self._queue.get, None):
+            try:
+                if keep and self.failed_dir is not None:
+                    self._keep(job)
+                else:
+                    self._remove(job)
+            except (IOError, OSError, shutil.Error) as e:
+                logger.getChild(str(job['PandaID'])).warning('cannot clean up working directory: %s' % str(e))
+
+    def _remove(self, job):
+        link = os.path.join(self.directory, job['working_dir'])
+        if os.path.islink(link):
+            shutil.rmtree(os.path.realpath(link), ignore_errors=True)
+            os.unlink(link)
+        elif os.path.isdir(link):
+            shutil.rmtree(link)
+        logger.getChild(str(job['PandaID'])).debug('removed working directory')
+
+    def _keep(self, job):
+        log = logger.getChild(str(job['PandaID']))
+        link = os.path.join(self.directory, job['working_dir'])
+        destination = os.path.join(self.failed_dir, os.path.basename(job['working_dir']))
+
+        # the inputs and outputs are large, the inputs can be downloaded again and the outputs are lost with the job
+        files = set(name for key in ('inFiles', 'outFiles', 'logFile') for name in str(job.get(key) or '').split(',') if name)
+        nbytes = size(link, files)
+        if nbytes > self.failed_size:
+            log.warning('not keeping working directory -- %s bytes, %s allowed' % (nbytes, self.failed_size))
+            self._remove(job)
+            return
+
+        if not os.path.isdir(self.failed_dir):
+            os.makedirs(self.failed_dir)
+        if os.path.exists(destination):
+            shutil.rmtree(destination)
+        shutil.copytree(link, destination, symlinks=True, ignore=lambda directory, names: [name for name in names if name in files])
+        os.utime(destination, None)
+        self._remove(job)
+        log.info('kept working directory in %s' % destination)
+
+        # the oldest go first, never the one just kept
+        kept = []
+        for name in os.listdir(self.failed_dir):
+            path = os.path.join(self.failed_dir, name)
+            if path != destination and os.path.isdir(path) and not os.path.islink(path):
+                kept.append((os.path.getmtime(path), path, size(path)))
+        kept.sort()
+        total = nbytes + sum(entry[2] for entry in kept)
+        while kept and total > self.failed_size:
+            mtime, path, nbytes = kept.pop(0)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= nbytes
+            log.info('removed failed job directory %s, %s bytes kept' % (path, total))
@@ -5,12 +5,15 @@
 # http://www.apache.org/licenses/LICENSE-2.0
 #
 # Authors:
-# - Mario Lassnig, mario.lassnig@cern.ch, 2016
+# - Mario Lassnig, mario.lassnig@cern.ch, 2016-2017
+
+# analysis jobs on HPC allocations run like any other, see pilot.workflow.generic_hpc
+
+from pilot.workflow import generic_hpc
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-def run():
-    logger.critical('not implemented')
-    return -1
+def run(args):
+    return generic_hpc.run(args)
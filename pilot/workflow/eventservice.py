@@ -5,12 +5,18 @@
 # http://www.apache.org/licenses/LICENSE-2.0
 #
 # Authors:
-# - Mario Lassnig, mario.lassnig@cern.ch, 2016
+# - Mario Lassnig, mario.lassnig@cern.ch, 2016-2017
+
+# event service jobs go through the generic workflow, their payload processes
+# event ranges from the server while it runs, see pilot.control.eventservice
+
+from pilot.workflow import generic
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-def run():
-    logger.critical('not implemented')
-    return -1
+def run(args):
+    from pilot.control import eventservice
+
+    return generic.run(args, execution=eventservice.control)
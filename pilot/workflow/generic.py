@@ -9,14 +9,18 @@
 # - Daniel Drizhuk, d.drizhuk@gmail.com, 2017
 
 import functools
-import Queue
 import signal
 import threading
 
 from collections import namedtuple
 
-from pilot.control import job, payload, data, lifetime
+from pilot.util import checkpoint
 from pilot.util.constants import SUCCESS
+from pilot.util.lifetime import Lifetime
+from pilot.util.registry import JobRegistry
+from pilot.util.shutdown import Shutdown
+from pilot.util.timing import JobTimer
+from pilot.util.workarea import WorkArea
 
 
 import logging
@@ -24,72 +28,104 @@ logger = logging.getLogger(__name__)
 
 
 def interrupt(args, signum, frame):
-    logger.info('caught signal: %s' % [v for v, k in signal.__dict__.iteritems() if k == signum][0])
-    args.graceful_stop.set()
+    # only flag the shutdown, which is run and logged by the main thread
+    args.shutdown.request([v for v, k in signal.__dict__.iteritems() if k == signum and v.startswith('SIG')][0])
 
 
-def run(args):
-    logger.info('setting up signal')
-    signal.signal(signal.SIGINT, functools.partial(interrupt, args))
+def run(args, execution=None):
+    """
+    Runs the jobs of the pilot until the shutdown.
+
+    :param execution: controller of the payload execution, from prepared to staging_out,
+                      :func:`pilot.control.payload.control` if `None`
+    """
+    # the controllers are imported with the workflow run, after the startup phases
+    from pilot.control import job, payload, data, lifetime, monitor
 
-    logger.info('setting up queues')
+    execution = execution or payload.control
 
-    queues = namedtuple('queues', ['jobs', 'payloads', 'data_in', 'data_out',
-                                   'validated_jobs', 'validated_payloads',
-                                   'finished_jobs', 'finished_payloads', 'finished_data_in', 'finished_data_out',
-                                   'failed_jobs', 'failed_payloads', 'failed_data_in', 'failed_data_out'])
+    logger.info('setting up lifetime and shutdown')
 
-    queues.jobs = Queue.Queue()
-    queues.payloads = Queue.Queue()
-    queues.data_in = Queue.Queue()
-    queues.data_out = Queue.Queue()
+    # the shutdown gets at most half of the lifetime
+    grace = min(args.shutdown_grace, args.lifetime / 2.0)
+    args.lifetime_manager = Lifetime(args.lifetime, grace=grace, clock=args.clock.monotonic)
+    args.shutdown = Shutdown(args.graceful_stop, grace=grace, end=args.lifetime_manager.end, clock=args.clock.monotonic)
+
+    logger.info('setting up signal')
+    signal.signal(signal.SIGINT, functools.partial(interrupt, args))
+    signal.signal(signal.SIGTERM, functools.partial(interrupt, args))
 
-    queues.validated_jobs = Queue.Queue()
-    queues.validated_payloads = Queue.Queue()
+    logger.info('setting up work area')
 
-    queues.finished_jobs = Queue.Queue()
-    queues.finished_payloads = Queue.Queue()
-    queues.finished_data_in = Queue.Queue()
-    queues.finished_data_out = Queue.Queue()
+    args.workarea = WorkArea(args.scratch, headroom=args.scratch_headroom, failed_dir=args.failed_jobs_dir,
+                             failed_size=args.failed_jobs_size)
 
-    queues.failed_jobs = Queue.Queue()
-    queues.failed_payloads = Queue.Queue()
-    queues.failed_data_in = Queue.Queue()
-    queues.failed_data_out = Queue.Queue()
+    logger.info('setting up job registry')
+
+    registry = JobRegistry(clock=args.clock.time)
+    registry.observe(checkpoint.observe)
+    registry.observe(args.workarea.observe)
+    registry.observe(args.lifetime_manager.estimates.observe)
+    job_timer = JobTimer(registry)
+    registry.observe(job_timer.observe)
+    if args.simulation is not None:
+        registry.observe(args.simulation.observe)
 
     logger.info('setting up tracing')
 
     traces = namedtuple('traces', ['pilot',
                                    'rucio'])
     traces.pilot = {'state': SUCCESS,
-                    'nr_jobs': 0}
+                    'nr_jobs': 0,
+                    'bytes_in': 0,
+                    'bytes_out': 0}
     traces.rucio = {}
 
+    logger.info('resuming jobs')
+
+    for resumed, state in checkpoint.load():
+        logger.info('resuming job %s in state %s' % (resumed['PandaID'], state))
+        args.workarea.resume(resumed)
+        registry.add(resumed, state)
+        traces.pilot['nr_jobs'] += 1
+
     logger.info('starting threads')
 
     threads = [threading.Thread(target=job.control,
-                                kwargs={'queues': queues,
+                                name='job',
+                                kwargs={'registry': registry,
                                         'traces': traces,
                                         'args': args}),
-               threading.Thread(target=payload.control,
-                                kwargs={'queues': queues,
+               threading.Thread(target=execution,
+                                name='payload',
+                                kwargs={'registry': registry,
                                         'traces': traces,
                                         'args': args}),
                threading.Thread(target=data.control,
-                                kwargs={'queues': queues,
+                                name='data',
+                                kwargs={'registry': registry,
                                         'traces': traces,
                                         'args': args}),
                threading.Thread(target=lifetime.control,
-                                kwargs={'queues': queues,
+                                name='lifetime',
+                                kwargs={'registry': registry,
+                                        'traces': traces,
+                                        'args': args}),
+               threading.Thread(target=monitor.control,
+                                name='monitor',
+                                kwargs={'registry': registry,
                                         'traces': traces,
                                         'args': args})]
 
-    [t.start() for t in threads]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
 
     logger.info('waiting for interrupts')
 
-    # Interruptible joins require a timeout
-    while threading.activeCount() > 1:
-        [t.join(timeout=1) for t in threads]
+    args.shutdown.wait_requested()
+    traces.pilot['shutdown'] = args.shutdown.run(registry, threads)
+    job_timer.dump('pilot_timing.json')
+    args.workarea.stop(timeout=60)
 
     return traces
@@ -5,12 +5,344 @@
 # http://www.apache.org/licenses/LICENSE-2.0
 #
 # Authors:
-# - Mario Lassnig, mario.lassnig@cern.ch, 2016
+# - Mario Lassnig, mario.lassnig@cern.ch, 2017
+
+# Workflow for HPC allocations: whole nodes with many cores, a shared
+# filesystem and no outbound network. An agent outside the allocation gets
+# the jobs from the server and writes them to a jobs file, a JSON list of
+# getJob answers. The pilot packs the jobs onto the cores of the node, by their
+# coreCount, and runs their payloads directly, supervised by one loop in one
+# process. Input files are taken from the shared filesystem and output files
+# and log tarballs are moved back there, by a stage-out thread so that the
+# loop keeps starting and supervising payloads meanwhile. The state of every
+# job is written to <results>/<PandaID>.json, from where the agent reports it
+# to the server.
+
+import functools
+import json
+import multiprocessing
+import os
+import Queue
+import shutil
+import signal
+import socket
+import threading
+import time
+
+from collections import namedtuple
+
+from pilot.util import offload
+from pilot.util.constants import SUCCESS
+from pilot.util.filehandling import adler32, write_atomic
+from pilot.util.lifetime import monotonic
+from pilot.util.shutdown import Shutdown
+from pilot.workflow.generic import interrupt
 
 import logging
 logger = logging.getLogger(__name__)
 
+# seconds between checks of the running payloads, one waitpid call each
+POLL_INTERVAL = 0.1
+
+# job fields copied to the state files
+STATE_FIELDS = ('coreCount', 'startTime', 'endTime', 'exitCode', 'errmsg', 'outputs')
+
+
+def load_jobs(path):
+    """
+    :returns: `list` of the job descriptions in a jobs file
+    """
+    with open(path) as jobs_file:
+        return json.load(jobs_file)
+
+
+def cores(job):
+    return int(job.get('coreCount') or 1)
+
+
+def pack(pending, free):
+    """
+    Chooses the jobs to start on the free cores, the first ones of the pending jobs which fit.
+
+    :param pending: `list` of the jobs waiting, largest first for a first-fit decreasing packing
+    :param int free: number of free cores
+    :returns: `list` of the jobs to start
+    """
+    chosen = []
+    for job in pending:
+        if not free:
+            break
+        if cores(job) <= free:
+            chosen.append(job)
+            free -= cores(job)
+    return chosen
+
+
+def write_state(job, state, directory):
+    """
+    Atomically writes the state file of a job.
+    """
+    entry = dict((field, job[field]) for field in STATE_FIELDS if field in job)
+    entry.update({'PandaID': job['PandaID'],
+                  'state': state,
+                  'time': time.time(),
+                  'node': socket.gethostname()})
+    write_atomic(os.path.join(directory, '%s.json' % job['PandaID']), [json.dumps(entry, sort_keys=True)])
+
+
+def _fail(job, errmsg, args, traces):
+    job.setdefault('errmsg', errmsg)
+    logger.getChild(str(job['PandaID'])).warning('job failed: %s' % job['errmsg'])
+    write_state(job, 'failed', args.hpc_results)
+    traces.pilot['failed'] += 1
+
+
+def _stage_in(job, shared):
+    for name in job['inFiles'].split(','):
+        if not name:
+            continue
+        path = os.path.join(shared, name)
+        if not os.path.exists(path):
+            raise IOError('input file %s not found in %s' % (name, shared))
+        os.symlink(os.path.abspath(path), os.path.join(job['working_dir'], name))
+
+
+def _deliver(job, output, shared):
+    path = os.path.join(job['working_dir'], output['name'])
+    if 'adler32' not in output:
+        output['bytes'] = os.path.getsize(path)
+        output['adler32'] = offload.call(adler32, path)
+    output['path'] = os.path.join(shared, output['name'])
+    shutil.move(path, output['path'])
+    return output
+
+
+def _stage_out(job, args, shared):
+    from pilot.control.data import prepare_log
+    from pilot.control.payload import read_job_report
+
+    guids = {}
+    try:
+        report = offload.call(read_job_report, os.path.join(job['working_dir'], 'jobReport.json'))
+        guids = dict((f['subFiles'][0]['name'], f['subFiles'][0]['file_guid']) for f in report.get('files', {}).get('output', []))
+    except (IOError, ValueError) as e:
+        # the agent assigns the GUIDs then
+        logger.getChild(str(job['PandaID'])).warning('cannot read job report: %s' % str(e))
+
+    outputs = [_deliver(job, {'scope': job['scopeOut'], 'name': name, 'guid': guids.get(name)}, shared)
+               for name in job['outFiles'].split(',') if name]
+    outputs.append(_deliver(job, prepare_log(job, 'tarball_PandaJob_%s_%s' % (job['PandaID'], args.queue)), shared))
+    return outputs
+
+
+def _start(job, args, shared, traces):
+    from pilot.control.payload import run_payload, setup_payload
+
+    log = logger.getChild(str(job['PandaID']))
+
+    job['working_dir'] = 'job-%s' % job['PandaID']
+    try:
+        os.mkdir(job['working_dir'])
+        _stage_in(job, shared)
+    except (OSError, IOError) as e:
+        _fail(job, 'stage-in failed: %s' % str(e), args, traces)
+        return None
+
+    out = open(os.path.join(job['working_dir'], 'payload.stdout'), 'wb')
+    err = open(os.path.join(job['working_dir'], 'payload.stderr'), 'wb')
+    write_state(job, 'starting', args.hpc_results)
+
+    proc = None
+    if setup_payload(job, out, err):
+        proc = run_payload(job, out, err)
+    if proc is None:
+        out.close()
+        err.close()
+        _fail(job, 'payload could not be started', args, traces)
+        return None
+
+    log.info('running on %s cores' % cores(job))
+    job['startTime'] = time.time()
+    write_state(job, 'running', args.hpc_results)
+    return proc, out, err
+
+
+def _stage_outs(todo, done, args, shared):
+    for job in iter(todo.get, None):
+        try:
+            done.put((job, _stage_out(job, args, shared), None))
+        except Exception as e:
+            # any error, the scheduler waits for every job handed over
+            done.put((job, None, e))
+
+
+def _finish(job, exit_code, args, traces, todo):
+    """
+    Hands a job whose payload is done to the stage-out thread.
+
+    :returns: `True` if the job is staged out, `False` if it failed
+    """
+    job['endTime'] = time.time()
+    job['exitCode'] = exit_code
+    if exit_code != 0:
+        _fail(job, 'payload failed with exit code %s' % exit_code, args, traces)
+        return False
+
+    write_state(job, 'transferring', args.hpc_results)
+    todo.put(job)
+    return True
+
+
+def _collect(done, staging, args, traces):
+    """
+    Writes the states of the jobs whose stage-out is over.
+
+    :param staging: `dict` of the jobs handed to the stage-out thread by PandaID, the collected ones are removed
+    :returns: `int` -- number of jobs collected
+    """
+    collected = 0
+    while True:
+        try:
+            job, outputs, error = done.get_nowait()
+        except Queue.Empty:
+            return collected
+        del staging[job['PandaID']]
+        collected += 1
+        if error is not None:
+            _fail(job, 'stage-out failed: %s' % str(error), args, traces)
+        else:
+            job['outputs'] = outputs
+            write_state(job, 'finished', args.hpc_results)
+            traces.pilot['finished'] += 1
+
+
+def _stop(running, args, traces):
+    # the payloads get what is left of the shutdown grace period to exit
+    deadline = time.time() + max(0, min(args.shutdown.grace, args.shutdown.end - args.shutdown.clock()))
+    for job, proc, out, err in running.values():
+        proc.terminate()
+    while [proc for job, proc, out, err in running.values() if proc.poll() is None] and time.time() < deadline:
+        time.sleep(0.1)
+
+    for job, proc, out, err in running.values():
+        if proc.poll() is None:
+            proc.kill()
+        out.close()
+        err.close()
+        job['endTime'] = time.time()
+        _fail(job, 'terminated at shutdown', args, traces)
+
+
+def _schedule(pending, free, args, shared, traces, todo, done):
+    """
+    Runs the pending jobs on the free cores until all are done or the shutdown is requested.
+
+    :param todo: `Queue` of the stage-out thread
+    :param done: `Queue` of the jobs the stage-out thread is done with, with their outputs or error
+    :returns: the jobs still running, still pending and still being staged out
+    """
+    running = {}
+    staging = {}
+    while pending or running or staging:
+        if args.shutdown.reason is None and args.shutdown.clock() >= args.shutdown.end - args.shutdown.grace:
+            args.shutdown.request('lifetime')
+        if args.shutdown.reason is not None:
+            logger.warning('shutdown (%s) -- %s jobs running, %s staging out, %s not started' %
+                           (args.shutdown.reason, len(running), len(staging), len(pending)))
+            break
+
+        polled = [(job, proc.poll(), out, err) for job, proc, out, err in running.values()]
+        finished = [entry for entry in polled if entry[1] is not None]
+        for job, exit_code, out, err in finished:
+            del running[job['PandaID']]
+            free += cores(job)
+            out.close()
+            err.close()
+
+        # the freed cores are filled before the stage-outs of the jobs done
+        chosen = pack(pending, free)
+        if chosen:
+            started = set(job['PandaID'] for job in chosen)
+            pending = [job for job in pending if job['PandaID'] not in started]
+        for job in chosen:
+            entry = _start(job, args, shared, traces)
+            if entry is not None:
+                running[job['PandaID']] = (job,) + entry
+                free -= cores(job)
+
+        for job, exit_code, out, err in finished:
+            if _finish(job, exit_code, args, traces, todo):
+                staging[job['PandaID']] = job
+
+        collected = _collect(done, staging, args, traces)
+
+        if not finished and not chosen and not collected:
+            time.sleep(POLL_INTERVAL)
+
+    return running, pending, staging
+
+
+def run(args):
+    logger.info('setting up shutdown')
+
+    args.shutdown = Shutdown(args.graceful_stop,
+                             grace=min(args.shutdown_grace, args.lifetime / 2.0),
+                             end=monotonic() + args.lifetime,
+                             clock=monotonic)
+
+    logger.info('setting up signal')
+    signal.signal(signal.SIGINT, functools.partial(interrupt, args))
+    signal.signal(signal.SIGTERM, functools.partial(interrupt, args))
+
+    logger.info('setting up tracing')
+
+    traces = namedtuple('traces', ['pilot'])
+    traces.pilot = {'state': SUCCESS,
+                    'nr_jobs': 0,
+                    'finished': 0,
+                    'failed': 0}
+
+    node_cores = args.hpc_cores or multiprocessing.cpu_count()
+    shared = args.hpc_shared or os.path.dirname(os.path.abspath(args.hpc_jobs))
+    if not os.path.isdir(args.hpc_results):
+        os.makedirs(args.hpc_results)
+
+    try:
+        jobs = load_jobs(args.hpc_jobs)
+    except (IOError, ValueError) as e:
+        logger.error('cannot read jobs file %s: %s' % (args.hpc_jobs, str(e)))
+        return traces
+    traces.pilot['nr_jobs'] = len(jobs)
+
+    pending = []
+    for job in jobs:
+        if cores(job) > node_cores:
+            _fail(job, 'needs %s cores, the node has %s' % (cores(job), node_cores), args, traces)
+        else:
+            pending.append(job)
+    pending.sort(key=cores, reverse=True)
+
+    logger.info('packing %s jobs onto %s cores -- shared filesystem %s, results in %s' % (len(pending), node_cores, shared, args.hpc_results))
+
+    todo, done = Queue.Queue(), Queue.Queue()
+    stager = threading.Thread(target=_stage_outs, name='stageout', args=(todo, done, args, shared))
+    stager.daemon = True
+    stager.start()
+
+    running, pending, staging = _schedule(pending, node_cores, args, shared, traces, todo, done)
+
+    _stop(running, args, traces)
+    for job in pending:
+        _fail(job, 'not started before the end of the allocation', args, traces)
+
+    # the stage-outs handed over get what is left of the allocation
+    todo.put(None)
+    stager.join(max(0, args.shutdown.end - args.shutdown.clock()))
+    _collect(done, staging, args, traces)
+    for job in staging.values():
+        _fail(job, 'stage-out not finished before the end of the allocation', args, traces)
+
+    logger.info('%s jobs finished, %s failed' % (traces.pilot['finished'], traces.pilot['failed']))
+    args.graceful_stop.set()
 
-def run():
-    logger.critical('not implemented')
-    return -1
+    return traces